@@ -33,6 +33,9 @@ setup(
     ],
     packages=["bloc", "twisted.plugins"],
     package_dir={"": "src"},
+    entry_points={
+        "console_scripts": ["bloc-bench = bloc.bench:main"]
+    },
     install_requires=[
         "twisted>=16.5.0",
         "treq>=15.1.0",
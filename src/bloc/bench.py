@@ -0,0 +1,464 @@
+"""
+Benchmarks for bloc server. Run ``bloc-bench --help`` for usage. It has three modes:
+
+* ``sim``: Drives :obj:`SettlingGroup` and :obj:`HeartbeatingClients` directly with a fake clock.
+  It measures only the server's algorithmic cost and is deterministic in everything but the
+  timings, so it is useful to track regressions over time.
+* ``load``: Starts many :obj:`BlocClient` sessions against a real server over HTTP and measures
+  heartbeat latency, throughput and time to settle. If the server is not given then a local one
+  is started as a child process and its CPU usage is also reported.
+* ``http``: Feeds raw heartbeat requests in process to both the Klein resource and
+  :obj:`LeanResource` and reports the cost of each without any networking.
+"""
+
+from __future__ import division, print_function
+
+import os
+import socket
+import sys
+from timeit import default_timer
+
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+from twisted.internet.defer import Deferred, gatherResults, inlineCallbacks, returnValue
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import usage
+from twisted.web.http import HTTPChannel
+from twisted.web.server import Site
+
+from bloc.client import BlocClient, connection_pool
+from bloc.detector import PhiAccrualDetector
+from bloc.server import Bloc, HeartbeatingClients, LeanResource, SettlingGroup
+
+
+def percentile(values, p):
+    """
+    Return `p` th percentile of `values` using nearest rank method. None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(p / 100 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summary(values):
+    """
+    Return dict of commonly reported percentiles of `values`
+    """
+    return {"p50": percentile(values, 50), "p90": percentile(values, 90),
+            "p99": percentile(values, 99), "max": max(values) if values else None}
+
+
+def simulate(clients, interval=1, timeout=3, settle=6, duration=60, churn=0, churn_every=20,
+             tick=0.1, timer=default_timer, phi=None):
+    """
+    Simulate `clients` clients heartbeating every `interval` seconds for `duration` seconds of
+    fake time. Every `churn_every` seconds, `churn` clients stop heartbeating and the same number
+    of new clients join.
+
+    :param float phi: If given, clients are also removed by :obj:`PhiAccrualDetector` with this
+        threshold
+    :return: dict with number of heartbeats, their cost in seconds, cost of checking heartbeats,
+        number of clients timed out and the fake time taken to settle after each churn
+    """
+    clock = task.Clock()
+    group = SettlingGroup(clock, settle)
+    # Not started as a service; its check is called below every second of fake time
+    hbclients = HeartbeatingClients(
+        clock, timeout, 1, group.remove,
+        detector=PhiAccrualDetector(phi) if phi is not None else None)
+
+    live = ["c{}".format(i) for i in range(clients)]
+    next_id = [clients]
+    heartbeat_costs = []
+    check_costs = []
+    settle_times = []
+    churned_at = [None]
+
+    def timed_check():
+        start = timer()
+        hbclients._check_clients()
+        check_costs.append(timer() - start)
+
+    def do_churn():
+        for client in live[:churn]:
+            # stops heartbeating and will be timed out
+            live.remove(client)
+        for _ in range(churn):
+            live.append("c{}".format(next_id[0]))
+            next_id[0] += 1
+        churned_at[0] = clock.seconds()
+
+    ticks_per_interval = max(int(round(interval / tick)), 1)
+    ticks_per_check = int(round(1 / tick))
+    heartbeats = 0
+    for now_tick in range(1, int(round(duration / tick)) + 1):
+        slot = now_tick % ticks_per_interval
+        # clients are spread evenly within the interval
+        start = timer()
+        for client in live[slot::ticks_per_interval]:
+            hbclients.heartbeat(client)
+            group.add(client)
+            heartbeats += 1
+        heartbeat_costs.append(timer() - start)
+        clock.advance(tick)
+        if now_tick % ticks_per_check == 0:
+            timed_check()
+        if churned_at[0] is not None and group.settled and len(group) == len(live):
+            settle_times.append(clock.seconds() - churned_at[0])
+            churned_at[0] = None
+        if churn and now_tick % int(round(churn_every / tick)) == 0:
+            do_churn()
+
+    return {"heartbeats": heartbeats,
+            "heartbeat_cost": sum(heartbeat_costs) / heartbeats if heartbeats else None,
+            "check_cost": summary(check_costs),
+            "settle_times": settle_times,
+            "timeouts": hbclients.timeouts,
+            "members": len(group),
+            "settled": group.settled}
+
+
+class _Transport(object):
+    """
+    In memory transport of :obj:`HTTPChannel` that keeps what is written to it
+    """
+    disconnecting = False
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writeSequence(self, data):
+        self.written.extend(data)
+
+    def take(self):
+        """
+        Return bytes written since last call
+        """
+        data, self.written = b''.join(self.written), []
+        return data
+
+    def getPeer(self):
+        return IPv4Address('TCP', '127.0.0.1', 8990)
+
+    def getHost(self):
+        return IPv4Address('TCP', '127.0.0.1', 8989)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+def _channel(site):
+    """
+    Return :obj:`HTTPChannel` of `site` connected to an in memory transport
+    """
+    channel = HTTPChannel()
+    # Set up like Site.buildProtocol does
+    channel.site = site
+    channel.requestFactory = site.requestFactory
+    # Do not schedule idle timeout on the global reactor
+    channel.timeOut = None
+    channel.makeConnection(_Transport())
+    return channel
+
+
+def _heartbeat(channel, session_id, timer=default_timer):
+    """
+    Send heartbeat request of `session_id` to `channel` as raw bytes
+
+    :return: ``(seconds, response)`` tuple with time taken to parse and handle the request and
+        the raw response written
+    """
+    data = b'GET /index HTTP/1.1\r\nBloc-Session-ID: ' + session_id + b'\r\n\r\n'
+    start = timer()
+    channel.dataReceived(data)
+    return timer() - start, channel.transport.take()
+
+
+def handle(requests, clients=100, timer=default_timer):
+    """
+    Handle `requests` heartbeat requests from `clients` clients in process using both the Klein
+    resource and :obj:`LeanResource` of :obj:`Bloc`. Only processing of the received request
+    bytes, i.e. parsing the request, finding the resource and rendering the response is timed.
+
+    :return: dict with average seconds taken per request by each resource
+    """
+    results = {}
+    for name, make_resource in [("klein", lambda bloc: bloc.app.resource()),
+                                ("lean", LeanResource)]:
+        bloc = Bloc(task.Clock(), 3, 6)
+        channel = _channel(Site(make_resource(bloc)))
+        sessions = ["c{}".format(i).encode("utf-8") for i in range(clients)]
+        taken = 0
+        for i in range(requests):
+            taken += _heartbeat(channel, sessions[i % clients], timer)[0]
+        results[name] = taken / requests
+    return results
+
+
+class TimedBlocClient(BlocClient):
+    """
+    BlocClient that records latency of each heartbeat
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.latencies = kwargs.pop("latencies")
+        super(TimedBlocClient, self).__init__(*args, **kwargs)
+
+    def _get_index(self, params=None):
+        start = default_timer()
+        d = super(TimedBlocClient, self)._get_index(params)
+
+        def record(result):
+            self.latencies.append(default_timer() - start)
+            return result
+
+        return d.addCallback(record)
+
+
+class _ServerProcess(ProcessProtocol):
+    """
+    Local bloc server started by ``load`` benchmark
+    """
+
+    def __init__(self):
+        self.ended = Deferred()
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+
+def _wait_for_port(clock, port, attempts=50):
+    """
+    Return Deferred that fires when something is listening on localhost `port`
+    """
+    def check():
+        s = socket.socket()
+        try:
+            s.connect(("127.0.0.1", port))
+        except socket.error:
+            if check.attempts == 0:
+                raise Exception("bloc server did not start on port {}".format(port))
+            check.attempts -= 1
+        else:
+            loop.stop()
+        finally:
+            s.close()
+
+    check.attempts = attempts
+    loop = task.LoopingCall(check)
+    loop.clock = clock
+    return loop.start(0.1)
+
+
+def _settled_at(clock, clients):
+    """
+    Return Deferred that fires with time taken for all clients to be settled with same total
+    """
+    start = clock.seconds()
+
+    def check():
+        totals = set(c.get_index_total() and c.get_index_total()[1] for c in clients)
+        if totals == set([len(clients)]):
+            loop.stop()
+
+    loop = task.LoopingCall(check)
+    loop.clock = clock
+    return loop.start(0.05).addCallback(lambda _: clock.seconds() - start)
+
+
+@inlineCallbacks
+def load(reactor, options):
+    """
+    Run ``load`` benchmark and return dict of results
+    """
+    proc = None
+    server = options["server"]
+    if server is None:
+        port = options["port"]
+        server = "127.0.0.1:{}".format(port)
+        proc = _ServerProcess()
+        reactor.spawnProcess(
+            proc, sys.executable,
+            [sys.executable, "-m", "twisted", "--log-level=warn", "bloc",
+             "-l", "tcp:{}:interface=127.0.0.1".format(port),
+             "-t", str(options["timeout"]), "-s", str(options["settle"])] +
+            (["--lean"] if options["lean"] else []) +
+            (["--workers", str(options["workers"])] if options["workers"] else []),
+            env=os.environ)
+        yield _wait_for_port(reactor, port)
+
+    pool = connection_pool(reactor, persistent=options["clients"])
+    latencies = []
+    interval = options["interval"]
+
+    def new_client():
+        return TimedBlocClient(reactor, server, interval, pool=pool, latencies=latencies)
+
+    clients = [new_client() for _ in range(options["clients"])]
+    for i, client in enumerate(clients):
+        # spread the clients in the interval
+        reactor.callLater(interval * i / len(clients), client.startService)
+    first_settle = yield _settled_at(reactor, clients)
+
+    del latencies[:]
+    start = default_timer()
+    cpu_start = _process_cpu(proc.transport.pid) if proc is not None else None
+    reused, created = pool.reused, pool.created
+    settle_times = []
+    elapsed = 0
+    while elapsed < options["duration"]:
+        if options["churn"]:
+            yield gatherResults([c.stopService() for c in clients[:options["churn"]]])
+            del clients[:options["churn"]]
+            for _ in range(options["churn"]):
+                client = new_client()
+                client.startService()
+                clients.append(client)
+            settle_times.append((yield _settled_at(reactor, clients)))
+        else:
+            yield task.deferLater(reactor, options["duration"], lambda: None)
+        elapsed = default_timer() - start
+    heartbeats = len(latencies)
+    reused, created = pool.reused - reused, pool.created - created
+    server_cpu = None
+    if cpu_start is not None:
+        server_cpu = _process_cpu(proc.transport.pid) - cpu_start
+
+    yield gatherResults([c.stopService() for c in clients])
+    yield pool.closeCachedConnections()
+    if proc is not None:
+        proc.transport.signalProcess("TERM")
+        yield proc.ended
+
+    returnValue({
+        "heartbeats": heartbeats,
+        "rate": heartbeats / elapsed,
+        "latency": summary(latencies),
+        "first_settle": first_settle,
+        "settle_times": settle_times,
+        "server_cpu_per_heartbeat": server_cpu / heartbeats if server_cpu and heartbeats else None,
+        "connections_reused": reused,
+        "connections_created": created,
+    })
+
+
+def _process_cpu(pid):
+    """
+    Return CPU seconds used by process `pid` so far. None if it cannot be found which is the case
+    on systems without procfs
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (IOError, OSError):
+        return None
+    # utime and stime are 14th and 15th fields, counted from after the command name
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _format(value):
+    if isinstance(value, float):
+        return "{:.6f}".format(value)
+    if isinstance(value, dict):
+        return ", ".join("{}={}".format(k, _format(v)) for k, v in sorted(value.items()))
+    if isinstance(value, list):
+        return "[" + ", ".join(_format(v) for v in value) + "]"
+    return str(value)
+
+
+def _report(results):
+    for key, value in sorted(results.items()):
+        print("{:<26}{}".format(key, _format(value)))
+
+
+class SimOptions(usage.Options):
+    """
+    Options for ``sim`` benchmark
+    """
+    optParameters = [
+        ['clients', 'n', 5000, "Number of clients", int],
+        ['interval', 'i', 1, "Client heartbeat interval in seconds", float],
+        ['timeout', 't', 3, "Server heartbeat timeout in seconds", float],
+        ['settle', 's', 6, "Server settle time in seconds", float],
+        ['duration', 'd', 60, "Fake seconds to simulate", float],
+        ['churn', 'c', 0, "Number of clients replaced every churn-every seconds", int],
+        ['churn-every', None, 20, "Seconds between churns", float],
+        ['phi', None, None, "Also remove clients with phi accrual detector of this threshold",
+         float],
+    ]
+
+
+class LoadOptions(usage.Options):
+    """
+    Options for ``load`` benchmark
+    """
+    optParameters = [
+        ['server', None, None, "server:port of bloc server. Local server is started if not given"],
+        ['port', 'p', 18989, "Port of local server", int],
+        ['clients', 'n', 500, "Number of clients", int],
+        ['interval', 'i', 1, "Client heartbeat interval in seconds", float],
+        ['timeout', 't', 3, "Local server heartbeat timeout in seconds", float],
+        ['settle', 's', 6, "Local server settle time in seconds", float],
+        ['duration', 'd', 30, "Seconds to run after first settle", float],
+        ['churn', 'c', 0, "Number of clients replaced after each settle", int],
+        ['workers', 'w', None, "Start local server with these many worker processes. Server CPU "
+         "is then of the coordinator process only", int],
+    ]
+    optFlags = [
+        ['lean', None, "Start local server with --lean"],
+    ]
+
+
+class HttpOptions(usage.Options):
+    """
+    Options for ``http`` benchmark
+    """
+    optParameters = [
+        ['requests', 'r', 20000, "Number of requests to handle with each resource", int],
+        ['clients', 'n', 100, "Number of clients sending the requests", int],
+    ]
+
+
+class Options(usage.Options):
+    """
+    Options for bloc-bench
+    """
+    subCommands = [
+        ['sim', None, SimOptions, "Simulate server with fake clock"],
+        ['load', None, LoadOptions, "Load a real server over HTTP"],
+        ['http', None, HttpOptions, "Compare cost of handling heartbeats with Klein and lean "
+         "resources"],
+    ]
+
+
+def main(argv=None):
+    """
+    Entry point of ``bloc-bench``
+    """
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        print("{}\n{}".format(options, e))
+        sys.exit(1)
+    sub = options.subOptions
+    if options.subCommand == "sim":
+        _report(simulate(sub["clients"], sub["interval"], sub["timeout"], sub["settle"],
+                         sub["duration"], sub["churn"], sub["churn-every"], phi=sub["phi"]))
+    elif options.subCommand == "load":
+        task.react(lambda reactor: load(reactor, sub).addCallback(_report))
+    elif options.subCommand == "http":
+        _report(handle(sub["requests"], sub["clients"]))
+    else:
+        print(options)
@@ -1,46 +1,347 @@
 from __future__ import print_function
 
+import json
+import random
 import uuid
+from collections import OrderedDict
 
 import treq
+from treq.client import HTTPClient
 
 from twisted.application.service import Service
 from twisted.internet import task
+from twisted.internet.defer import Deferred, gatherResults, succeed
+from twisted.internet.endpoints import clientFromString, connectProtocol
 from twisted.logger import Logger
+from twisted.web.client import Agent, HTTPConnectionPool
 
+from bloc.partition import HashRing
+from bloc.protocol import BlocLineClientProtocol
 from bloc.utils import check_status
 
 
-class BlocClient(Service):
+# Default fraction up to which adaptive heartbeats randomly happen earlier than suggested by
+# the server
+HINT_JITTER = 0.1
+
+# Fraction of the lease granted by the server that is not relied upon to account for the
+# client's clock running slower than the server's and for delays in the server
+LEASE_MARGIN = 0.2
+
+# Seconds after which getting members of a large group is given up and tried again on next
+# heartbeat
+MEMBERS_TIMEOUT = 30
+
+# Number of intervals after which LineBlocClient gives up on a response and aborts the connection
+LINE_ABORT_INTERVALS = 5
+
+
+class CountingConnectionPool(HTTPConnectionPool):
+    """
+    :obj:`HTTPConnectionPool` that counts requests that got a cached persistent connection and
+    new connections made. If heartbeats make many new connections then they are paying for
+    TCP setup which increases their latency.
+    """
+    reused = 0
+    created = 0
+
+    def getConnection(self, key, endpoint):
+        created = self.created
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        if self.created == created:
+            self.reused += 1
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self.created += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+
+def connection_pool(reactor, persistent=2, idle_timeout=240, retry=True):
+    """
+    Return :obj:`CountingConnectionPool` to be given to :obj:`BlocClient` or
+    :obj:`BlocMultiplexer`. Many clients in a process can share one pool.
+
+    :param reactor: Twisted reactor
+    :param int persistent: Maximum number of idle connections kept open per server. Connections
+        are not kept if it is 0. It should be at least the number of clients sharing the pool.
+    :param float idle_timeout: Seconds after which an idle connection is closed. It should be
+        more than the heartbeat interval for connections to be reused.
+    :param bool retry: Should a request be retried once on a new connection if the cached
+        connection it was sent on turns out to be closed by the server?
+    """
+    pool = CountingConnectionPool(reactor, persistent=persistent > 0)
+    pool.maxPersistentPerHost = persistent
+    pool.cachedConnectionTimeout = idle_timeout
+    pool.retryAutomatically = retry
+    return pool
+
+
+class _Session(object):
+    """
+    Index of a session as last reported by bloc server
+    """
+
+    def __init__(self, clock, session_id):
+        self.clock = clock
+        self._settled = False
+        self._index = 0
+        self._total = 0
+        self._generation = 0
+        self._buckets = None
+        self._range = None
+        self._weight_total = None
+        if session_id is None:  # pragma: no cover
+            self._session_id = str(uuid.uuid1())
+        else:
+            self._session_id = session_id
+        self.log = Logger()
+        # Callbacks and Deferreds waiting for changes and the state they were last told about
+        self._listeners = []
+        self._settled_waiters = []
+        self._last_state = (None, None)
+        # Time until which the index is leased and timer unsettling when it lapses
+        self._lease_expiry = None
+        self._lease_timer = None
+
+    def _set_index(self, content, sent=None):
+        """
+        Update index from server's response to request sent at `sent` seconds
+        """
+        if content['status'] == 'SETTLED':
+            self._settled = True
+            self._index = content['index']
+            self._total = content['total']
+            self._generation = content.get('generation', self._generation)
+            self._buckets = content.get('buckets')
+            self._range = content.get('range')
+            self._weight_total = content.get('weight_total')
+            self._cancel_lease_timer()
+            lease = content.get('lease')
+            if lease is not None and sent is not None:
+                self._lease_expiry = sent + lease * (1 - LEASE_MARGIN)
+            else:
+                self._lease_expiry = None
+            self._check_changed()
+        else:
+            self._set_unsettled()
+
+    def _set_unsettled(self):
+        self._settled = False
+        self._lease_expiry = None
+        self._cancel_lease_timer()
+        self._check_changed()
+
+    def _cancel_lease_timer(self):
+        if self._lease_timer is not None and self._lease_timer.active():
+            self._lease_timer.cancel()
+        self._lease_timer = None
+
+    def _heartbeat_failed(self):
+        """
+        Keep the index if it is leased until the lease lapses. Unsettle otherwise.
+        """
+        remaining = self._leased_for()
+        if remaining > 0:
+            if self._lease_timer is None:
+                self._lease_timer = self.clock.callLater(remaining, self._set_unsettled)
+        else:
+            self._set_unsettled()
+
+    def _leased_for(self):
+        """
+        Return seconds for which the index remains leased. 0 if it is not leased.
+        """
+        if not self._settled or self._lease_expiry is None:
+            return 0
+        return max(self._lease_expiry - self.clock.seconds(), 0)
+
+    def _check_changed(self):
+        """
+        Call listeners and fire waiters if index, total or buckets changed since last time
+        """
+        state = (self.get_index_total(), self.get_buckets())
+        if state == self._last_state:
+            return
+        self._last_state = state
+        for callback in list(self._listeners):
+            try:
+                callback(state[0])
+            except Exception:
+                self.log.failure("Error in on_change callback {c}", c=callback)
+        if state[0] is not None:
+            waiters, self._settled_waiters = self._settled_waiters, []
+            for d in waiters:
+                d.callback(state[0])
+
+    def on_change(self, callback):
+        """
+        Call `callback` with the new value of :func:`get_index_total` every time it changes,
+        i.e. with ``(index, total)`` when the group settles and with None when it starts
+        settling or when the server cannot be reached. It is also called if the buckets change.
+        Work based on the old index should be stopped before the callback returns.
+
+        :return: A function to call with no arguments to stop calling `callback`
+        """
+        self._listeners.append(callback)
+        return lambda: self._listeners.remove(callback)
+
+    def when_settled(self):
+        """
+        Return Deferred that fires with ``(index, total)`` when this client is next settled.
+        It fires immediately if it is already settled. Cancelling it stops waiting.
+        """
+        index_total = self.get_index_total()
+        if index_total is not None:
+            return succeed(index_total)
+        d = Deferred(self._settled_waiters.remove)
+        self._settled_waiters.append(d)
+        return d
+
+    def _error_allocating(self, f):
+        self._heartbeat_failed()
+        self.log.error("Error getting index: {f}", f=f)
+
+    @property
+    def session_id(self):
+        """
+        Session id identifying this client in the group
+        """
+        return self._session_id
+
+    def get_index_total(self):
+        """
+        Return (index, total) tuple if settled, None if settling. Here "index" is position of this
+        node in the group and "total" is number of nodes in the group. For example, if there are
+        two BlocClient instances talking to the server then one of them will get (1, 2) and other
+        will get (2, 2). Note that this returns internal state last updated every "interval"
+        seconds.
+
+        If the server grants leases (``--leases``) then the index is kept when heartbeats fail
+        until the lease lapses. Without leases it is dropped on the first failed heartbeat.
+        """
+        if not self._settled:
+            return None
+        if self._lease_timer is not None and not self._leased_for():
+            # Lease has lapsed but the timer has not run yet
+            return None
+        return (self._index, self._total)
+
+    def get_generation(self):
+        """
+        Return generation of the group's settle that assigned the current index if settled,
+        None otherwise. The server increments it every time the group settles so it can be
+        used as a fencing token: stores shared by the nodes can reject writes carrying a lower
+        generation than one they have already seen since those come from a node working with
+        a stale index. A named group starts from the highest generation reached by any discarded
+        named group so it does not go back when it is created again. Note that it starts again
+        from 1 when the server restarts unless it restores from a snapshot or a standby takes
+        over.
+        """
+        if not self._settled:
+            return None
+        return self._generation
+
+    def get_buckets(self):
+        """
+        Return list of buckets assigned to this node if settled and server is started with
+        fixed number of buckets. None otherwise.
+        """
+        if not self._settled:
+            return None
+        return self._buckets
+
+    def get_range(self):
+        """
+        Return (start, end, total) tuple if settled, None otherwise. This node owns the
+        [start, end) range of total. If any member of the group heartbeats with a weight then
+        members own ranges of sum of their weights in proportion to their weights. Otherwise
+        it is (index - 1, index, total). Items can be partitioned by owning items whose
+        ``hash % total`` is in the range.
+        """
+        index_total = self.get_index_total()
+        if index_total is None:
+            return None
+        if self._range is None:
+            index, total = index_total
+            return (index - 1, index, total)
+        start, end = self._range
+        return (start, end, self._weight_total)
+
+
+class BlocClient(_Session, Service):
     """
     Client to connect to bloc server
     """
 
-    def __init__(self, clock, server, interval, treq=treq, session_id=None):
+    def __init__(self, clock, server, interval, treq=treq, session_id=None, long_poll=False,
+                 track_members=False, group=None, adaptive=False, jitter=None,
+                 random_start=False, pool=None, weight=None):
         """
         Create a BlocClient instance
 
         :param clock: An implementation of :obj:`IReactorTime`. Typically will be main twisted
             reactor.
-        :param str server: server connection info in "server:port" form
+        :param server: server connection info in "server:port" form or list of them. If a list
+            is given then the client talks to the first one and moves to the next one in the
+            list whenever getting index fails. Typically a primary server and its standby.
         :param float interval: Frequency of heartbeat in seconds
-        """
-        self.clock = clock
-        self._server = server
+        :param bool long_poll: If True, instead of heartbeating every `interval` seconds, keep a
+            request open with the server that it responds to as soon as the group changes or
+            after `interval` seconds. Index changes are then known immediately.
+        :param bool track_members: If True, keep track of all members of the group by fetching
+            changes in them every time it settles so that :func:`get_ring` and
+            :func:`get_members` can be used
+        :param str group: Name of the group to join. The server's default group if not given
+        :param bool adaptive: If True, heartbeat after the number of seconds suggested by the
+            server in its last response instead of every `interval` seconds. The server suggests
+            it only if started with ``--hints``. `interval` is used when there is no suggestion
+            or when the heartbeat fails.
+        :param float jitter: Fraction of the delay up to which each heartbeat randomly happens
+            earlier, so that clients started together do not heartbeat together. Defaults to
+            `HINT_JITTER` when `adaptive` is True and 0 otherwise.
+        :param bool random_start: If True, the first heartbeat happens after random delay within
+            `interval` instead of immediately
 
-        self._settled = False
-        self._index = 0
-        self._total = 0
+        :param pool: :obj:`HTTPConnectionPool` to make requests with instead of treq's default
+            pool. Typically got from :func:`connection_pool`. It is not closed when the client
+            stops since it may be shared.
+        :param int weight: Capacity of this node relative to others sent with every heartbeat.
+            Nodes get ranges from :func:`get_range`, buckets and share of :func:`get_ring` in
+            proportion to their weights. Not sent if not given, which is same as weight 1. It
+            must be from 1 to :obj:`bloc.server.MAX_WEIGHT`.
+        """
+        _Session.__init__(self, clock, session_id)
+        self._servers = list(server) if isinstance(server, (list, tuple)) else [server]
+        self._server = self._servers[0]
         self._interval = interval
 
+        self._long_poll = long_poll
+        self._adaptive = adaptive
+        if jitter is None:
+            jitter = HINT_JITTER if adaptive else 0
+        self._jitter = jitter
+        self._random_start = random_start
+        if pool is not None:
+            treq = HTTPClient(Agent(clock, pool=pool))
         self._loop = task.LoopingCall(self._heartbeat)
         self._loop.clock = self.clock
-        if session_id is None:  # pragma: no cover
-            self._session_id = str(uuid.uuid1())
-        else:
-            self._session_id = session_id
-
-        self.log = Logger()
+        # Next scheduled and in-flight request when long polling or heartbeating adaptively
+        self._next_poll = None
+        self._polling = None
+        # Seconds to next heartbeat suggested in the last response
+        self._hint = None
+        self._random = random.random
+        self._track_members = track_members
+        self._group = group
+        self._ring = None
+        self._ring_generation = None
+        # Members of the group with their weights as of generation `_members_generation`
+        self._members = None
+        self._members_generation = None
+        # In-flight request getting members
+        self._getting_members = None
+        self._weight = weight
         self.treq = treq
 
     def startService(self):
@@ -48,35 +349,192 @@ class BlocClient(Service):
         Start getting the index and effectively heartbeating
         """
         super(BlocClient, self).startService()
-        self._loop.start(self._interval, True)
+        if self._long_poll:
+            self._poll()
+        elif self._random_start:
+            self._schedule(self._interval * self._random(), self._scheduled_heartbeat)
+        elif self._adaptive or self._jitter:
+            self._scheduled_heartbeat()
+        else:
+            self._loop.start(self._interval, True)
 
-    def _set_index(self, content):
-        if content['status'] == 'SETTLED':
-            self._settled = True
-            self._index = content['index']
-            self._total = content['total']
+    def _set_index(self, content, sent=None):
+        super(BlocClient, self)._set_index(content, sent)
+        self._hint = content.get('heartbeat')
+        if self._members is not None and content['status'] == 'SETTLED' and \
+                self._generation < self._members_generation:
+            # Generation went back. Server restarted and its changes cannot be applied.
+            self._members = None
+        if self._track_members and self._settled and \
+                self._ring_generation != self._generation:
+            self._get_members()
+
+    def _error_allocating(self, f):
+        super(BlocClient, self)._error_allocating(f)
+        if len(self._servers) > 1:
+            self._server = self._servers[(self._servers.index(self._server) + 1) %
+                                         len(self._servers)]
+            self.log.info("Failing over to {s}", s=self._server)
+
+    def _get_members(self):
+        """
+        Bring members up to date with the index's generation, getting only the changes since
+        the members' generation if there are any. It is done independent of heartbeats so that
+        failing to get members does not affect the index.
+        """
+        if self._members is not None and self._members_generation == self._generation:
+            self._update_ring()
+            return
+        if self._getting_members is not None:
+            return
+        params = None
+        if self._members is not None:
+            params = {'since': str(self._members_generation)}
+        d = self._getting_members = self.treq.get(self._url("members"), params=params)
+        d.addTimeout(MEMBERS_TIMEOUT, self.clock)
+        d.addCallback(check_status, [200])
+        d.addCallback(treq.json_content)
+        d.addCallback(self._set_members)
+        d.addErrback(lambda f: self.log.error("Error getting members: {f}", f=f))
+
+        def done(_):
+            self._getting_members = None
+
+        d.addBoth(done)
+
+    def _set_members(self, content):
+        """
+        Update members from ``GET /members`` response with either all the members or the
+        changes since the members' generation
+        """
+        if content['status'] != 'SETTLED':
+            return
+        weights = content.get('weights', {})
+        if 'members' in content:
+            self._members = dict((m, weights.get(m, 1)) for m in content['members'])
+        elif self._members is not None and content['since'] == self._members_generation:
+            for member in content['removed']:
+                self._members.pop(member, None)
+            for member in content['added']:
+                self._members[member] = weights.get(member, 1)
         else:
-            self._settled = False
+            return
+        self._members_generation = content['generation']
+        self._update_ring()
+
+    def _update_ring(self):
+        # Group could've changed after index was got. Will be tried again in next heartbeat
+        if self._members_generation == self._generation:
+            weights = dict((m, w) for m, w in self._members.items() if w != 1)
+            self._ring = HashRing(self._members, weights=weights)
+            self._ring_generation = self._generation
+
+    def get_members(self):
+        """
+        Return sorted list of session ids of all members of the group if settled, None
+        otherwise. It is available only if the client was created with `track_members=True`.
+        After the first time only the changes since the last settle are fetched from the server.
+        """
+        if self.get_ring() is None:
+            return None
+        return sorted(self._members)
+
+    def get_ring(self):
+        """
+        Return :obj:`bloc.partition.HashRing` of all the members if settled, None otherwise.
+        It is available only if the client was created with `track_members=True`. Use it to
+        find items owned by this client with ``ring.owned_by(client.session_id, items)``.
+        Unlike partitioning with index and total only about 1/N items change owners when
+        members change.
+        """
+        if self.get_index_total() is None or self._ring_generation != self._generation:
+            return None
+        return self._ring
 
     def _url(self, segment):
+        if self._group is not None:
+            segment = 'groups/{}/{}'.format(self._group, segment)
         return 'http://{}/{}'.format(self._server, segment)
 
-    def _get_index(self):
-        d = self.treq.get(self._url("index"), headers={'Bloc-Session-ID': [self._session_id]})
+    def _get_index(self, params=None):
+        headers = {'Bloc-Session-ID': [self._session_id]}
+        if self._weight is not None:
+            headers['Bloc-Weight'] = [str(self._weight)]
+        d = self.treq.get(self._url("index"), headers=headers, params=params)
         d.addCallback(check_status, [200])
         return d.addCallback(treq.json_content)
 
-    def _error_allocating(self, f):
-        self._settled = False
-        self.log.error("Error getting index: {f}", f=f)
+    def _delete_session(self):
+        return self.treq.delete(self._url("session"),
+                                headers={'Bloc-Session-ID': [self._session_id]})
 
     def _heartbeat(self):
         d = self._get_index()
-        d.addCallback(self._set_index)
+        d.addCallback(self._set_index, self.clock.seconds())
         d.addTimeout(self._interval, self.clock)
         d.addErrback(self._error_allocating)
         return d
 
+    def _schedule(self, delay, call):
+        """
+        Schedule `call` after `delay` seconds if the service is still running
+        """
+        self._polling = None
+        if self.running:
+            self._next_poll = self.clock.callLater(delay, call)
+
+    def _failed(self, f):
+        if not self.running:
+            return
+        self._error_allocating(f)
+        return self._interval
+
+    def _poll(self):
+        """
+        Long poll the server for index change since last known generation. Poll again
+        immediately after getting response or after `interval` seconds if it errors.
+        """
+        self._next_poll = None
+        # Server holds the request for at most `interval` seconds
+        d = self._get_index({'wait': str(self._generation), 'timeout': str(self._interval)})
+        self._polling = d
+        d.addCallback(self._set_index, self.clock.seconds())
+        d.addTimeout(self._interval * 2, self.clock)
+        d.addCallbacks(lambda _: 0, self._failed)
+        d.addCallback(self._schedule, self._poll)
+
+    def _scheduled_heartbeat(self):
+        """
+        Heartbeat and schedule the next heartbeat after the delay returned by `_next_delay`.
+        Used instead of the fixed `interval` loop when heartbeating adaptively or with jitter.
+        """
+        self._next_poll = None
+        d = self._get_index()
+        self._polling = d
+        d.addCallback(self._set_index, self.clock.seconds())
+        d.addTimeout(self._interval, self.clock)
+        d.addCallbacks(lambda _: self._next_delay(), self._failed)
+        d.addCallback(self._schedule, self._scheduled_heartbeat)
+
+    def _next_delay(self):
+        """
+        Return seconds to next heartbeat. It is the delay suggested by the server when adaptive
+        or `interval` otherwise, made randomly up to `jitter` fraction shorter so that clients
+        that heartbeated together do not heartbeat together again.
+        """
+        delay = self._hint if self._adaptive and self._hint is not None else self._interval
+        return delay * (1 - self._jitter * self._random())
+
+    def _stop_heartbeating(self):
+        if self._loop.running:
+            self._loop.stop()
+            return
+        if self._next_poll is not None:
+            self._next_poll.cancel()
+            self._next_poll = None
+        if self._polling is not None:
+            self._polling.cancel()
+
     def stopService(self):
         """
         Delete session and stop heartbeating
@@ -85,18 +543,189 @@ class BlocClient(Service):
         # Delete session before shutdown but do not worry about response if it not received
         # within 1 second because we don't want to block shutdown of twisted app and server will
         # anyway cancel the session without next heartbeat
-        d = self.treq.delete(self._url("session"), headers={'Bloc-Session-ID': [self._session_id]})
+        self._cancel_lease_timer()
+        if self._getting_members is not None:
+            self._getting_members.cancel()
+        d = self._delete_session()
         d.addTimeout(1, self.clock)
-        return d.addBoth(lambda r: self._loop.stop())
+        return d.addBoth(lambda r: self._stop_heartbeating())
 
-    def get_index_total(self):
+
+class LineBlocClient(BlocClient):
+    """
+    Client that talks to bloc server over its line protocol on a persistent TCP connection
+    instead of HTTP. The connection is made on first heartbeat and made again on next heartbeat
+    if it is lost. Server removes the session as soon as the connection is lost. Hence a
+    heartbeat not responded within interval fails like over HTTP but the connection is aborted
+    only if the response has not arrived after `LINE_ABORT_INTERVALS` intervals.
+    """
+
+    def __init__(self, clock, server, interval, session_id=None, endpoint=None):
         """
-        Return (index, total) tuple if settled, None if settling. Here "index" is position of this
-        node in the group and "total" is number of nodes in the group. For example, if there are
-        two BlocClient instances talking to the server then one of them will get (1, 2) and other
-        will get (2, 2). Note that this returns internal state last updated every "interval"
-        seconds.
+        Create a LineBlocClient instance
+
+        :param clock: An implementation of :obj:`IReactorTime`. Typically will be main twisted
+            reactor.
+        :param str server: server's line protocol connection info in "server:port" form
+        :param float interval: Frequency of heartbeat in seconds
+        :param endpoint: :obj:`IStreamClientEndpoint` to connect to. Defaults to TCP endpoint
+            of `server` created using `clock` as reactor
         """
-        if not self._settled:
-            return None
-        return (self._index, self._total)
+        super(LineBlocClient, self).__init__(clock, server, interval, session_id=session_id)
+        if endpoint is None:  # pragma: no cover
+            endpoint = clientFromString(clock, 'tcp:{}'.format(server))
+        self._endpoint = endpoint
+        self._protocol = None
+        self._connecting = []
+
+    def _connection(self):
+        """
+        Return Deferred that fires with connected :obj:`BlocLineClientProtocol`
+        """
+        if self._protocol is not None:
+            return succeed(self._protocol)
+        d = Deferred()
+        self._connecting.append(d)
+        if len(self._connecting) == 1:
+            proto = BlocLineClientProtocol(self._disconnected, self.clock,
+                                           self._interval * LINE_ABORT_INTERVALS)
+            connectProtocol(self._endpoint, proto).addBoth(self._connected)
+        return d
+
+    def _connected(self, result):
+        connecting, self._connecting = self._connecting, []
+        if isinstance(result, BlocLineClientProtocol):
+            self._protocol = result
+            for d in connecting:
+                d.callback(result)
+        else:
+            for d in connecting:
+                d.errback(result)
+
+    def _disconnected(self):
+        self._protocol = None
+
+    def _request(self, command):
+        return self._connection().addCallback(
+            lambda proto: proto.request(command, self._session_id))
+
+    def _get_index(self, params=None):
+        return self._request(b'INDEX')
+
+    def _delete_session(self):
+        return self._request(b'DELETE')
+
+    def _stop_heartbeating(self):
+        super(LineBlocClient, self)._stop_heartbeating()
+        if self._protocol is not None:
+            self._protocol.transport.loseConnection()
+
+
+class MultiplexedClient(_Session):
+    """
+    Session heartbeated by :obj:`BlocMultiplexer` along with its other sessions. Create it
+    with :func:`BlocMultiplexer.client`.
+    """
+
+    def __init__(self, multiplexer, session_id):
+        _Session.__init__(self, multiplexer.clock, session_id)
+        self._multiplexer = multiplexer
+
+    def remove(self):
+        """
+        Stop heartbeating this session and delete it on the server.
+
+        :return: Deferred that fires when session is deleted or after 1 second
+        """
+        return self._multiplexer._remove(self)
+
+
+class BlocMultiplexer(Service):
+    """
+    Heartbeats many sessions to bloc server using a single request per interval. Useful when
+    a process has many logical workers each of which needs its own index.
+    """
+
+    def __init__(self, clock, server, interval, treq=treq, pool=None):
+        """
+        Create a BlocMultiplexer instance
+
+        :param clock: An implementation of :obj:`IReactorTime`. Typically will be main twisted
+            reactor.
+        :param str server: server connection info in "server:port" form
+        :param float interval: Frequency of heartbeat in seconds
+        :param pool: :obj:`HTTPConnectionPool` to make requests with. See :obj:`BlocClient`
+        """
+        if pool is not None:
+            treq = HTTPClient(Agent(clock, pool=pool))
+        self.clock = clock
+        self._server = server
+        self._interval = interval
+        self._clients = OrderedDict()
+        self._loop = task.LoopingCall(self._heartbeat)
+        self._loop.clock = self.clock
+        self.log = Logger()
+        self.treq = treq
+
+    def client(self, session_id=None):
+        """
+        Return new :obj:`MultiplexedClient` that will be heartbeated from next interval
+        """
+        client = MultiplexedClient(self, session_id)
+        self._clients[client._session_id] = client
+        return client
+
+    def _url(self, segment):
+        return 'http://{}/{}'.format(self._server, segment)
+
+    def _delete_session(self, client):
+        d = self.treq.delete(self._url("session"),
+                             headers={'Bloc-Session-ID': [client._session_id]})
+        # Like BlocClient, do not wait for more than a second as server will anyway remove the
+        # session after it stops heartbeating
+        d.addTimeout(1, self.clock)
+        return d.addBoth(lambda _: None)
+
+    def _remove(self, client):
+        del self._clients[client._session_id]
+        client._set_unsettled()
+        return self._delete_session(client)
+
+    def _set_indexes(self, contents, sent):
+        for session_id, content in contents.items():
+            client = self._clients.get(session_id)
+            if client is not None:
+                client._set_index(content, sent)
+
+    def _error_allocating(self, f):
+        for client in self._clients.values():
+            client._heartbeat_failed()
+        self.log.error("Error getting indexes: {f}", f=f)
+
+    def _heartbeat(self):
+        if not self._clients:
+            return
+        d = self.treq.post(self._url("heartbeats"),
+                           json.dumps(list(self._clients)).encode("utf-8"),
+                           headers={'Content-Type': ['application/json']})
+        d.addCallback(check_status, [200])
+        d.addCallback(treq.json_content)
+        d.addCallback(self._set_indexes, self.clock.seconds())
+        d.addTimeout(self._interval, self.clock)
+        d.addErrback(self._error_allocating)
+        return d
+
+    def startService(self):
+        """
+        Start heartbeating all the sessions
+        """
+        super(BlocMultiplexer, self).startService()
+        self._loop.start(self._interval, True)
+
+    def stopService(self):
+        """
+        Delete all sessions and stop heartbeating
+        """
+        super(BlocMultiplexer, self).stopService()
+        d = gatherResults([self._delete_session(client) for client in self._clients.values()])
+        return d.addBoth(lambda _: self._loop.stop())
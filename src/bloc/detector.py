@@ -0,0 +1,138 @@
+"""
+Phi accrual failure detector (Hayashibara et al.) that adapts the time after which a client is
+considered failed to how regularly its heartbeats have been arriving. For each client it keeps
+the last `window` intervals between heartbeats and from their mean and standard deviation
+computes "phi", the suspicion that the client has failed given the time since its last
+heartbeat. Phi of 1 means about 10% chance of wrongly suspecting it, 2 means 1%, 3 means 0.1%
+and so on.
+
+Since phi only grows with time since the last heartbeat, the time at which it crosses the
+threshold is computed once per heartbeat and :obj:`bloc.server.HeartbeatingClients` uses it
+as the client's deadline, just like a fixed timeout. Checks hence still only look at clients
+that are due.
+"""
+
+import math
+from array import array
+
+
+# Coefficients of the logistic approximation of normal distribution's CDF used by Akka
+_A = 0.070566
+_B = 1.5976
+
+
+def _cbrt(x):
+    return math.copysign(abs(x) ** (1.0 / 3), x)
+
+
+def deviations(threshold):
+    """
+    Return number of standard deviations beyond the mean interval at which phi reaches
+    `threshold`. It is the real root of ``A * y ** 3 + B * y = ln(10 ** threshold - 1)``.
+    """
+    c = math.log(10 ** threshold - 1)
+    p, q = _B / _A, -c / _A
+    d = math.sqrt(q * q / 4 + p ** 3 / 27)
+    return _cbrt(-q / 2 + d) + _cbrt(-q / 2 - d)
+
+
+def phi(elapsed, mean, std):
+    """
+    Return phi for `elapsed` seconds since last heartbeat given mean and standard deviation of
+    intervals between heartbeats
+    """
+    y = (elapsed - mean) / std
+    e = math.exp(min(-y * (_B + _A * y * y), 700))
+    if elapsed > mean:
+        return -math.log10(e / (1 + e))
+    return -math.log10(1 - 1 / (1 + e))
+
+
+class _Arrivals(object):
+    """
+    Ring buffer of last intervals between a client's heartbeats along with their running sum
+    and sum of squares
+    """
+    __slots__ = ('last', 'intervals', 'pos', 'count', 'sum', 'squares')
+
+    def __init__(self, now, window):
+        self.last = now
+        self.intervals = array('d', [0.0]) * window
+        self.pos = 0
+        self.count = 0
+        self.sum = 0.0
+        self.squares = 0.0
+
+    def add(self, now):
+        interval = now - self.last
+        self.last = now
+        old = self.intervals[self.pos]
+        self.intervals[self.pos] = interval
+        self.pos = (self.pos + 1) % len(self.intervals)
+        if self.count < len(self.intervals):
+            self.count += 1
+        self.sum += interval - old
+        self.squares += interval * interval - old * old
+
+    def stats(self):
+        """
+        Return mean and standard deviation of the intervals
+        """
+        mean = self.sum / self.count
+        return mean, math.sqrt(max(self.squares / self.count - mean * mean, 0))
+
+
+class PhiAccrualDetector(object):
+    """
+    Phi accrual failure detector of many clients. See module docstring.
+
+    :param float threshold: Phi at which a client is considered failed
+    :param int window: Number of last intervals between heartbeats kept per client
+    :param float min_std: Minimum standard deviation of intervals in seconds so that very
+        regular heartbeats do not make the detector suspect a client on the slightest delay
+    :param int min_samples: Number of intervals needed before phi is computed
+    """
+
+    def __init__(self, threshold=8, window=100, min_std=0.1, min_samples=3):
+        self.threshold = threshold
+        self.window = window
+        self.min_std = min_std
+        self.min_samples = min_samples
+        self._deviations = deviations(threshold)
+        self._clients = {}
+
+    def heartbeat(self, client, now):
+        """
+        Record heartbeat of the client at `now` seconds
+
+        :return: Seconds after `now` at which phi of the client reaches the threshold if it
+            does not heartbeat again. None if there are not enough intervals yet.
+        """
+        arrivals = self._clients.get(client)
+        if arrivals is None:
+            self._clients[client] = _Arrivals(now, self.window)
+            return None
+        arrivals.add(now)
+        if arrivals.count < self.min_samples:
+            return None
+        mean, std = arrivals.stats()
+        return mean + self._deviations * max(std, self.min_std)
+
+    def phi(self, client, now):
+        """
+        Return phi of the client at `now` seconds. None if there are not enough intervals.
+        """
+        arrivals = self._clients.get(client)
+        if arrivals is None or arrivals.count < self.min_samples:
+            return None
+        mean, std = arrivals.stats()
+        return phi(now - arrivals.last, mean, max(std, self.min_std))
+
+    def remove(self, client):
+        """
+        Forget the client
+        """
+        self._clients.pop(client, None)
+
+    def __len__(self):
+        return len(self._clients)
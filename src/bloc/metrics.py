@@ -0,0 +1,76 @@
+"""
+Minimal Prometheus text format rendering of server metrics. Counters and gauges are plain
+numbers kept by the objects being measured so that updating them on the heartbeat path costs
+no more than an integer increment.
+"""
+
+from bisect import bisect_left
+
+import attr
+
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+
+@attr.s
+class Histogram(object):
+    """
+    Histogram of observed values with fixed bucket upper bounds
+
+    :param tuple buckets: Sorted upper bounds of buckets. +Inf bucket is implicit.
+    """
+    buckets = attr.ib(default=DEFAULT_BUCKETS)
+    _counts = attr.ib(default=None)
+    sum = attr.ib(default=0.0)
+    count = attr.ib(default=0)
+
+    def __attrs_post_init__(self):
+        self._counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value, times=1):
+        """
+        Record a value `times` times
+        """
+        self._counts[bisect_left(self.buckets, value)] += times
+        self.sum += value * times
+        self.count += times
+
+    def samples(self, labels=None):
+        """
+        Return list of (suffix, labels, value) samples of this histogram
+        """
+        labels = labels or {}
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append(("_bucket", dict(labels, le=le), cumulative))
+        samples.append(("_sum", labels, self.sum))
+        samples.append(("_count", labels, self.count))
+        return samples
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in sorted(labels.items())) + "}"
+
+
+def render(families):
+    """
+    Return metrics in Prometheus text exposition format as bytes
+
+    :param families: iterable of (name, type, help, samples) tuples where samples is list of
+        (suffix, labels, value) tuples. A :obj:`Histogram`'s samples can be got from its
+        `samples` method.
+    """
+    lines = []
+    for name, _type, _help, samples in families:
+        lines.append("# HELP {} {}".format(name, _help))
+        lines.append("# TYPE {} {}".format(name, _type))
+        for suffix, labels, value in samples:
+            lines.append("{}{}{} {}".format(name, suffix, _format_labels(labels), repr(value)))
+    return ("\n".join(lines) + "\n").encode("utf-8")
@@ -0,0 +1,107 @@
+"""
+Helpers to partition work among the members of a settled group
+"""
+
+from bisect import bisect_right
+from hashlib import md5
+from struct import unpack_from
+
+
+def key_hash(key):
+    """
+    Return stable 64 bit integer hash of given string or bytes key. Unlike ``hash`` this is same
+    across processes and python versions.
+    """
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    return unpack_from(">Q", md5(key).digest())[0]
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of members. Each member is placed at `replicas` points on the ring and a
+    key is owned by the member at the first point after the key's hash. When a member joins or
+    leaves only about 1/N of the keys change owners unlike ``hash(key) % total``.
+
+    :param members: Iterable of member ids. Typically session ids of :obj:`BlocClient`
+    :param int replicas: Number of points per member. More points spread the keys more evenly
+        at the cost of time to build the ring.
+    :param dict weights: Member to its integer weight. A member gets `replicas` points per unit
+        of weight and hence owns keys in proportion to its weight. Members not in it have
+        weight 1.
+    """
+
+    def __init__(self, members, replicas=40, weights=None):
+        weights = weights or {}
+        points = sorted(
+            (key_hash(u"{}-{}".format(member, i)), member)
+            for member in members for i in range(replicas * weights.get(member, 1)))
+        self._hashes = [h for h, _ in points]
+        self._owners = [m for _, m in points]
+
+    def owner(self, key):
+        """
+        Return member owning the key. None if the ring is empty
+        """
+        if not self._hashes:
+            return None
+        return self._owners[bisect_right(self._hashes, key_hash(key)) % len(self._hashes)]
+
+    def owners(self, keys):
+        """
+        Return list of members owning each of the keys in the same order
+        """
+        if not self._hashes:
+            return [None] * len(keys)
+        hashes, owners, n = self._hashes, self._owners, len(self._hashes)
+        return [owners[bisect_right(hashes, key_hash(key)) % n] for key in keys]
+
+    def owned_by(self, member, keys):
+        """
+        Return list of keys owned by given member
+        """
+        return [key for key, owner in zip(keys, self.owners(keys)) if owner == member]
+
+
+def assign_buckets(buckets, members, previous=None, weights=None):
+    """
+    Spread `buckets` fixed buckets numbered from 0 evenly among members while keeping as many
+    buckets as possible with their previous owners. Only buckets of members that left and
+    buckets above the new fair share of existing members move.
+
+    :param int buckets: Number of buckets
+    :param members: Iterable of members
+    :param dict previous: Previous assignment of member to list of buckets
+    :param dict weights: Member to its weight. If given, members get buckets in proportion to
+        their weights instead of evenly. Members not in it have weight 1.
+    :return: dict of member to sorted list of buckets
+    """
+    members = sorted(members)
+    if not members:
+        return {}
+    previous = previous or {}
+    weights = weights or {}
+    total = sum(weights.get(m, 1) for m in members)
+    # Everyone gets the whole part of their share. Members with the largest fractional part
+    # and then the members that had most buckets get the remaining ones so that fewer buckets
+    # move.
+    shares = dict((m, divmod(buckets * weights.get(m, 1), total)) for m in members)
+    extra = buckets - sum(whole for whole, _ in shares.values())
+    ranked = sorted(members, key=lambda m: (-shares[m][1], -len(previous.get(m, ())), m))
+    quota = dict((m, shares[m][0] + (1 if i < extra else 0)) for i, m in enumerate(ranked))
+    assignment = dict((m, []) for m in members)
+    kept = set()
+    for member in ranked:
+        for bucket in sorted(previous.get(member, ())):
+            if len(assignment[member]) == quota[member]:
+                break
+            if bucket < buckets and bucket not in kept:
+                assignment[member].append(bucket)
+                kept.add(bucket)
+    free = [b for b in range(buckets) if b not in kept]
+    for member in members:
+        need = quota[member] - len(assignment[member])
+        assignment[member].extend(free[:need])
+        del free[:need]
+        assignment[member].sort()
+    return assignment
@@ -0,0 +1,121 @@
+"""
+Newline delimited protocol to talk to bloc server over a persistent TCP connection. It is a
+cheaper alternative to HTTP where each heartbeat is a single short line.
+
+Client sends one of following commands per line:
+
+* ``INDEX <session-id>``: Heartbeat and get the index. Response is same JSON as ``GET /index``
+* ``DELETE <session-id>``: Remove the session. Response is ``{}``
+
+If the server is a passive standby then every command gets ``{"error": "passive standby"}``.
+
+Responses are sent one per line in the same order as the commands. All sessions that were
+heartbeated over a connection are removed from the group when the connection is lost.
+"""
+
+import json
+from collections import deque
+
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Factory
+from twisted.logger import Logger
+from twisted.protocols.basic import LineReceiver
+
+from bloc.server import PASSIVE_RESPONSE
+
+
+UNKNOWN_COMMAND = b'{"error": "unknown command"}'
+
+
+class BlocLineProtocol(LineReceiver):
+    """
+    Server side of the line protocol. Expects `factory` to have `bloc` attribute which is
+    :obj:`bloc.server.Bloc` instance
+    """
+    delimiter = b'\n'
+    log = Logger()
+
+    def connectionMade(self):
+        self._sessions = set()
+
+    def lineReceived(self, line):
+        command, _, client = line.rstrip(b'\r').partition(b' ')
+        client = client.decode("utf-8")
+        if not self.factory.bloc.active:
+            self.sendLine(PASSIVE_RESPONSE)
+        elif command == b'INDEX' and client:
+            self._sessions.add(client)
+            self.sendLine(self.factory.bloc.heartbeat(client))
+        elif command == b'DELETE' and client:
+            self._sessions.discard(client)
+            self.factory.bloc.cancel(client)
+            self.sendLine(b'{}')
+        else:
+            self.sendLine(UNKNOWN_COMMAND)
+
+    def connectionLost(self, reason):
+        if self._sessions:
+            self.log.info('Connection lost. Removing sessions {s}', s=self._sessions)
+        for client in self._sessions:
+            self.factory.bloc.cancel(client)
+
+
+class BlocLineFactory(Factory):
+    """
+    Factory of :obj:`BlocLineProtocol` serving given :obj:`bloc.server.Bloc`
+    """
+    protocol = BlocLineProtocol
+
+    def __init__(self, bloc):
+        self.bloc = bloc
+
+
+class BlocLineClientProtocol(LineReceiver):
+    """
+    Client side of the line protocol
+
+    :param callable disconnected: Called with no arguments when connection is lost
+    :param clock: :obj:`IReactorTime` used to abort the connection when a response is overdue
+    :param float abort_after: If given, the connection is aborted when a response has not
+        arrived within these many seconds. Since the server removes all sessions of a lost
+        connection it should be much longer than the time after which requests are cancelled.
+    """
+    delimiter = b'\n'
+
+    def __init__(self, disconnected, clock=None, abort_after=None):
+        self._disconnected = disconnected
+        self._clock = clock
+        self._abort_after = abort_after
+        # Deferreds waiting for responses in order and their timers aborting the connection
+        self._pending = deque()
+
+    def request(self, command, client):
+        """
+        Send command for the client and return Deferred that fires with decoded JSON response.
+        Cancelling the Deferred only discards the response when it arrives so that a slow
+        response does not lose the connection and with it the sessions on the server.
+        """
+        d = Deferred()
+        timer = None
+        if self._abort_after is not None:
+            timer = self._clock.callLater(self._abort_after, self.transport.abortConnection)
+        self._pending.append((d, timer))
+        self.sendLine(command + b' ' + client.encode("utf-8"))
+        return d
+
+    def lineReceived(self, line):
+        if self._pending:
+            d, timer = self._pending.popleft()
+            if timer is not None:
+                timer.cancel()
+            if not d.called:
+                d.callback(json.loads(line.decode("utf-8")))
+
+    def connectionLost(self, reason):
+        pending, self._pending = self._pending, deque()
+        for d, timer in pending:
+            if timer is not None and timer.active():
+                timer.cancel()
+            if not d.called:
+                d.errback(reason)
+        self._disconnected()
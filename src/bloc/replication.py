@@ -0,0 +1,192 @@
+"""
+Warm standby of bloc server. The primary server listens for standbys and sends them the state of
+all its groups as a JSON line (see :func:`bloc.server.Bloc.snapshot`) when they connect and
+every time a group settles or starts settling after that. A standby does not serve clients until
+it loses the primary for `takeover` seconds after which it restores the last state it got and
+starts serving. Settled groups remain settled with the same indexes, so clients that fail over
+to it do not see any change.
+
+The standby cannot tell a primary that is down from one it cannot reach, so on taking over it
+starts a new term (see :func:`bloc.server.Bloc.start_term`) whose generations never clash with
+the primary's. A primary that comes back must still be stopped since members heartbeating to it
+form groups separate from the standby's.
+"""
+
+import json
+
+from twisted.application.service import Service
+from twisted.internet.defer import CancelledError
+from twisted.internet.protocol import Factory
+from twisted.logger import Logger
+from twisted.protocols.basic import LineReceiver
+
+
+class _PrimaryProtocol(LineReceiver):
+    """
+    Connection from a standby on the primary server
+    """
+    delimiter = b'\n'
+
+    def connectionMade(self):
+        # Sends the latest state, including changes that are not published as they happen like
+        # members joining a group that is already settling
+        self.factory.publish()
+        self.factory.standbys.add(self)
+        if self.factory.last is not None:
+            self.sendLine(self.factory.last)
+
+    def connectionLost(self, reason):
+        self.factory.standbys.discard(self)
+
+    def lineReceived(self, line):
+        """
+        Standbys do not send anything
+        """
+
+
+class ReplicationFactory(Factory):
+    """
+    Factory of standby connections on the primary server. It sends the state to the standbys
+    every time any group settles or starts settling while it is started, i.e. while listening.
+
+    :param bloc: :obj:`bloc.server.Bloc` whose state is sent
+    """
+    protocol = _PrimaryProtocol
+    log = Logger()
+
+    def __init__(self, bloc):
+        self.bloc = bloc
+        self.standbys = set()
+        # Last encoded state
+        self.last = None
+        self._waiting = None
+
+    def startFactory(self):
+        self._wait()
+
+    def stopFactory(self):
+        self._waiting.cancel()
+
+    def _wait(self):
+        self._waiting = self.bloc.wait_for_any_change()
+        self._waiting.addCallbacks(lambda _: (self.publish(), self._wait()), lambda f: None)
+
+    def publish(self):
+        """
+        Send state to all standbys if it has changed since it was last sent
+        """
+        if not self.bloc.active:
+            return
+        line = json.dumps(self.bloc.snapshot(), sort_keys=True).encode("utf-8")
+        if line == self.last:
+            return
+        self.last = line
+        for standby in self.standbys:
+            standby.sendLine(line)
+
+
+class _StandbyProtocol(LineReceiver):
+    """
+    Connection to the primary on a standby server
+    """
+    delimiter = b'\n'
+    # State of a large group does not fit in LineReceiver's default
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, standby):
+        self._standby = standby
+
+    def lineReceived(self, line):
+        self._standby._received(json.loads(line.decode("utf-8")))
+
+    def connectionLost(self, reason):
+        self._standby._disconnected()
+
+
+class Standby(Service):
+    """
+    Keeps the given server as a passive standby of the primary reachable at `endpoint` and
+    makes it active in a new term when the primary cannot be reached for `takeover` seconds.
+    Once active it does not become passive again, so the primary must not serve after that.
+
+    :param bloc: :obj:`bloc.server.Bloc` that is made passive
+    :param clock: :obj:`IReactorTime` provider
+    :param endpoint: :obj:`IStreamClientEndpoint` of the primary's replication listener
+    :param float takeover: Seconds for which the primary must be unreachable before taking over
+    :param float retry: Seconds between attempts to connect to the primary
+    """
+    log = Logger()
+
+    def __init__(self, bloc, clock, endpoint, takeover=3, retry=1):
+        self.bloc = bloc
+        bloc.active = False
+        self.clock = clock
+        self._endpoint = endpoint
+        self._takeover = takeover
+        self._retry = retry
+        self._state = None
+        self._protocol = None
+        self._connecting = None
+        self._next_connect = None
+        self._takeover_call = None
+
+    def startService(self):
+        Service.startService(self)
+        self._schedule_takeover()
+        self._connect()
+
+    def stopService(self):
+        Service.stopService(self)
+        for call in (self._next_connect, self._takeover_call):
+            if call is not None and call.active():
+                call.cancel()
+        if self._connecting is not None:
+            self._connecting.cancel()
+        if self._protocol is not None:
+            self._protocol.transport.loseConnection()
+
+    def _schedule_takeover(self):
+        if self._takeover_call is None or not self._takeover_call.active():
+            self._takeover_call = self.clock.callLater(self._takeover, self._take_over)
+
+    def _connect(self):
+        self._next_connect = None
+        d = self._connecting = self._endpoint.connect(Factory.forProtocol(
+            lambda: _StandbyProtocol(self)))
+        d.addCallbacks(self._connected, self._connect_failed)
+
+    def _connected(self, protocol):
+        self._connecting = None
+        self._protocol = protocol
+        if self._takeover_call.active():
+            self._takeover_call.cancel()
+        self.log.info('Connected to primary')
+
+    def _connect_failed(self, f):
+        self._connecting = None
+        if f.check(CancelledError) or not self.running:
+            return
+        self.log.info('Could not connect to primary: {e}', e=f.value)
+        self._next_connect = self.clock.callLater(self._retry, self._connect)
+
+    def _received(self, state):
+        self._state = state
+
+    def _disconnected(self):
+        self._protocol = None
+        if not self.running or self.bloc.active:
+            return
+        self.log.info('Lost connection to primary')
+        self._schedule_takeover()
+        self._next_connect = self.clock.callLater(self._retry, self._connect)
+
+    def _take_over(self):
+        if self._next_connect is not None and self._next_connect.active():
+            self._next_connect.cancel()
+        if self._connecting is not None:
+            self._connecting.cancel()
+        if self._state is not None:
+            self.bloc.restore(self._state)
+        self.bloc.start_term()
+        self.bloc.active = True
+        self.log.warn('Took over from primary')
@@ -1,4 +1,10 @@
+import heapq
 import json
+import math
+from collections import deque
+from functools import wraps
+
+from timeit import default_timer
 
 import attr
 
@@ -6,8 +12,13 @@ from klein import Klein
 
 from twisted.application.service import MultiService
 from twisted.application.internet import TimerService
+from twisted.internet.defer import Deferred, TimeoutError
 from twisted.internet.interfaces import IReactorTime
 from twisted.logger import Logger
+from twisted.web.resource import Resource
+
+from bloc.metrics import Histogram, render
+from bloc.partition import assign_buckets
 
 
 class NotSettled(Exception):
@@ -21,35 +32,169 @@ class SettlingGroup(object):
     """
     A group that "settles" down when there is no activity for `settle` seconds.
 
+    A single timer is kept while settling. Activity only pushes the settle deadline forward
+    and the timer checks the deadline when it fires, rescheduling itself if the deadline has
+    moved.
+
     :param clock: A twisted time provider that implements :obj:`IReactorTime`
     :param float settle: Number of seconds to wait before settling
+    :param bool sticky: Should members keep their previous index when settling? If False, all
+        members are numbered afresh in arbitrary order
+    :param float max_settle: If given, the group settles at most these many seconds after it
+        started settling even if there is activity all this while. It is effectively `settle`
+        if smaller than that.
+
+    Members can have an integer weight, 1 by default. Changing a member's weight is activity
+    like adding or removing a member.
     """
     clock = attr.ib(validator=attr.validators.provides(IReactorTime))
     settle = attr.ib(convert=float)
+    sticky = attr.ib(default=False)
+    max_settle = attr.ib(default=None)
     _members = attr.ib(default=attr.Factory(dict))
+    # Weights of members whose weight is not 1
+    _weights = attr.ib(default=attr.Factory(dict))
     _settled = attr.ib(default=False)
     _timer = attr.ib(default=None)
+    _deadline = attr.ib(default=None)
+    _generation = attr.ib(default=0)
+    # Generation after which the next settle's generation is. See start_term
+    _term_start = attr.ib(default=0)
+    _waiters = attr.ib(default=attr.Factory(set))
+    # Metrics
+    resets = attr.ib(default=0)
+    _settling_since = attr.ib(default=None)
+    _settling_seconds = attr.ib(default=0.0)
     _log = Logger()
 
     def _reset_timer(self):
-        if self._timer is not None and self._timer.active():
-            self._timer.cancel()
-        self._timer = self.clock.callLater(self.settle, self._do_settling)
-        self._settled = False
-        self._log.info('reset timer')
+        now = self.clock.seconds()
+        self._deadline = now + self.settle
+        if self._timer is None or not self._timer.active():
+            self._timer = self.clock.callLater(self.settle, self._check_deadline)
+        was_settled, self._settled = self._settled, False
+        self.resets += 1
+        if self._settling_since is None:
+            self._settling_since = now
+            self._log.info('started settling')
+        if was_settled:
+            self._notify_waiters()
+
+    def _check_deadline(self):
+        """
+        Settle if the deadline or the maximum settle time has passed. Otherwise check again
+        when the earlier of them is due.
+        """
+        due = self._deadline
+        if self.max_settle is not None:
+            due = min(due, self._settling_since + self.max_settle)
+        now = self.clock.seconds()
+        if now < due:
+            self._timer = self.clock.callLater(due - now, self._check_deadline)
+        else:
+            self._do_settling()
 
     def _do_settling(self):
-        self._members = {p: i + 1 for i, p in enumerate(self._members.keys())}
+        if self.sticky:
+            self._members = self._sticky_indexes()
+        else:
+            self._members = {p: i + 1 for i, p in enumerate(self._members.keys())}
         self._settled = True
+        self._generation = max(self._generation, self._term_start) + 1
+        self._settling_seconds += self.clock.seconds() - self._settling_since
+        self._settling_since = None
         self._log.info('settled with {n} members', n=len(self._members))
+        self._notify_waiters()
+
+    def _sticky_indexes(self):
+        """
+        Return new indexes where members keep their previous index if it is within the new
+        total. Remaining indexes are given to new members first and then to members whose
+        previous index is beyond the new total.
+        """
+        total = len(self._members)
+        indexes = {}
+        newcomers, displaced = [], []
+        for member, index in self._members.items():
+            if index is None:
+                newcomers.append(member)
+            elif index > total:
+                displaced.append(member)
+            else:
+                indexes[member] = index
+        taken = set(indexes.values())
+        free = (i for i in range(1, total + 1) if i not in taken)
+        for member, index in zip(newcomers + displaced, free):
+            indexes[member] = index
+        return indexes
+
+    def _notify_waiters(self):
+        waiters, self._waiters = self._waiters, set()
+        for d in waiters:
+            d.callback(None)
+
+    def wait_for_change(self):
+        """
+        Return Deferred that fires with None when the group next changes its state i.e. when it
+        settles or when it starts settling after being settled. Cancelling the Deferred stops
+        waiting.
+        """
+        d = Deferred(self._waiters.discard)
+        self._waiters.add(d)
+        return d
+
+    def snapshot(self):
+        """
+        Return JSON serializable state of the group that :func:`restore` can restore from
+        """
+        state = {'members': dict(self._members), 'settled': self._settled,
+                 'generation': self._generation}
+        if self._weights:
+            state['weights'] = dict(self._weights)
+        return state
+
+    def restore(self, state):
+        """
+        Replace the group's members, their indexes and generation with `state` got from
+        :func:`snapshot`. If the group was settling then it starts settling again.
+        """
+        self._members = dict(state['members'])
+        self._weights = dict(state.get('weights', {}))
+        self._generation = state['generation']
+        if state['settled']:
+            self._settled = True
+        else:
+            self._reset_timer()
+
+    def start_term(self, generation):
+        """
+        Make generation of the next settle higher than `generation`. The current generation is
+        kept so that a settled group stays as it is. See :func:`Bloc.start_term`
+        """
+        self._term_start = max(self._term_start, generation)
+
+    def stop(self):
+        """
+        Stop settling and release everyone waiting for a change. Called when the group is
+        discarded.
+        """
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._notify_waiters()
 
-    def add(self, member):
+    def add(self, member, weight=1):
         """
-        Add member to the group
+        Add member to the group with given weight or update its weight if it is already there
         """
         if member in self._members:
-            return
-        self._members[member] = None
+            if self._weights.get(member, 1) == weight:
+                return
+        else:
+            self._members[member] = None
+        if weight == 1:
+            self._weights.pop(member, None)
+        else:
+            self._weights[member] = weight
         self._reset_timer()
 
     def remove(self, member):
@@ -59,8 +204,22 @@ class SettlingGroup(object):
         :raises: ``KeyError` if member is not in the group
         """
         del self._members[member]
+        self._weights.pop(member, None)
         self._reset_timer()
 
+    def weight_of(self, member):
+        """
+        Return weight of the member
+        """
+        return self._weights.get(member, 1)
+
+    @property
+    def weighted(self):
+        """
+        Does any member have weight other than 1?
+        """
+        return bool(self._weights)
+
     def index_of(self, member):
         """
         Return index allocated for the given member if group has settled
@@ -71,6 +230,12 @@ class SettlingGroup(object):
             raise NotSettled(member)
         return self._members[member]
 
+    def members(self):
+        """
+        Return list of members in the group
+        """
+        return list(self._members)
+
     def __len__(self):
         return len(self._members)
 
@@ -84,17 +249,67 @@ class SettlingGroup(object):
         """
         return self._settled
 
+    @property
+    def generation(self):
+        """
+        Generation of the group's last settle. It increases every time the group settles and
+        indexes only change when this changes.
+        """
+        return self._generation
+
+    @property
+    def settling_seconds(self):
+        """
+        Total number of seconds this group has spent settling since its first member was added
+        """
+        if self._settling_since is None:
+            return self._settling_seconds
+        return self._settling_seconds + self.clock.seconds() - self._settling_since
+
+
+# Heartbeat arrivals are counted in windows of these many seconds
+ARRIVAL_WINDOW = 0.1
+ARRIVAL_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
 
 @attr.s
 class HeartbeatingClients(MultiService):
     """
-    Group of clients that will heartbeat to remain active
+    Group of clients that will heartbeat to remain active.
+
+    Each client's expiry deadline is kept in ``_clients``. The client is also kept in the set
+    of clients due in the `interval` long tick its deadline falls in, ``_due``, and every
+    heartbeat moves it to the set of its new tick. The ticks that have sets are kept in a
+    min-heap. A check then only looks at clients of the ticks that have started, which are
+    mostly the clients that have expired, instead of all the clients.
+
+    If a `detector` like :obj:`bloc.detector.PhiAccrualDetector` is given then a client's
+    deadline is the earlier of the time given by the detector and the timeout. Heartbeats of
+    long polls are not given to the detector since their intervals depend on when the group
+    changes rather than on the client.
     """
     clock = attr.ib(validator=attr.validators.provides(IReactorTime))
     timeout = attr.ib(convert=float)
     interval = attr.ib(convert=float)
     _remove_cb = attr.ib()
     _clients = attr.ib(default=attr.Factory(dict))
+    _walltime = attr.ib(default=default_timer)
+    detector = attr.ib(default=None)
+    # Tick to set of clients whose deadline is in it, heap of those ticks and tick of each client
+    _due = attr.ib(default=attr.Factory(dict))
+    _due_ticks = attr.ib(default=attr.Factory(list))
+    _client_ticks = attr.ib(default=attr.Factory(dict))
+    # Metrics
+    heartbeats = attr.ib(default=0)
+    added = attr.ib(default=0)
+    removed = attr.ib(default=0)
+    timeouts = attr.ib(default=0)
+    check_durations = attr.ib(default=attr.Factory(Histogram))
+    # Number of heartbeats that arrived in each ARRIVAL_WINDOW. Synchronized clients show up as
+    # many windows with no arrivals and a few with many.
+    arrivals = attr.ib(default=attr.Factory(lambda: Histogram(ARRIVAL_BUCKETS)))
+    _window = attr.ib(default=None)
+    _window_arrivals = attr.ib(default=0)
     log = Logger()
 
     def __attrs_post_init__(self):
@@ -105,29 +320,136 @@ class HeartbeatingClients(MultiService):
 
     def remove(self, client):
         del self._clients[client]
+        self._due[self._client_ticks.pop(client)].discard(client)
+        self.removed += 1
+        if self.detector is not None:
+            self.detector.remove(client)
 
     def _check_clients(self):
-        # This is O(n). May have issues when n is large. See if a heap can be used instead
+        start = self._walltime()
         now = self.clock.seconds()
-        clients_to_remove = []
-        for client, last_active in self._clients.items():
-            inactive = now - last_active
-            if inactive > self.timeout:
-                self.log.info('Client {c} timed out after {t} seconds', c=client, t=inactive)
-                clients_to_remove.append(client)
-        for client in clients_to_remove:
-            self.remove(client)
-            self._remove_cb(client)
-
-    def heartbeat(self, client):
+        self._check_due(now)
+        self.check_durations.observe(self._walltime() - start)
+
+    def _expire(self, client, now, deadline):
+        self.log.info('Client {c} timed out {t} seconds after its deadline',
+                      c=client, t=now - deadline)
+        del self._clients[client]
+        self.timeouts += 1
+        if self.detector is not None:
+            self.detector.remove(client)
+        self._remove_cb(client)
+
+    def _check_due(self, now):
+        # Clients of a tick that has started but not ended may not be due yet. They are checked
+        # again in the next check.
+        later = []
+        while self._due_ticks and (self._due_ticks[0] - 1) * self.interval < now:
+            for client in self._due.pop(heapq.heappop(self._due_ticks)):
+                del self._client_ticks[client]
+                deadline = self._clients[client]
+                if deadline < now:
+                    self._expire(client, now, deadline)
+                else:
+                    later.append(client)
+        for client in later:
+            self._schedule(client, self._clients[client])
+
+    def _schedule(self, client, deadline):
+        """
+        Move the client to the set of clients due in the tick of its deadline
+        """
+        tick = int(math.ceil(deadline / self.interval))
+        old = self._client_ticks.get(client)
+        if old == tick:
+            return
+        if old is not None:
+            self._due[old].discard(client)
+        clients = self._due.get(tick)
+        if clients is None:
+            clients = self._due[tick] = set()
+            heapq.heappush(self._due_ticks, tick)
+        clients.add(client)
+        self._client_ticks[client] = tick
+
+    def heartbeat(self, client, timeout=None, detect=True):
+        """
+        Record heartbeat of the client. It is removed if it does not heartbeat again within
+        `timeout` seconds which defaults to `self.timeout` or earlier if the detector suspects it.
+
+        :param bool detect: Should the detector learn from this heartbeat? If False, the
+            client is removed only after `timeout`.
+        """
+        now = self.clock.seconds()
+        if timeout is None:
+            timeout = self.timeout
+        if self.detector is not None and detect:
+            suspected = self.detector.heartbeat(client, now)
+            if suspected is not None and suspected < timeout:
+                timeout = suspected
+        deadline = now + timeout
+        self.heartbeats += 1
+        self._count_arrival(now)
         if client not in self._clients:
             self.log.info('Adding client {c}', c=client)
-        self._clients[client] = self.clock.seconds()
+            self.added += 1
+        self._clients[client] = deadline
+        self._schedule(client, deadline)
+
+    def _count_arrival(self, now):
+        window = int(now / ARRIVAL_WINDOW)
+        if window != self._window:
+            if self._window is not None:
+                self.arrivals.observe(self._window_arrivals)
+                # Windows without arrivals. Only the ones within a timeout are counted since
+                # there are no clients after that.
+                empty = min(window - self._window - 1, int(self.timeout / ARRIVAL_WINDOW))
+                if empty > 0:
+                    self.arrivals.observe(0, empty)
+            self._window = window
+            self._window_arrivals = 0
+        self._window_arrivals += 1
 
     def __contains__(self, client):
         return client in self._clients
 
 
+SETTLING_RESPONSE = json.dumps({'status': 'SETTLING'}).encode("utf-8")
+
+# Fractions of group's heartbeat timeout suggested as time to next heartbeat
+SETTLING_HEARTBEAT = 0.25
+SETTLED_HEARTBEAT = 0.75
+
+# Number of last generations whose membership changes are kept to answer
+# ``GET /members?since=<generation>`` with only the changes
+MEMBERS_HISTORY = 32
+
+# Largest weight a member can have. Clients tracking members build a hash ring with points in
+# proportion to the weights so it is bounded to keep that cheap.
+MAX_WEIGHT = 100
+
+# Number of generations in each term of an active server. A standby taking over starts the next
+# term so that its generations never clash with those of the primary if that is still serving.
+TERM_GENERATIONS = 2 ** 32
+
+
+PASSIVE_RESPONSE = json.dumps({'error': 'passive standby'}).encode("utf-8")
+
+
+def _when_active(handler):
+    """
+    Decorate a :obj:`Bloc` route handler to respond with 503 when the server is a passive
+    standby. Clients then try another server.
+    """
+    @wraps(handler)
+    def _handler(self, request, *args, **kwargs):
+        if not self.active:
+            request.setResponseCode(503)
+            return PASSIVE_RESPONSE
+        return handler(self, request, *args, **kwargs)
+    return _handler
+
+
 def extract_client(request):
     """
     Return session id from the request
@@ -136,14 +458,262 @@ def extract_client(request):
     return _id[0] if _id is not None else None
 
 
+def extract_weight(request):
+    """
+    Return weight of the client from the request. 1 if it is not given.
+
+    :raises: ``ValueError`` if the weight is not an integer from 1 to :obj:`MAX_WEIGHT`
+    """
+    weight = request.requestHeaders.getRawHeaders('Bloc-Weight', None)
+    if weight is None:
+        return 1
+    weight = int(weight[0])
+    if not 1 <= weight <= MAX_WEIGHT:
+        raise ValueError(weight)
+    return weight
+
+
+@attr.s
+class _Group(object):
+    """
+    A group hosted by :obj:`Bloc` along with encoded responses cached for its current generation
+
+    :param group: :obj:`SettlingGroup` of the members
+    :param float timeout: Heartbeat timeout of the members
+    :param int buckets: Number of fixed buckets to spread among the members or None
+    :param bool hints: Should index responses suggest when the member should heartbeat next?
+        See :obj:`Bloc`
+    :param bool leases: Should SETTLED responses grant a lease on the index? See :obj:`Bloc`
+    """
+    group = attr.ib()
+    timeout = attr.ib(convert=float)
+    buckets = attr.ib(default=None)
+    hints = attr.ib(default=False)
+    leases = attr.ib(default=False)
+    settling_response = attr.ib(default=SETTLING_RESPONSE)
+    # Encoded SETTLED responses of each member for settled generation `_responses_generation`
+    _responses = attr.ib(default=attr.Factory(dict))
+    _responses_generation = attr.ib(default=None)
+    # Encoded /members response and its generation
+    _members_response = attr.ib(default=(None, None))
+    _bucket_assignment = attr.ib(default=attr.Factory(dict))
+    # Member to its [start, end) range of the total weight when the group is weighted
+    _ranges = attr.ib(default=attr.Factory(dict))
+    _weight_total = attr.ib(default=0)
+    # Membership changes of last MEMBERS_HISTORY generations as (generation, changed members
+    # with their weight, removed members), the generation before the oldest of them, members
+    # with their weight at the latest one and encoded changes since each of the generations
+    _history = attr.ib(default=attr.Factory(lambda: deque(maxlen=MEMBERS_HISTORY)))
+    _history_base = attr.ib(default=None)
+    _history_members = attr.ib(default=None)
+    _delta_responses = attr.ib(default=attr.Factory(dict))
+
+    def __attrs_post_init__(self):
+        if self.hints:
+            self.settling_response = json.dumps(
+                {'status': 'SETTLING', 'heartbeat': self.settling_heartbeat}).encode("utf-8")
+
+    @property
+    def settling_heartbeat(self):
+        """
+        Seconds after which members should heartbeat while the group is settling. Frequent
+        heartbeats let members know quickly when the group settles.
+        """
+        return self.timeout * SETTLING_HEARTBEAT
+
+    @property
+    def settled_heartbeat(self):
+        """
+        Seconds after which members should heartbeat while the group is settled. It is well
+        within the timeout and the settle time so that members neither time out nor miss the
+        group settling again with different indexes.
+        """
+        return min(self.timeout, self.group.settle) * SETTLED_HEARTBEAT
+
+    def settled_response(self, client):
+        """
+        Return encoded SETTLED response of the client. It is encoded once per client after
+        every settle and returned from cache after that.
+        """
+        generation = self.group.generation
+        if generation != self._responses_generation:
+            self._new_generation()
+        response = self._responses.get(client)
+        if response is None:
+            content = {'status': 'SETTLED',
+                       'index': self.group.index_of(client),
+                       'total': len(self.group),
+                       'generation': generation}
+            if self.buckets is not None:
+                content['buckets'] = self._bucket_assignment[client]
+            if self._ranges:
+                content['weight'] = self.group.weight_of(client)
+                content['range'] = self._ranges[client]
+                content['weight_total'] = self._weight_total
+            if self.hints:
+                content['heartbeat'] = self.settled_heartbeat
+            if self.leases:
+                # No other member can get this index before the group settles again which is
+                # at least `settle` seconds after this response
+                content['lease'] = self.group.settle
+            response = self._responses[client] = json.dumps(content).encode("utf-8")
+        return response
+
+    def _new_generation(self):
+        """
+        Called on first response after the group has settled with a new generation
+        """
+        self._responses = {}
+        self._responses_generation = self.group.generation
+        weights = self._weights()
+        if self.buckets is not None:
+            self._bucket_assignment = assign_buckets(
+                self.buckets, self.group.members(), self._bucket_assignment, weights)
+        self._ranges = {}
+        self._weight_total = 0
+        if weights is not None:
+            # Members own consecutive ranges of the total weight in the order of their index
+            for member in sorted(weights, key=self.group.index_of):
+                start = self._weight_total
+                self._weight_total += weights[member]
+                self._ranges[member] = [start, self._weight_total]
+        self._record_members()
+
+    def _record_members(self):
+        """
+        Record membership changes since the last generation seen
+        """
+        members = dict((member, self.group.weight_of(member)) for member in self.group.members())
+        previous = self._history_members
+        if previous is None:
+            self._history_base = self.group.generation
+        else:
+            changed = dict((m, w) for m, w in members.items() if previous.get(m) != w)
+            removed = [m for m in previous if m not in members]
+            if len(self._history) == self._history.maxlen:
+                self._history_base = self._history[0][0]
+            self._history.append((self.group.generation, changed, removed))
+        self._history_members = members
+        self._delta_responses = {}
+
+    def _weights(self):
+        """
+        Return dict of each member's weight if the group is weighted, None otherwise
+        """
+        if not self.group.weighted:
+            return None
+        return dict((member, self.group.weight_of(member)) for member in self.group.members())
+
+    def index_response(self, client):
+        if self.group.settled and client in self.group:
+            return self.settled_response(client)
+        else:
+            return self.settling_response
+
+    def changed_since(self, generation):
+        """
+        Has the group settled with generation other than given generation?
+        """
+        return self.group.settled and self.group.generation != generation
+
+    def snapshot(self):
+        """
+        Return JSON serializable state of the group including its bucket assignment
+        """
+        state = self.group.snapshot()
+        state['buckets'] = self._bucket_assignment
+        return state
+
+    def restore(self, state):
+        """
+        Restore state got from :func:`snapshot`. Cached responses are discarded. Bucket
+        assignment is kept since recomputing it from the previous assignment of the same
+        members gives the same result.
+        """
+        self.group.restore(state)
+        self._bucket_assignment = state.get('buckets') or {}
+        self._responses = {}
+        self._responses_generation = None
+        self._members_response = (None, None)
+        self._history.clear()
+        self._history_base = None
+        self._history_members = None
+        self._delta_responses = {}
+
+    def members_response(self, since=None):
+        """
+        Return encoded response with sorted list of all members, and their weights if the
+        group is weighted, if settled. It is encoded once per generation.
+
+        If `since` is a generation within last :obj:`MEMBERS_HISTORY` generations then the
+        response instead has the members "added" and "removed" since then. A member whose
+        weight changed is in "added" and weights of added members are given if the group is
+        weighted.
+        """
+        if not self.group.settled:
+            return SETTLING_RESPONSE
+        if self.group.generation != self._responses_generation:
+            self._new_generation()
+        if since is not None:
+            response = self._delta_response(since)
+            if response is not None:
+                return response
+        generation, response = self._members_response
+        if generation != self.group.generation:
+            generation = self.group.generation
+            content = {'status': 'SETTLED', 'generation': generation,
+                       'members': sorted(self.group.members())}
+            weights = self._weights()
+            if weights is not None:
+                content['weights'] = weights
+            response = json.dumps(content).encode("utf-8")
+            self._members_response = (generation, response)
+        return response
+
+    def _delta_response(self, since):
+        """
+        Return encoded changes in membership since given generation or None if they are not
+        known. It is encoded once per generation.
+        """
+        response = self._delta_responses.get(since)
+        if response is not None:
+            return response
+        if since != self._history_base and since not in (g for g, _, _ in self._history):
+            return None
+        changed, removed = {}, set()
+        for generation, _changed, _removed in self._history:
+            if generation <= since:
+                continue
+            for member in _removed:
+                changed.pop(member, None)
+                removed.add(member)
+            for member, weight in _changed.items():
+                removed.discard(member)
+                changed[member] = weight
+        content = {'status': 'SETTLED', 'generation': self.group.generation, 'since': since,
+                   'added': sorted(changed), 'removed': sorted(removed)}
+        if self.group.weighted:
+            content['weights'] = changed
+        response = self._delta_responses[since] = json.dumps(content).encode("utf-8")
+        return response
+
+
 class Bloc(MultiService):
     """
-    Main server object that clients talk to
+    Main server object that clients talk to.
+
+    Besides the default group served at ``/index``, it hosts any number of named groups served at
+    ``/groups/<name>/index``. A named group is created when its first member heartbeats and is
+    discarded when its last member leaves. All the groups share one :obj:`HeartbeatingClients`
+    and hence one timer checking heartbeat timeouts. Sessions of the default group are tracked
+    in it by session id and sessions of a named group by ``(name, session id)``.
     """
 
     app = Klein()
+    log = Logger()
 
-    def __init__(self, clock, timeout, settle, interval=1):
+    def __init__(self, clock, timeout, settle, interval=1, buckets=None, sticky=False,
+                 groups=None, hints=False, max_settle=None, leases=False, detector=None):
         """
         Create Bloc object
 
@@ -155,28 +725,448 @@ class Bloc(MultiService):
             are settled for this much time before marking the group as SETTLED
         :param float interval: Internal interval to check all clients heartbeat status. Defaults to
             1 second. Mostly, this doesn't need to be changed.
+        :param int buckets: If given, these many fixed buckets are spread among the members when
+            the group settles and each member's buckets are returned in its SETTLED response.
+            Buckets stay with their owners across settles as much as possible.
+        :param bool sticky: Should members keep their index across settles where possible?
+            See :obj:`SettlingGroup`
+        :param dict groups: Named group to ``(timeout, settle)`` tuple of that group. Named groups
+            not given here use `timeout` and `settle`. `buckets`, `sticky`, `hints`,
+            `max_settle` and `leases` apply to all groups.
+        :param bool hints: If True, index responses have "heartbeat" with number of seconds after
+            which the client should heartbeat next. It is a quarter of the timeout while the
+            group is settling and three quarters of the smaller of timeout and settle when it is
+            settled. Clients created with ``adaptive=True`` follow it.
+        :param float max_settle: If given, groups settle within these many seconds of starting
+            to settle even if members keep joining or leaving. See :obj:`SettlingGroup`
+        :param bool leases: If True, SETTLED responses have "lease" with number of seconds from
+            the time of the request for which the index remains the member's even if it cannot
+            reach the server. It is the group's settle time since the index cannot be given to
+            another member before the group settles again. Clients keep their index across
+            failed heartbeats until the lease lapses.
+        :param detector: Failure detector like :obj:`bloc.detector.PhiAccrualDetector` that
+            removes members earlier than the timeout when their heartbeats stop arriving as
+            regularly as before. See :obj:`HeartbeatingClients`
         """
-        self._group = SettlingGroup(clock, settle)
-        self._clients = HeartbeatingClients(clock, timeout, interval, self._group.remove)
+        self._clock = clock
+        self._timeout = timeout
+        self._settle = settle
+        self._buckets = buckets
+        self._sticky = sticky
+        self._hints = hints
+        self._max_settle = max_settle
+        self._leases = leases
+        self._group_settings = groups or {}
+        self._clients = HeartbeatingClients(clock, timeout, interval, self._remove_client,
+                                            detector=detector)
+        # Named groups that currently have members
+        self._groups = {}
+        # Highest generation reached by any discarded named group or start of the current term.
+        # Named groups start from it so that the generation of a group never goes back when it
+        # is created again and is within the term.
+        self._generation = 0
+        # Deferreds waiting for any group to change. See :func:`wait_for_any_change`
+        self._waiters = set()
+        # A passive standby does not serve clients. See :obj:`bloc.replication.Standby`
+        self.active = True
+        self._default = self._new_group(None, timeout, settle)
+        self._group = self._default.group
         super(Bloc, self).__init__()
         self.addService(self._clients)
 
+    def _new_group(self, name, timeout, settle, generation=0):
+        group = _Group(SettlingGroup(self._clock, settle, self._sticky, self._max_settle,
+                                     generation=generation),
+                       timeout, self._buckets, self._hints, self._leases)
+        self._watch(name, group)
+        return group
+
+    def _watch(self, name, group):
+        """
+        Release everyone waiting for any group to change when the group changes, for as long as
+        the group is not discarded
+        """
+        def changed(_):
+            waiters, self._waiters = self._waiters, set()
+            for d in waiters:
+                d.callback(None)
+            if self._get_group(name) is group:
+                self._watch(name, group)
+
+        group.group.wait_for_change().addCallback(changed)
+
+    def _get_group(self, name, create=False):
+        """
+        Return :obj:`_Group` of given name. Default group if name is None. If the named group
+        does not exist then it is created if `create` is True else None is returned.
+        """
+        if name is None:
+            return self._default
+        group = self._groups.get(name)
+        if group is None and create:
+            timeout, settle = self._group_settings.get(name, (self._timeout, self._settle))
+            group = self._groups[name] = self._new_group(
+                name, timeout, settle, self._generation)
+            self.log.info('Created group {g}', g=name)
+        return group
+
+    def _remove_member(self, name, group, client):
+        """
+        Remove client from the group and discard the group if it is a named group that has
+        become empty
+        """
+        group.group.remove(client)
+        if name is not None and not len(group.group):
+            del self._groups[name]
+            group.group.stop()
+            self._generation = max(self._generation, group.group.generation)
+            self.log.info('Removed empty group {g}', g=name)
+
+    def _remove_client(self, key):
+        """
+        Called by :obj:`HeartbeatingClients` when a session times out
+        """
+        name, client = key if isinstance(key, tuple) else (None, key)
+        self._remove_member(name, self._get_group(name), client)
+
+    def snapshot(self):
+        """
+        Return JSON serializable state of all the groups: their members, indexes, generations
+        and bucket assignments along with the generation new named groups start from. Heartbeat
+        deadlines are not included.
+        """
+        groups = [(None, self._default)] + sorted(self._groups.items())
+        state = {'groups': [dict(group.snapshot(), name=name) for name, group in groups]}
+        if self._generation:
+            state['generation'] = self._generation
+        return state
+
+    def restore(self, state, grace=None):
+        """
+        Restore groups from `state` got from :func:`snapshot` of this server before it restarted
+        or of another server. Settled groups remain settled with the same indexes so their
+        members do not see any change. It is meant to be called on a server that does not have
+        any members yet.
+
+        :param float grace: Seconds from now within which every member must heartbeat to this
+            server to remain in its group. Defaults to the group's heartbeat timeout.
+        """
+        self._generation = max(self._generation, state.get('generation', 0))
+        term_start = self._generation // TERM_GENERATIONS * TERM_GENERATIONS
+        for saved in state['groups']:
+            name = saved['name']
+            group = self._get_group(name, create=True)
+            group.restore(saved)
+            group.group.start_term(term_start)
+            for member in saved['members']:
+                self._clients.heartbeat(self._key(name, member),
+                                        group.timeout if grace is None else grace)
+        self.log.info('Restored {n} groups', n=len(state['groups']))
+
+    def start_term(self):
+        """
+        Start the next term: all groups, including the ones created later, settle next with
+        generations higher than any the server whose state this server has can give in its own
+        term. Called by a standby when it takes over since the primary it lost may still be
+        serving clients, e.g. when only the replication connection broke. The generations given
+        by both servers then never clash and stores fencing writes with them reject writes
+        of the primary's members once a write with the standby's generation is seen.
+        """
+        groups = [self._default] + list(self._groups.values())
+        highest = max([self._generation] + [group.group.generation for group in groups])
+        self._generation = (highest // TERM_GENERATIONS + 1) * TERM_GENERATIONS
+        for group in groups:
+            group.group.start_term(self._generation)
+        self.log.info('Started term {t}', t=self._generation // TERM_GENERATIONS)
+
+    def responses(self):
+        """
+        Return ``(settling, settled)`` encoded responses of the default group where `settling`
+        is its SETTLING response and `settled` is dict of each member's SETTLED response. `settled`
+        is None while the group is settling. See :obj:`bloc.worker.WorkerPool`
+        """
+        group = self._default
+        if not group.group.settled:
+            return group.settling_response, None
+        return (group.settling_response,
+                dict((member, group.settled_response(member))
+                     for member in group.group.members()))
+
+    def wait_for_change(self):
+        """
+        Return Deferred that fires with None when the default group next settles or starts
+        settling after being settled
+        """
+        return self._group.wait_for_change()
+
+    def wait_for_any_change(self):
+        """
+        Return Deferred that fires with None when any group next settles or starts settling
+        after being settled. Cancelling the Deferred stops waiting.
+        """
+        d = Deferred(self._waiters.discard)
+        self._waiters.add(d)
+        return d
+
+    @staticmethod
+    def _key(name, client):
+        return client if name is None else (name, client)
+
+    def _wait_for_change(self, client, timeout, name=None):
+        """
+        Return Deferred that fires with index response of the client when the group next
+        changes its state or after `timeout` seconds, whichever is earlier
+        """
+        group, key = self._get_group(name), self._key(name, client)
+
+        def respond(_):
+            # The client has been waiting on an open request all this while so it is alive
+            if key in self._clients:
+                self._clients.heartbeat(key, group.timeout, detect=False)
+            return group.index_response(client)
+
+        d = group.group.wait_for_change()
+        d.addTimeout(min(timeout, group.timeout), self._clock)
+        d.addErrback(lambda f: f.trap(TimeoutError))
+        return d.addCallback(respond)
+
+    def heartbeat(self, client, name=None, weight=1, detect=True):
+        """
+        Record heartbeat of the client, adding it to the group if it is new and return its
+        encoded index response
+
+        :param str name: Name of the group. Default group if None
+        :param int weight: Weight of the client in the group. Changing it makes the group settle
+            again. If any member of a group has weight other than 1 then SETTLED responses of
+            the group have the member's "weight" and its "range" of the group's "weight_total"
+            which members own in proportion to their weights, and buckets are spread in
+            proportion to the weights.
+        :param bool detect: Should the failure detector learn from this heartbeat? See
+            :obj:`HeartbeatingClients`
+        """
+        group = self._get_group(name, create=True)
+        self._clients.heartbeat(self._key(name, client), group.timeout, detect)
+        group.group.add(client, weight)
+        return group.index_response(client)
+
+    def cancel(self, client, name=None):
+        """
+        Remove the client from the group if it is there
+
+        :param str name: Name of the group. Default group if None
+        """
+        key = self._key(name, client)
+        if key in self._clients:
+            self._clients.remove(key)
+        group = self._get_group(name)
+        if group is not None and client in group.group:
+            self._remove_member(name, group, client)
+
     @app.route('/session', methods=['DELETE'])
+    @_when_active
     def cancel_session(self, request):
-        client = extract_client(request)
-        self._clients.remove(client)
-        self._group.remove(client)
+        self.cancel(extract_client(request))
         return "{}".encode("utf-8")
 
+    @app.route('/groups/<name>/session', methods=['DELETE'])
+    @_when_active
+    def cancel_group_session(self, request, name):
+        self.cancel(extract_client(request), name)
+        return "{}".encode("utf-8")
+
+    @app.route('/heartbeats', methods=['POST'])
+    @_when_active
+    def heartbeats(self, request):
+        """
+        Heartbeat all the clients whose session ids are given as JSON list in the body. Returns
+        JSON object with each session id mapped to its index response as returned by
+        ``GET /index``
+        """
+        try:
+            clients = json.loads(request.content.read().decode("utf-8"))
+        except ValueError:
+            clients = None
+        if not isinstance(clients, list) or \
+                not all(isinstance(client, type(u'')) for client in clients):
+            request.setResponseCode(400)
+            return b'{}'
+        return b'{' + b', '.join(
+            json.dumps(client).encode("utf-8") + b': ' + self.heartbeat(client)
+            for client in clients) + b'}'
+
+    @app.route('/members', methods=['GET'])
+    @_when_active
+    def get_members(self, request, name=None):
+        """
+        Return sorted list of session ids of all members along with generation if the group is
+        settled. Clients can build :obj:`bloc.partition.HashRing` from them. If ``since`` query
+        argument is given with generation of the members got earlier then only the members
+        added and removed since then are returned if the server still has them.
+        """
+        since = request.args.get(b'since')
+        if since is not None:
+            try:
+                since = int(since[0])
+            except ValueError:
+                request.setResponseCode(400)
+                return b'{}'
+        group = self._get_group(name)
+        return SETTLING_RESPONSE if group is None else group.members_response(since)
+
+    @app.route('/groups/<name>/members', methods=['GET'])
+    @_when_active
+    def get_group_members(self, request, name):
+        """
+        Same as ``GET /members`` for the named group
+        """
+        return self.get_members(request, name)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics(self, request):
+        """
+        Return server metrics in Prometheus text format
+        """
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+        group, clients = self._group, self._clients
+        return render([
+            ("bloc_heartbeats_total", "counter", "Heartbeats received",
+             [("", {}, clients.heartbeats)]),
+            ("bloc_sessions_added_total", "counter", "Sessions added by first heartbeat",
+             [("", {}, clients.added)]),
+            ("bloc_sessions_removed_total", "counter", "Sessions removed by client",
+             [("", {}, clients.removed)]),
+            ("bloc_session_timeouts_total", "counter", "Sessions removed after heartbeat timeout",
+             [("", {}, clients.timeouts)]),
+            ("bloc_heartbeat_check_seconds", "histogram", "Time taken to check heartbeat timeouts",
+             clients.check_durations.samples()),
+            ("bloc_heartbeat_arrivals", "histogram",
+             "Heartbeats received in each {} second window".format(ARRIVAL_WINDOW),
+             clients.arrivals.samples()),
+            ("bloc_groups", "gauge", "Current number of named groups",
+             [("", {}, len(self._groups))]),
+            ("bloc_members", "gauge", "Current number of members in the default group",
+             [("", {}, len(group))]),
+            ("bloc_settled", "gauge", "1 if group is settled, 0 if it is settling",
+             [("", {}, int(group.settled))]),
+            ("bloc_settles_total", "counter", "Number of times the group has settled",
+             [("", {}, group.generation)]),
+            ("bloc_settle_resets_total", "counter", "Number of times settle timer was reset",
+             [("", {}, group.resets)]),
+            ("bloc_settling_seconds_total", "counter", "Seconds spent in SETTLING state",
+             [("", {}, group.settling_seconds)]),
+        ])
+
     @app.route('/index', methods=['GET'])
-    def get_index(self, request):
+    @_when_active
+    def get_index(self, request, name=None):
+        """
+        Heartbeat and return the client's index. If ``wait`` query argument is given with
+        generation of the last index got by the client then the response is held until the group
+        changes from that state or until ``timeout`` query argument seconds have passed.
+        Client's weight can be given in ``Bloc-Weight`` header. See :func:`heartbeat`
+        """
         client = extract_client(request)
-        self._clients.heartbeat(client)
-        self._group.add(client)
-        if self._group.settled:
-            return json.dumps(
-                {'status': 'SETTLED',
-                 'index': self._group.index_of(client),
-                 'total': len(self._group)}).encode("utf-8")
-        else:
-            return json.dumps({'status': 'SETTLING'}).encode("utf-8")
+        try:
+            weight = extract_weight(request)
+        except ValueError:
+            request.setResponseCode(400)
+            return b'{}'
+        wait = request.args.get(b'wait')
+        if wait is not None:
+            # Parsed before heartbeating so that a rejected request is not a heartbeat
+            timeout = request.args.get(b'timeout')
+            try:
+                generation = int(wait[0])
+                timeout = float(timeout[0]) if timeout is not None else None
+            except ValueError:
+                request.setResponseCode(400)
+                return b'{}'
+            # Comparison is False for nan too
+            if timeout is not None and not 0 <= timeout < float('inf'):
+                request.setResponseCode(400)
+                return b'{}'
+        response = self.heartbeat(client, name, weight, detect=wait is None)
+        if wait is not None:
+            group = self._get_group(name)
+            if not group.changed_since(generation):
+                return self._wait_for_change(
+                    client, group.timeout if timeout is None else timeout, name)
+        return response
+
+    @app.route('/groups/<name>/index', methods=['GET'])
+    @_when_active
+    def get_group_index(self, request, name):
+        """
+        Same as ``GET /index`` for the named group. The group is created if it does not exist.
+        """
+        return self.get_index(request, name)
+
+
+class LeanResource(Resource):
+    """
+    Root resource that serves heartbeats of the default group, i.e. ``GET /index`` without long
+    polling and ``DELETE /session``, directly instead of through Klein's routing. It returns
+    the same pre-encoded responses. All other requests are passed on to the Klein resource of
+    the :obj:`Bloc`.
+    """
+
+    def __init__(self, bloc):
+        Resource.__init__(self)
+        self._klein = bloc.app.resource()
+        self._lean = {b'index': _LeanIndex(bloc, self._klein),
+                      b'session': _LeanSession(bloc, self._klein)}
+
+    def getChildWithDefault(self, name, request):
+        child = self._lean.get(name)
+        if child is not None and not request.postpath:
+            return child
+        return _to_klein(self._klein, request)
+
+
+def _to_klein(klein, request):
+    """
+    Return Klein resource after giving back the path segment consumed while looking for the
+    child so that Klein routes on the whole path
+    """
+    request.postpath.insert(0, request.prepath.pop())
+    return klein
+
+
+class _LeanIndex(Resource):
+    """
+    ``GET /index`` of :obj:`LeanResource`
+    """
+    isLeaf = True
+
+    def __init__(self, bloc, klein):
+        Resource.__init__(self)
+        self._bloc = bloc
+        self._klein = klein
+
+    def render_GET(self, request):
+        if request.args or not self._bloc.active:
+            # long poll and passive responses are left to Klein
+            return _to_klein(self._klein, request).render(request)
+        try:
+            weight = extract_weight(request)
+        except ValueError:
+            return _to_klein(self._klein, request).render(request)
+        return self._bloc.heartbeat(extract_client(request), weight=weight)
+
+
+class _LeanSession(Resource):
+    """
+    ``DELETE /session`` of :obj:`LeanResource`
+    """
+    isLeaf = True
+
+    def __init__(self, bloc, klein):
+        Resource.__init__(self)
+        self._bloc = bloc
+        self._klein = klein
+
+    def render_DELETE(self, request):
+        if not self._bloc.active:
+            return _to_klein(self._klein, request).render(request)
+        self._bloc.cancel(extract_client(request))
+        return b'{}'
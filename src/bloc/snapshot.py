@@ -0,0 +1,113 @@
+"""
+Saving server state to a local file and restoring it when the server starts again so that a
+planned restart does not make the groups settle again. The file has the state returned by
+:func:`bloc.server.Bloc.snapshot` as compact JSON.
+"""
+
+import errno
+import json
+import os
+
+from twisted.application.service import Service
+from twisted.internet import task
+from twisted.logger import Logger
+
+
+def save(state, path):
+    """
+    Write encoded `state` bytes to file at `path` atomically, i.e. the file has either the
+    old or the new state even if the process dies while writing it
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(state)
+        f.flush()
+        os.fsync(f.fileno())
+    # rename replaces the file atomically on POSIX
+    os.rename(tmp, path)
+
+
+def encode(state):
+    """
+    Return compact JSON encoding of `state` as bytes
+    """
+    return json.dumps(state, separators=(',', ':'), sort_keys=True).encode("utf-8")
+
+
+def load(path):
+    """
+    Return state saved in file at `path`. None if the file does not exist.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(f.read().decode("utf-8"))
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+class Snapshotter(Service):
+    """
+    Restores the server from the file at `path` when started and saves the server's state to
+    it as soon as any group settles or starts settling, every `interval` seconds if it has
+    changed otherwise and when stopped. A passive standby neither restores nor saves since its
+    state comes from the primary.
+
+    :param bloc: :obj:`bloc.server.Bloc` to save and restore
+    :param clock: :obj:`IReactorTime` provider
+    :param str path: Path of the snapshot file
+    :param float interval: Seconds between saves that catch changes other than settling, like
+        members joining a group that is already settling
+    :param float grace: Seconds from start within which restored members must heartbeat.
+        Defaults to the heartbeat timeout. See :func:`bloc.server.Bloc.restore`
+    """
+    log = Logger()
+
+    def __init__(self, bloc, clock, path, interval=5, grace=None):
+        self.bloc = bloc
+        self.path = path
+        self.grace = grace
+        self.interval = interval
+        self._loop = task.LoopingCall(self.save)
+        self._loop.clock = clock
+        self._last = None
+        self._waiting = None
+
+    def startService(self):
+        Service.startService(self)
+        if self.bloc.active:
+            state = load(self.path)
+            if state is not None:
+                self.bloc.restore(state, self.grace)
+                self.log.info('Restored from {p}', p=self.path)
+        self._wait()
+        self._loop.start(self.interval, False)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._loop.running:
+            self._loop.stop()
+        if self._waiting is not None:
+            self._waiting.cancel()
+        self.save()
+
+    def _wait(self):
+        self._waiting = self.bloc.wait_for_any_change()
+        self._waiting.addCallbacks(lambda _: (self.save(), self._wait()), lambda f: None)
+
+    def save(self):
+        """
+        Save server's state to the file if it has changed since it was last saved
+        """
+        if not self.bloc.active:
+            return
+        state = encode(self.bloc.snapshot())
+        if state == self._last:
+            return
+        try:
+            save(state, self.path)
+        except (IOError, OSError):
+            self.log.failure('Could not save snapshot to {p}', p=self.path)
+        else:
+            self._last = state
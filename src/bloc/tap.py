@@ -2,10 +2,16 @@
 Twisted application plugin for bloc
 """
 
-from bloc.server import Bloc
+from bloc.detector import PhiAccrualDetector
+from bloc.protocol import BlocLineFactory
+from bloc.replication import ReplicationFactory, Standby
+from bloc.server import Bloc, LeanResource
+from bloc.snapshot import Snapshotter
+from bloc.worker import WorkerPool, parse_listen
 
 from twisted.application.service import MultiService
 from twisted.application.strports import service
+from twisted.internet.endpoints import clientFromString
 from twisted.python import usage
 from twisted.web.server import Site
 
@@ -14,12 +20,79 @@ class Options(usage.Options):
     """
     Options for bloc
     """
+    optFlags = [
+        ['sticky', None, "Keep members' index across settles where possible"],
+        ['hints', None, "Suggest time to next heartbeat in index responses"],
+        ['lean', None, "Serve heartbeats of the default group without Klein routing"],
+        ['leases', None, "Grant members a lease on their index in SETTLED responses"],
+    ]
     optParameters = [
         ['listen', 'l', 'tcp:8989', 'The endpoint to listen on.'],
         ['timeout', 't', None, "Number of seconds to wait before timing out client heartbeats"],
-        ['settle', 's', None, "Number of seconds to wait before settling the group"]
+        ['settle', 's', None, "Number of seconds to wait before settling the group"],
+        ['line-listen', None, None,
+         "The endpoint to listen on for line protocol. It is not started if not given."],
+        ['buckets', 'b', None,
+         "Number of fixed buckets to spread among the members. Each member gets its buckets "
+         "with its index."],
+        ['replication-listen', None, None,
+         "The endpoint to listen on for standby servers. Standbys are not served if not given."],
+        ['standby-of', None, None,
+         "Client endpoint of the primary's replication listener, e.g. tcp:primary:8991. "
+         "The server remains a passive standby of it until it cannot be reached."],
+        ['takeover', None, 3, "Number of seconds a standby waits for the primary before taking "
+         "over", float],
+        ['snapshot', None, None,
+         "File to save the state of the groups to as they change and restore it from on start"],
+        ['snapshot-interval', None, 5,
+         "Number of seconds between saving snapshots of changes that do not settle a group", float],
+        ['grace', None, None,
+         "Number of seconds restored members have to heartbeat after start. Defaults to timeout",
+         float],
+        ['max-settle', None, None,
+         "Maximum number of seconds the group can remain settling when members keep joining "
+         "or leaving. Must not be less than settle.", float],
+        ['phi', None, None,
+         "Remove members whose heartbeats stop arriving as regularly as before once phi accrual "
+         "suspicion reaches this threshold, even before the timeout. 8 is a good start.", float],
+        ['workers', None, None,
+         "Number of worker processes accepting HTTP requests on the listen port. "
+         "The listen endpoint must be TCP.", int],
     ]
 
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['groups'] = {}
+
+    def opt_group(self, value):
+        """
+        Timeout and settle seconds of a named group as name:timeout:settle. Can be given
+        multiple times. Other named groups use --timeout and --settle.
+        """
+        try:
+            name, timeout, settle = value.split(':')
+            self['groups'][name] = (float(timeout), float(settle))
+        except ValueError:
+            raise usage.UsageError(
+                "--group must be name:timeout:settle, got {}".format(value))
+
+    def postOptions(self):
+        if (self['max-settle'] is not None and self['settle'] is not None and
+                self['max-settle'] < float(self['settle'])):
+            raise usage.UsageError("--max-settle must not be less than --settle")
+        if self['phi'] is not None:
+            if self['phi'] <= 0:
+                raise usage.UsageError("--phi must be positive")
+            if self['hints']:
+                # Adaptive clients change their interval when the group settles which the
+                # detector would take as failure
+                raise usage.UsageError("--phi cannot be used with --hints")
+        if self['workers'] is not None:
+            try:
+                parse_listen(self['listen'])
+            except ValueError as e:
+                raise usage.UsageError("--workers needs TCP --listen: {}".format(e))
+
 
 def makeService(config):
     """
@@ -27,13 +100,41 @@ def makeService(config):
     """
     from twisted.internet import reactor
     s = MultiService()
-    bloc = Bloc(reactor, float(config["timeout"]), float(config["settle"]))
+    buckets = config.get("buckets")
+    max_settle = config.get("max-settle")
+    phi = config.get("phi")
+    bloc = Bloc(reactor, float(config["timeout"]), float(config["settle"]),
+                buckets=int(buckets) if buckets is not None else None,
+                sticky=bool(config.get("sticky")), groups=config.get("groups"),
+                hints=bool(config.get("hints")),
+                max_settle=float(max_settle) if max_settle is not None else None,
+                leases=bool(config.get("leases")),
+                detector=PhiAccrualDetector(float(phi)) if phi is not None else None)
     s.addService(bloc)
-    site = Site(bloc.app.resource())
+    if config.get('snapshot') is not None:
+        # Added before the listeners so that the state is restored before serving any client
+        grace = config.get('grace')
+        s.addService(Snapshotter(bloc, reactor, config['snapshot'],
+                                 float(config.get('snapshot-interval', 5)),
+                                 float(grace) if grace is not None else None))
+    site = Site(LeanResource(bloc) if config.get('lean') else bloc.app.resource())
     site.displayTracebacks = False
 
     # The Twisted code currently (v16.6.0, 17.1.0) compares the type of
     # this argument to 'str' in order to determine how to handle it.
     description = str(config['listen'])
-    s.addService(service(description, site))
+    if config.get('workers') is not None:
+        s.addService(WorkerPool(bloc, reactor, description, int(config['workers']), site))
+    else:
+        s.addService(service(description, site))
+
+    if config.get('line-listen') is not None:
+        s.addService(service(str(config['line-listen']), BlocLineFactory(bloc)))
+
+    if config.get('replication-listen') is not None:
+        s.addService(service(str(config['replication-listen']), ReplicationFactory(bloc)))
+
+    if config.get('standby-of') is not None:
+        endpoint = clientFromString(reactor, str(config['standby-of']))
+        s.addService(Standby(bloc, reactor, endpoint, float(config.get('takeover', 3))))
     return s
@@ -0,0 +1,345 @@
+"""
+Serving heartbeats from multiple processes to use more than one core. The server process
+(coordinator) opens the public listening socket and starts worker processes that all accept
+connections on it. The coordinator alone owns the groups and heartbeat timeouts and does not
+accept any public connection itself.
+
+Each worker parses HTTP requests and answers ``GET /index`` (without long polling) and
+``DELETE /session`` of the default group from a replica of the group's encoded responses that
+the coordinator sends it as a JSON line over the worker's stdin every time the group settles or
+starts settling. The heartbeat or removal itself is forwarded to the coordinator as a short line
+over the worker's stdout::
+
+    H <session-id>
+    W <weight> <session-id>
+    D <session-id>
+
+where ``W`` is a heartbeat with weight other than 1.
+
+Every other request, including those to named groups and long polls, is proxied to the
+coordinator's own HTTP server listening on localhost.
+"""
+
+import json
+import os
+import signal
+import socket
+import sys
+
+from twisted.application.service import Service
+from twisted.internet import task
+from twisted.internet.defer import Deferred, gatherResults, succeed
+from twisted.internet.protocol import ProcessProtocol
+from twisted.logger import (
+    FilteringLogObserver, LogLevel, LogLevelFilterPredicate, Logger, globalLogBeginner,
+    textFileLogObserver)
+from twisted.protocols.basic import LineReceiver
+from twisted.web.proxy import ReverseProxyResource
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from bloc.server import extract_client, extract_weight
+
+
+def parse_listen(description):
+    """
+    Return ``(port, interface, backlog)`` of a TCP server endpoint description like
+    ``tcp:8989`` or ``tcp:port=8989:interface=127.0.0.1:backlog=100``. Workers can only
+    share TCP listening sockets.
+
+    :raises: ``ValueError`` if it is not a TCP description
+    """
+    parts = description.split(':')
+    if parts[0] != 'tcp' or len(parts) < 2:
+        raise ValueError("Not a TCP endpoint: {}".format(description))
+    args = {'port': None, 'interface': '', 'backlog': '50'}
+    for part in parts[1:]:
+        key, sep, value = part.partition('=')
+        if sep:
+            if key not in args:
+                raise ValueError("Unknown parameter {} in {}".format(key, description))
+            args[key] = value
+        else:
+            args['port'] = key
+    return int(args['port']), args['interface'], int(args['backlog'])
+
+
+def listening_socket(port, interface='', backlog=50):
+    """
+    Return non-blocking TCP socket listening on given port and interface
+    """
+    family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class _WorkerProcess(ProcessProtocol):
+    """
+    Coordinator's end of a worker process's stdin and stdout
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._buffer = b''
+        self.ended = Deferred()
+
+    def connectionMade(self):
+        self._pool._started(self)
+
+    def childDataReceived(self, fd, data):
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        bloc = self._pool.bloc
+        for line in lines:
+            event, _, client = line.partition(b' ')
+            client = client.decode("utf-8")
+            if event == b'H':
+                bloc.heartbeat(client)
+            elif event == b'W':
+                weight, _, client = client.partition(u' ')
+                bloc.heartbeat(client, weight=int(weight))
+            elif event == b'D':
+                bloc.cancel(client)
+
+    def send(self, line):
+        self.transport.write(line + b'\n')
+
+    def processEnded(self, reason):
+        self._pool._ended(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerPool(Service):
+    """
+    Runs `workers` worker processes accepting HTTP requests on the public TCP port and serves
+    `site` on a localhost port for the requests they do not answer themselves. A worker that
+    exits is started again after a second.
+
+    :param bloc: :obj:`bloc.server.Bloc` owning the groups
+    :param reactor: Reactor providing :obj:`IReactorTCP`, :obj:`IReactorProcess` and
+        :obj:`IReactorTime`
+    :param str listen: TCP server endpoint description of the public port.
+        See :func:`parse_listen`
+    :param int workers: Number of worker processes
+    :param site: :obj:`twisted.web.server.Site` serving the :obj:`bloc.server.Bloc`
+    """
+    log = Logger()
+
+    def __init__(self, bloc, reactor, listen, workers, site):
+        self.bloc = bloc
+        self.reactor = reactor
+        self._address = parse_listen(listen)
+        self._count = workers
+        self._site = site
+        self._socket = None
+        self._backend = None
+        self._workers = set()
+        self._waiting = None
+        self._last = None
+        self._check = task.LoopingCall(self._push)
+        self._check.clock = reactor
+
+    def startService(self):
+        Service.startService(self)
+        self._socket = listening_socket(*self._address)
+        self._backend = self.reactor.listenTCP(0, self._site, interface='127.0.0.1')
+        for _ in range(self._count):
+            self._spawn()
+        self._push()
+        self._wait()
+        # Only catches the server becoming active. Group changes are pushed as they happen.
+        self._check.start(1, False)
+
+    def stopService(self):
+        Service.stopService(self)
+        self._check.stop()
+        self._waiting.cancel()
+        ended = [worker.ended for worker in self._workers]
+        for worker in self._workers:
+            worker.transport.closeStdin()
+        self._socket.close()
+        return gatherResults(ended + [self._backend.stopListening() or succeed(None)])
+
+    def _spawn(self):
+        if not self.running:
+            return
+        args = [sys.executable, '-m', 'bloc.worker', '3', str(int(self._socket.family)),
+                str(self._backend.getHost().port)]
+        self.reactor.spawnProcess(
+            _WorkerProcess(self), sys.executable, args, env=os.environ,
+            childFDs={0: 'w', 1: 'r', 2: 2, 3: self._socket.fileno()})
+
+    def _started(self, worker):
+        self._workers.add(worker)
+        if self._last is not None:
+            worker.send(self._last[1])
+
+    def _ended(self, worker, reason):
+        self._workers.discard(worker)
+        if self.running:
+            self.log.warn('Worker exited: {r}. Starting another', r=reason.value)
+            self.reactor.callLater(1, self._spawn)
+
+    def _wait(self):
+        self._waiting = self.bloc.wait_for_change()
+        self._waiting.addCallbacks(lambda _: (self._push(), self._wait()), lambda f: None)
+
+    def _push(self):
+        """
+        Send default group's responses to all workers if they have changed
+        """
+        active = self.bloc.active
+        settling, settled = self.bloc.responses()
+        key = (active, settled)
+        if self._last is not None and self._last[0] == key:
+            return
+        state = {'active': active, 'settling': settling.decode("utf-8")}
+        if settled is not None:
+            state['settled'] = dict((member, response.decode("utf-8"))
+                                    for member, response in settled.items())
+        self._last = key, json.dumps(state).encode("utf-8")
+        for worker in self._workers:
+            worker.send(self._last[1])
+
+
+class Replica(LineReceiver):
+    """
+    Worker's end of the connection to the coordinator over stdio. Keeps the latest responses
+    got from the coordinator and forwards heartbeats and removals to it.
+    """
+    delimiter = b'\n'
+    # Responses of a large group do not fit in LineReceiver's default
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self):
+        # Requests are proxied to the coordinator until its responses are got
+        self.active = False
+        self._settling = None
+        self._settled = {}
+        self.done = Deferred()
+
+    def lineReceived(self, line):
+        state = json.loads(line.decode("utf-8"))
+        self.active = state['active']
+        self._settling = state['settling'].encode("utf-8")
+        self._settled = dict((member, response.encode("utf-8"))
+                             for member, response in state.get('settled', {}).items())
+
+    def connectionLost(self, reason):
+        self.done.callback(None)
+
+    def heartbeat(self, client, weight=1):
+        """
+        Forward heartbeat of the client and return its encoded index response
+        """
+        if weight == 1:
+            self.transport.write(b'H ' + client.encode("utf-8") + b'\n')
+        else:
+            self.transport.write(u'W {} {}\n'.format(weight, client).encode("utf-8"))
+        return self._settled.get(client, self._settling)
+
+    def cancel(self, client):
+        """
+        Forward removal of the client
+        """
+        self.transport.write(b'D ' + client.encode("utf-8") + b'\n')
+
+
+class WorkerResource(Resource):
+    """
+    Worker's root resource. Answers heartbeats of the default group from the :obj:`Replica`
+    like :obj:`bloc.server.LeanResource` and passes on all other requests to `proxy`.
+
+    :param replica: :obj:`Replica`
+    :param proxy: Resource at the root of the coordinator, typically a
+        :obj:`twisted.web.proxy.ReverseProxyResource`
+    """
+
+    def __init__(self, replica, proxy):
+        Resource.__init__(self)
+        self._proxy = proxy
+        self._lean = {b'index': _WorkerIndex(replica, proxy),
+                      b'session': _WorkerSession(replica, proxy)}
+
+    def getChildWithDefault(self, name, request):
+        child = self._lean.get(name)
+        if child is not None and not request.postpath:
+            return child
+        return self._proxy.getChildWithDefault(name, request)
+
+
+class _WorkerIndex(Resource):
+    """
+    ``GET /index`` of :obj:`WorkerResource`
+    """
+    isLeaf = True
+
+    def __init__(self, replica, proxy):
+        Resource.__init__(self)
+        self._replica = replica
+        self._proxy = proxy
+
+    def render_GET(self, request):
+        client = extract_client(request)
+        try:
+            weight = extract_weight(request)
+        except ValueError:
+            weight = None
+        if request.args or client is None or weight is None or not self._replica.active:
+            return self._proxy.getChildWithDefault(b'index', request).render(request)
+        return self._replica.heartbeat(client, weight)
+
+
+class _WorkerSession(Resource):
+    """
+    ``DELETE /session`` of :obj:`WorkerResource`
+    """
+    isLeaf = True
+
+    def __init__(self, replica, proxy):
+        Resource.__init__(self)
+        self._replica = replica
+        self._proxy = proxy
+
+    def render_DELETE(self, request):
+        client = extract_client(request)
+        if client is None or not self._replica.active:
+            return self._proxy.getChildWithDefault(b'session', request).render(request)
+        self._replica.cancel(client)
+        return b'{}'
+
+
+def _ignore_signals():
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_IGN)
+
+
+def main(reactor, fd, family, backend_port):
+    """
+    Run a worker accepting connections on listening socket `fd` until its stdin is closed
+    """
+    from twisted.internet import stdio
+    # Only the coordinator stops workers, by closing their stdin. Signals sent to the whole
+    # process group, like Ctrl-C, would otherwise stop the reactor before `task.react` does.
+    # Ignored once running since the reactor installs its own handlers when it starts.
+    reactor.callWhenRunning(_ignore_signals)
+    globalLogBeginner.beginLoggingTo([FilteringLogObserver(
+        textFileLogObserver(sys.stderr),
+        [LogLevelFilterPredicate(defaultLogLevel=LogLevel.warn)])])
+    replica = Replica()
+    stdio.StandardIO(replica, reactor=reactor)
+    proxy = ReverseProxyResource(u'127.0.0.1', int(backend_port), b'', reactor)
+    site = Site(WorkerResource(replica, proxy))
+    site.displayTracebacks = False
+    reactor.adoptStreamPort(int(fd), int(family), site)
+    # adoptStreamPort duplicates the descriptor
+    os.close(int(fd))
+    return replica.done
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,101 @@
+"""
+Tests for :module:`bloc.bench`
+"""
+
+import json
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.server import Site
+
+from bloc.bench import _channel, _heartbeat, handle, percentile, simulate, summary
+from bloc.server import Bloc, LeanResource
+
+
+class PercentileTests(SynchronousTestCase):
+    """
+    Tests for :func:`percentile` and :func:`summary`
+    """
+
+    def test_percentile(self):
+        """
+        Returns nearest rank percentile
+        """
+        values = list(range(100, 0, -1))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertEqual(percentile([3], 90), 3)
+
+    def test_empty(self):
+        """
+        Returns None when there are no values
+        """
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(summary([]), {"p50": None, "p90": None, "p99": None, "max": None})
+
+
+class SimulateTests(SynchronousTestCase):
+    """
+    Tests for :func:`simulate`
+    """
+
+    def test_settles(self):
+        """
+        All clients heartbeat every interval and the group settles with all of them
+        """
+        r = simulate(100, interval=1, timeout=3, settle=6, duration=10)
+        self.assertEqual(r["heartbeats"], 1000)
+        self.assertEqual(r["members"], 100)
+
+    def test_phi(self):
+        """
+        Clients that left are removed earlier with phi accrual detector
+        """
+        r = simulate(100, timeout=3, settle=6, duration=30, churn=10, churn_every=20, phi=8)
+        self.assertEqual(r["timeouts"], 10)
+        self.assertAlmostEqual(r["settle_times"][0], 8, places=5)
+        self.assertTrue(r["settled"])
+        self.assertEqual(len(r["check_cost"]), 4)
+
+    def test_churn(self):
+        """
+        Time to settle after each churn is reported
+        """
+        r = simulate(100, timeout=3, settle=6, duration=50, churn=10, churn_every=20)
+        self.assertEqual(len(r["settle_times"]), 2)
+        for settle_time in r["settle_times"]:
+            # clients that left are removed after timeout and then group settles
+            self.assertAlmostEqual(settle_time, 9, places=5)
+        self.assertEqual(r["members"], 100)
+
+
+class HandleTests(SynchronousTestCase):
+    """
+    Tests for :func:`handle`
+    """
+
+    def test_handle(self):
+        """
+        Returns average time taken per request by each resource
+        """
+        times = iter(range(100))
+        self.assertEqual(handle(10, 5, timer=lambda: next(times)), {"klein": 1, "lean": 1})
+
+    def test_response(self):
+        """
+        Raw request bytes are parsed and answered with the index response by both resources
+        """
+        for make_resource in [lambda bloc: bloc.app.resource(), LeanResource]:
+            bloc = Bloc(Clock(), 3, 6)
+            channel = _channel(Site(make_resource(bloc)))
+            for session in [b'c1', b'c2']:
+                _, response = _heartbeat(channel, session)
+                head, body = response.split(b'\r\n\r\n', 1)
+                self.assertTrue(head.startswith(b'HTTP/1.1 200 '))
+                if b'Transfer-Encoding: chunked' in head:
+                    size, body = body.split(b'\r\n', 1)
+                    body = body[:int(size, 16)]
+                self.assertEqual(json.loads(body.decode("utf-8")), {"status": "SETTLING"})
+            self.assertEqual(set(bloc._group.members()), {'c1', 'c2'})
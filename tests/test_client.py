@@ -6,12 +6,19 @@ import json
 
 from treq.testing import RequestSequence, StringStubbingResource, StubTreq, HasHeaders
 
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import CancelledError, Deferred, fail, succeed
+from twisted.internet.error import ConnectionLost, ConnectionRefusedError
 from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
 from twisted.web.util import DeferredResource
 
-from bloc.client import BlocClient
+from bloc.client import (
+    LINE_ABORT_INTERVALS, MEMBERS_TIMEOUT, BlocClient, BlocMultiplexer, CountingConnectionPool,
+    LineBlocClient, connection_pool)
 
 
 class BlocClientTests(SynchronousTestCase):
@@ -43,6 +50,111 @@ class BlocClientTests(SynchronousTestCase):
             self.assertTrue(self.client._settled)
         self.assertEqual(self.async_failures, [])
 
+    def test_group(self):
+        """
+        Client created with group talks to the named group's URLs
+        """
+        self.client = BlocClient(self.clock, 'server:8989', 3, session_id='sid', group='g1')
+        self.async_failures = []
+        self.stubs = RequestSequence(
+            [((b"get", "http://server:8989/groups/g1/index", {},
+               HasHeaders({"Bloc-Session-ID": ["sid"]}), b''),
+              (200, {}, b'{"status": "SETTLED", "index": 1, "total": 1}')),
+             ((b"delete", "http://server:8989/groups/g1/session", {},
+               HasHeaders({"Bloc-Session-ID": ["sid"]}), b''),
+              (200, {}, b'{}'))],
+            self.async_failures.append)
+        self.client.treq = StubTreq(StringStubbingResource(self.stubs))
+        with self.stubs.consume(self.fail):
+            self.client.startService()
+            self.assertEqual(self.client.get_index_total(), (1, 1))
+            self.successResultOf(self.client.stopService())
+        self.assertEqual(self.async_failures, [])
+
+    def test_generation(self):
+        """
+        Generation in SETTLED response is returned by `get_generation` while settled
+        """
+        self.setup_treq(body={"status": "SETTLED", "index": 1, "total": 2, "generation": 7})
+        self.client.startService()
+        with self.stubs.consume(self.fail):
+            self.assertEqual(self.client.get_generation(), 7)
+        self.setup_treq(body={"status": "SETTLING"})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertIsNone(self.client.get_generation())
+
+    def test_failover(self):
+        """
+        Client given many servers moves to the next one when getting index fails
+        """
+        self.client = BlocClient(self.clock, ['server:8989', 'standby:8989'], 3,
+                                 session_id='sid')
+        self.setup_treq(code=503)
+        self.client.startService()
+        with self.stubs.consume(self.fail):
+            self.assertIsNone(self.client.get_index_total())
+        self.flushLoggedErrors()
+        self.stubs = RequestSequence(
+            [((b"get", "http://standby:8989/index", {},
+               HasHeaders({"Bloc-Session-ID": ["sid"]}), b''),
+              (200, {}, b'{"status": "SETTLED", "index": 1, "total": 1}'))],
+            self.async_failures.append)
+        self.client.treq = StubTreq(StringStubbingResource(self.stubs))
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertEqual(self.client.get_index_total(), (1, 1))
+        self.assertEqual(self.async_failures, [])
+
+    def test_buckets(self):
+        """
+        Buckets in SETTLED response are returned by `get_buckets`
+        """
+        self.setup_treq(body={"status": "SETTLED", "index": 1, "total": 2, "buckets": [0, 3]})
+        self.client.startService()
+        with self.stubs.consume(self.fail):
+            self.assertEqual(self.client.get_buckets(), [0, 3])
+        self.setup_treq(body={"status": "SETTLING"})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertIsNone(self.client.get_buckets())
+
+    def test_weight(self):
+        """
+        Client created with weight sends it with heartbeats
+        """
+        self.client = BlocClient(self.clock, 'server:8989', 3, session_id='sid', weight=3)
+        self.async_failures = []
+        self.stubs = RequestSequence(
+            [((b"get", "http://server:8989/index", {},
+               HasHeaders({"Bloc-Session-ID": ["sid"], "Bloc-Weight": ["3"]}), b''),
+              (200, {}, b'{"status": "SETTLED", "index": 1, "total": 1}'))],
+            self.async_failures.append)
+        self.client.treq = StubTreq(StringStubbingResource(self.stubs))
+        with self.stubs.consume(self.fail):
+            self.client.startService()
+            self.assertEqual(self.client.get_index_total(), (1, 1))
+        self.assertEqual(self.async_failures, [])
+
+    def test_range(self):
+        """
+        `get_range` returns range and total weight in SETTLED response. Without them it is the
+        index's range of total and None when settling.
+        """
+        self.setup_treq(body={"status": "SETTLED", "index": 2, "total": 3})
+        self.client.startService()
+        with self.stubs.consume(self.fail):
+            self.assertEqual(self.client.get_range(), (1, 2, 3))
+        self.setup_treq(body={"status": "SETTLED", "index": 2, "total": 3, "weight": 2,
+                              "range": [3, 5], "weight_total": 6})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertEqual(self.client.get_range(), (3, 5, 6))
+        self.setup_treq(body={"status": "SETTLING"})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertIsNone(self.client.get_range())
+
     def test_settling(self):
         """
         When getting index returns SETTLING, then get_index_total returns None
@@ -143,3 +255,873 @@ class BlocClientTests(SynchronousTestCase):
         self.assertIsNone(self.successResultOf(d))
         # Moving time would fail treq if it tried to heartbeat
         self.clock.advance(4)
+
+
+class ChangeTests(SynchronousTestCase):
+    """
+    Tests for :func:`on_change` and :func:`when_settled` of clients
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.client = BlocClient(self.clock, 'server:8989', 3, session_id='sid')
+
+    def test_on_change(self):
+        """
+        Callback is called with new index and total only when they or buckets change
+        """
+        calls = []
+        self.client.on_change(calls.append)
+        self.client._set_index({"status": "SETTLING"})
+        self.assertEqual(calls, [])
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2})
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2})
+        self.assertEqual(calls, [(1, 2)])
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2, "buckets": [1]})
+        self.client._set_index({"status": "SETTLED", "index": 2, "total": 2, "buckets": [1]})
+        self.client._set_index({"status": "SETTLING"})
+        self.client._error_allocating(Failure(ValueError()))
+        self.flushLoggedErrors(ValueError)
+        self.assertEqual(calls, [(1, 2), (1, 2), (2, 2), None])
+
+    def test_stop_on_change(self):
+        """
+        Callback is not called after calling the function returned by `on_change`
+        """
+        calls = []
+        stop = self.client.on_change(calls.append)
+        stop()
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2})
+        self.assertEqual(calls, [])
+
+    def test_callback_error(self):
+        """
+        Error in a callback is logged and other callbacks are still called
+        """
+        calls = []
+        self.client.on_change(lambda i: 1 / 0)
+        self.client.on_change(calls.append)
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2})
+        self.assertEqual(calls, [(1, 2)])
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+    def test_when_settled(self):
+        """
+        `when_settled` fires when the client next settles or immediately if it is settled
+        """
+        d = self.client.when_settled()
+        self.client._set_index({"status": "SETTLING"})
+        self.assertNoResult(d)
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2})
+        self.assertEqual(self.successResultOf(d), (1, 2))
+        self.assertEqual(self.successResultOf(self.client.when_settled()), (1, 2))
+
+    def test_when_settled_cancel(self):
+        """
+        Cancelling `when_settled` Deferred stops waiting
+        """
+        d = self.client.when_settled()
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2})
+        self.assertEqual(self.client._settled_waiters, [])
+
+    def test_multiplexed(self):
+        """
+        Clients of :obj:`BlocMultiplexer` also support `on_change`
+        """
+        calls = []
+        client = BlocMultiplexer(self.clock, 'server:8989', 3).client('s1')
+        client.on_change(calls.append)
+        client._set_index({"status": "SETTLED", "index": 1, "total": 1})
+        self.assertEqual(calls, [(1, 1)])
+
+
+class LeaseTests(SynchronousTestCase):
+    """
+    Tests for clients keeping their index while it is leased
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.client = BlocClient(self.clock, 'server:8989', 3, session_id='sid')
+        self.calls = []
+        self.client.on_change(self.calls.append)
+
+    def fail_heartbeat(self):
+        self.client._error_allocating(Failure(ValueError()))
+        self.flushLoggedErrors(ValueError)
+
+    def test_kept_until_lapse(self):
+        """
+        Index is kept across failed heartbeats until the lease less the margin lapses from the
+        time the request was sent
+        """
+        self.clock.advance(1)
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2, "lease": 10}, 0)
+        self.clock.advance(2)
+        self.fail_heartbeat()
+        self.clock.advance(3)
+        self.fail_heartbeat()
+        self.assertEqual(self.client.get_index_total(), (1, 2))
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(1.9)
+        self.assertEqual(self.client.get_index_total(), (1, 2))
+        self.clock.advance(0.1)
+        self.assertIsNone(self.client.get_index_total())
+        self.assertEqual(self.calls, [(1, 2), None])
+
+    def test_renewed(self):
+        """
+        Successful heartbeat renews the lease and stops the lapse timer
+        """
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2, "lease": 10}, 0)
+        self.clock.advance(3)
+        self.fail_heartbeat()
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2, "lease": 10}, 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(7)
+        self.fail_heartbeat()
+        self.clock.advance(0.9)
+        self.assertEqual(self.client.get_index_total(), (1, 2))
+        self.clock.advance(0.1)
+        self.assertIsNone(self.client.get_index_total())
+
+    def test_settling_revokes(self):
+        """
+        SETTLING response drops the index even if it is leased
+        """
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2, "lease": 10}, 0)
+        self.fail_heartbeat()
+        self.client._set_index({"status": "SETTLING"})
+        self.assertIsNone(self.client.get_index_total())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.calls, [(1, 2), None])
+
+    def test_no_lease(self):
+        """
+        Index is dropped on first failed heartbeat if it is not leased or the lease has lapsed
+        """
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2}, 0)
+        self.fail_heartbeat()
+        self.assertIsNone(self.client.get_index_total())
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2, "lease": 5}, 0)
+        self.clock.advance(4)
+        self.fail_heartbeat()
+        self.assertIsNone(self.client.get_index_total())
+
+    def test_heartbeat_sent_time(self):
+        """
+        Lease is counted from the time the heartbeat was sent, not when its response arrived
+        """
+        d = Deferred()
+        self.client._get_index = lambda params=None: d
+        self.clock.advance(5)
+        self.client._heartbeat()
+        self.clock.advance(2)
+        d.callback({"status": "SETTLED", "index": 1, "total": 2, "lease": 10})
+        self.assertEqual(self.client._lease_expiry, 13)
+
+    def test_stop(self):
+        """
+        Stopping the client cancels the lapse timer
+        """
+        self.client.treq = StubTreq(Resource())
+        self.client._set_index({"status": "SETTLED", "index": 1, "total": 2, "lease": 10}, 0)
+        self.fail_heartbeat()
+        self.client.startService()
+        self.fail_heartbeat()
+        self.successResultOf(self.client.stopService())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_multiplexed(self):
+        """
+        Clients of :obj:`BlocMultiplexer` keep leased index when heartbeats fail
+        """
+        mux = BlocMultiplexer(self.clock, 'server:8989', 3)
+        client = mux.client('s1')
+        client._set_index({"status": "SETTLED", "index": 1, "total": 1, "lease": 10}, 0)
+        mux._error_allocating(Failure(ValueError()))
+        self.flushLoggedErrors(ValueError)
+        self.assertEqual(client.get_index_total(), (1, 1))
+        self.clock.advance(8)
+        self.assertIsNone(client.get_index_total())
+
+
+class HeldResource(Resource):
+    """
+    Resource that holds requests until they are responded with `respond`
+    """
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+
+    def render(self, request):
+        self.requests.append(request)
+        return NOT_DONE_YET
+
+    def respond(self, body, code=200):
+        request = self.requests.pop(0)
+        request.setResponseCode(code)
+        request.write(json.dumps(body).encode("utf-8"))
+        request.finish()
+        return request
+
+
+class TrackMembersTests(SynchronousTestCase):
+    """
+    Tests for :obj:`client.BlocClient` with `track_members=True`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.client = BlocClient(self.clock, 'server:8989', 3, session_id='s1',
+                                 track_members=True)
+
+    def setup_treq(self, index_body, members_body=None, since=None):
+        self.async_failures = []
+        requests = [((b"get", "http://server:8989/index", {},
+                      HasHeaders({"Bloc-Session-ID": ["s1"]}), b''),
+                     (200, {}, json.dumps(index_body).encode("utf-8")))]
+        if members_body is not None:
+            params = {} if since is None else {b"since": [since]}
+            requests.append(((b"get", "http://server:8989/members", params, HasHeaders({}), b''),
+                             (200, {}, json.dumps(members_body).encode("utf-8"))))
+        self.stubs = RequestSequence(requests, self.async_failures.append)
+        self.client.treq = StubTreq(StringStubbingResource(self.stubs))
+
+    def test_fetches_members_on_settle(self):
+        """
+        Members are fetched when the group settles with new generation and ring is built
+        from them
+        """
+        self.setup_treq({"status": "SETTLING"})
+        self.client.startService()
+        with self.stubs.consume(self.fail):
+            self.assertIsNone(self.client.get_ring())
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 1},
+                        {"status": "SETTLED", "generation": 1, "members": ["s1", "s2"]})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            ring = self.client.get_ring()
+            self.assertEqual(set(ring.owners(["a", "b", "c", "d", "e"])), set(["s1", "s2"]))
+        # not fetched again for same generation
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 1})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertIs(self.client.get_ring(), ring)
+        self.assertEqual(self.async_failures, [])
+
+    def test_weighted_ring(self):
+        """
+        Ring is built with weights of the members if given
+        """
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 1},
+                        {"status": "SETTLED", "generation": 1, "members": ["s1", "s2"],
+                         "weights": {"s1": 1, "s2": 4}})
+        self.client.startService()
+        with self.stubs.consume(self.fail):
+            owners = self.client.get_ring().owners(["k{}".format(i) for i in range(1000)])
+        self.assertTrue(owners.count("s2") > 2 * owners.count("s1"))
+
+    def test_changes(self):
+        """
+        After the first time only changes since the last members' generation are fetched and
+        applied
+        """
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 1},
+                        {"status": "SETTLED", "generation": 1, "members": ["s1", "s2"]})
+        self.client.startService()
+        with self.stubs.consume(self.fail):
+            self.assertEqual(self.client.get_members(), ["s1", "s2"])
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 3},
+                        {"status": "SETTLED", "generation": 3, "since": 1, "added": ["s3", "s4"],
+                         "removed": ["s2"], "weights": {"s3": 1, "s4": 5}}, b"1")
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertEqual(self.client.get_members(), ["s1", "s3", "s4"])
+            owners = self.client.get_ring().owners(["k{}".format(i) for i in range(1000)])
+            self.assertTrue(owners.count("s4") > 2 * owners.count("s3"))
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 4},
+                        {"status": "SETTLED", "generation": 4, "since": 3, "added": ["s4"],
+                         "removed": []}, b"3")
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertEqual(self.client._members, {"s1": 1, "s3": 1, "s4": 1})
+        self.assertEqual(self.async_failures, [])
+
+    def test_changes_mismatch(self):
+        """
+        Changes since a generation other than the members' are ignored
+        """
+        self.test_fetches_members_on_settle()
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 3},
+                        {"status": "SETTLED", "generation": 3, "since": 2, "added": ["s3"],
+                         "removed": []}, b"1")
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertIsNone(self.client.get_members())
+            self.assertEqual(self.client._members_generation, 1)
+
+    def test_server_restarted(self):
+        """
+        All members are fetched again if generation goes back
+        """
+        self.test_changes()
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 1, "generation": 1},
+                        {"status": "SETTLED", "generation": 1, "members": ["s1"]})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertEqual(self.client.get_members(), ["s1"])
+
+    def test_members_newer(self):
+        """
+        Members newer than the SETTLED index are kept when the group then starts settling
+        """
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 1},
+                        {"status": "SETTLED", "generation": 2, "members": ["s1", "s2"]})
+        self.client.startService()
+        self.setup_treq({"status": "SETTLING"})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+        self.assertEqual(self.client._members, {"s1": 1, "s2": 1})
+        self.assertEqual(self.client._members_generation, 2)
+        self.assertEqual(self.async_failures, [])
+
+    def test_members_failed(self):
+        """
+        Failing to get members does not affect the index and is tried again on next heartbeat
+        """
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 1})
+        self.stubs._sequence.append(
+            ((b"get", "http://server:8989/members", {}, HasHeaders({}), b''), (500, {}, b'')))
+        changes = []
+        self.client.on_change(changes.append)
+        self.client.startService()
+        with self.stubs.consume(self.fail):
+            self.assertEqual(self.client.get_index_total(), (1, 2))
+            self.assertIsNone(self.client.get_ring())
+        self.assertEqual(changes, [(1, 2)])
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 1},
+                        {"status": "SETTLED", "generation": 1, "members": ["s1", "s2"]})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertEqual(self.client.get_members(), ["s1", "s2"])
+
+    def test_members_slow(self):
+        """
+        Slow members request does not hold the heartbeat. Another request is not made while it
+        is in flight and it is given up after `MEMBERS_TIMEOUT` seconds.
+        """
+        self.client = BlocClient(self.clock, 'server:8989', 100, session_id='s1',
+                                 track_members=True)
+        resource = HeldResource()
+        self.client.treq = StubTreq(resource)
+        settled = {"status": "SETTLED", "index": 1, "total": 2, "generation": 1}
+        self.client.startService()
+        resource.respond(settled)
+        self.client.treq.flush()
+        self.assertEqual(self.client.get_index_total(), (1, 2))
+        self.assertEqual([r.path for r in resource.requests], [b'/members'])
+        self.client._heartbeat()
+        resource.requests.append(resource.requests.pop(0))
+        resource.respond(settled)
+        self.client.treq.flush()
+        self.assertEqual([r.path for r in resource.requests], [b'/members'])
+        self.clock.advance(MEMBERS_TIMEOUT)
+        self.assertIsNone(self.client._getting_members)
+        self.assertEqual(self.client.get_index_total(), (1, 2))
+
+    def test_members_changed(self):
+        """
+        If members have different generation than the index then ring is not available
+        """
+        self.setup_treq({"status": "SETTLED", "index": 1, "total": 2, "generation": 1},
+                        {"status": "SETTLED", "generation": 2, "members": ["s1", "s2", "s3"]})
+        self.client.startService()
+        with self.stubs.consume(self.fail):
+            self.assertEqual(self.client.get_index_total(), (1, 2))
+            self.assertIsNone(self.client.get_ring())
+
+    def test_settling_no_ring(self):
+        """
+        Ring is not available when settling even if it was fetched before
+        """
+        self.test_fetches_members_on_settle()
+        self.setup_treq({"status": "SETTLING"})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertIsNone(self.client.get_ring())
+
+
+class LongPollTests(SynchronousTestCase):
+    """
+    Tests for :obj:`client.BlocClient` with `long_poll=True`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.client = BlocClient(self.clock, 'server:8989', 3, session_id='sid', long_poll=True)
+        self.resource = HeldResource()
+        self.client.treq = StubTreq(self.resource)
+
+    def respond(self, body, code=200):
+        """
+        Respond to the outstanding poll and return the query arguments it was sent with
+        """
+        request = self.resource.respond(body, code)
+        self.client.treq.flush()
+        return request.args
+
+    def test_polls_with_generation(self):
+        """
+        Client polls with last known generation and polls again immediately after getting
+        response
+        """
+        self.client.startService()
+        self.assertEqual(
+            self.respond({"status": "SETTLED", "index": 1, "total": 2, "generation": 4}),
+            {b"wait": [b"0"], b"timeout": [b"3"]})
+        self.assertEqual(self.client.get_index_total(), (1, 2))
+        self.clock.advance(0)
+        self.assertEqual(self.respond({"status": "SETTLING"})[b"wait"], [b"4"])
+        self.assertIsNone(self.client.get_index_total())
+        self.clock.advance(0)
+        self.assertEqual(
+            self.respond({"status": "SETTLED", "index": 2, "total": 2, "generation": 5})[b"wait"],
+            [b"4"])
+        self.assertEqual(self.client.get_index_total(), (2, 2))
+        self.clock.advance(0)
+        self.assertEqual(len(self.resource.requests), 1)
+        self.assertEqual(self.resource.requests[0].args[b"wait"], [b"5"])
+
+    def test_error_polls_after_interval(self):
+        """
+        If polling errors then client polls again after interval
+        """
+        self.client.startService()
+        self.respond({}, code=500)
+        self.assertIsNone(self.client.get_index_total())
+        self.clock.advance(2)
+        self.assertEqual(self.resource.requests, [])
+        self.clock.advance(1)
+        self.respond({"status": "SETTLED", "index": 1, "total": 1, "generation": 1})
+        self.assertEqual(self.client.get_index_total(), (1, 1))
+
+    def test_poll_times_out(self):
+        """
+        If server does not respond within twice the interval then client is not settled
+        and polls again after interval
+        """
+        self.client.startService()
+        self.respond({"status": "SETTLED", "index": 1, "total": 1, "generation": 1})
+        self.clock.advance(0)
+        self.clock.advance(6)
+        self.assertIsNone(self.client.get_index_total())
+        self.assertIsNone(self.client._polling)
+        self.assertTrue(self.client._next_poll.active())
+
+    def test_stop_cancels_poll(self):
+        """
+        :func:`stopService` cancels outstanding poll and does not poll anymore
+        """
+        self.client.startService()
+        self.client.treq = StubTreq(DeferredResource(Deferred()))
+        d = self.client.stopService()
+        self.clock.advance(1)
+        self.assertIsNone(self.successResultOf(d))
+        self.assertIsNone(self.client._polling)
+        self.assertIsNone(self.client._next_poll)
+
+
+class AdaptiveTests(SynchronousTestCase):
+    """
+    Tests for :obj:`client.BlocClient` with `adaptive=True`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.client = BlocClient(self.clock, 'server:8989', 3, session_id='sid', adaptive=True)
+        self.client._random = lambda: 0.5
+        self.resource = HeldResource()
+        self.client.treq = StubTreq(self.resource)
+
+    def respond(self, body, code=200):
+        self.resource.respond(body, code)
+        self.client.treq.flush()
+
+    def test_follows_hint(self):
+        """
+        Next heartbeat happens after the delay suggested in the response less the jitter
+        """
+        self.client.startService()
+        self.respond({"status": "SETTLING", "heartbeat": 1})
+        self.clock.advance(0.94)
+        self.assertEqual(self.resource.requests, [])
+        self.clock.advance(0.01)
+        self.respond({"status": "SETTLED", "index": 1, "total": 1, "heartbeat": 10})
+        self.assertEqual(self.client.get_index_total(), (1, 1))
+        self.clock.advance(9.49)
+        self.assertEqual(self.resource.requests, [])
+        self.clock.advance(0.01)
+        self.assertEqual(len(self.resource.requests), 1)
+
+    def test_no_hint(self):
+        """
+        Client heartbeats every interval less the jitter if server does not suggest delay
+        """
+        self.client.startService()
+        self.respond({"status": "SETTLING", "heartbeat": 1})
+        self.clock.advance(1)
+        self.respond({"status": "SETTLING"})
+        self.clock.advance(2.84)
+        self.assertEqual(self.resource.requests, [])
+        self.clock.advance(0.01)
+        self.assertEqual(len(self.resource.requests), 1)
+
+    def test_error(self):
+        """
+        Client heartbeats after interval if heartbeat fails or times out
+        """
+        self.client.startService()
+        self.respond({"status": "SETTLED", "index": 1, "total": 1, "heartbeat": 10})
+        self.clock.advance(10)
+        self.respond({}, code=500)
+        self.assertIsNone(self.client.get_index_total())
+        self.clock.advance(3)
+        self.assertEqual(len(self.resource.requests), 1)
+        # does not respond
+        self.clock.advance(3)
+        self.assertIsNone(self.client._polling)
+        self.clock.advance(3)
+        self.assertEqual(len(self.resource.requests), 2)
+
+    def test_stop(self):
+        """
+        :func:`stopService` cancels next heartbeat
+        """
+        self.client.startService()
+        self.respond({"status": "SETTLING", "heartbeat": 1})
+        self.client.treq = StubTreq(DeferredResource(Deferred()))
+        d = self.client.stopService()
+        self.clock.advance(1)
+        self.assertIsNone(self.successResultOf(d))
+        self.assertIsNone(self.client._next_poll)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class JitterTests(SynchronousTestCase):
+    """
+    Tests for :obj:`client.BlocClient` with `jitter` and `random_start`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.resource = HeldResource()
+
+    def client(self, **kwargs):
+        client = BlocClient(self.clock, 'server:8989', 4, session_id='sid', **kwargs)
+        client._random = lambda: 0.25
+        client.treq = StubTreq(self.resource)
+        return client
+
+    def respond(self, client):
+        self.resource.respond({"status": "SETTLING"})
+        client.treq.flush()
+
+    def test_random_start(self):
+        """
+        First heartbeat happens after random delay within interval
+        """
+        client = self.client(random_start=True)
+        client.startService()
+        self.clock.advance(0.9)
+        self.assertEqual(self.resource.requests, [])
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.resource.requests), 1)
+        # then every interval
+        self.respond(client)
+        self.clock.advance(4)
+        self.assertEqual(len(self.resource.requests), 1)
+
+    def test_jitter(self):
+        """
+        Each heartbeat happens randomly up to `jitter` fraction earlier than interval
+        """
+        client = self.client(jitter=0.2)
+        client.startService()
+        self.respond(client)
+        self.clock.advance(3.7)
+        self.assertEqual(self.resource.requests, [])
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.resource.requests), 1)
+
+    def test_no_jitter(self):
+        """
+        Without jitter and random start the client heartbeats every interval from start
+        """
+        client = self.client()
+        self.assertEqual(client._jitter, 0)
+        client.startService()
+        self.assertTrue(client._loop.running)
+        self.assertEqual(len(self.resource.requests), 1)
+        self.assertEqual(self.client(adaptive=True)._jitter, 0.1)
+
+
+class ConnectionPoolTests(SynchronousTestCase):
+    """
+    Tests for :func:`client.connection_pool` and :obj:`client.CountingConnectionPool`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_settings(self):
+        """
+        Pool is created with given settings
+        """
+        pool = connection_pool(self.clock, persistent=5, idle_timeout=30, retry=False)
+        self.assertIsInstance(pool, CountingConnectionPool)
+        self.assertTrue(pool.persistent)
+        self.assertEqual(pool.maxPersistentPerHost, 5)
+        self.assertEqual(pool.cachedConnectionTimeout, 30)
+        self.assertFalse(pool.retryAutomatically)
+        self.assertFalse(connection_pool(self.clock, persistent=0).persistent)
+
+    def test_counts(self):
+        """
+        Pool counts new connections and connections reused from the pool
+        """
+        pool = connection_pool(self.clock, idle_timeout=30)
+        connected = []
+
+        class Endpoint(object):
+            def connect(self, factory):
+                connected.append(factory)
+                return Deferred()
+
+        pool.getConnection("key", Endpoint())
+        self.assertEqual((pool.created, pool.reused), (1, 0))
+        connection = StringTransport()
+        connection.state = "QUIESCENT"
+        pool._putConnection("key", connection)
+        pool.getConnection("key", Endpoint())
+        self.assertEqual((pool.created, pool.reused), (1, 1))
+        self.assertEqual(len(connected), 1)
+
+    def test_clients_use_pool(self):
+        """
+        BlocClient and BlocMultiplexer make requests using given pool
+        """
+        pool = connection_pool(self.clock)
+        client = BlocClient(self.clock, 'server:8989', 3, session_id='sid', pool=pool)
+        self.assertIs(client.treq._agent._pool, pool)
+        multiplexer = BlocMultiplexer(self.clock, 'server:8989', 3, pool=pool)
+        self.assertIs(multiplexer.treq._agent._pool, pool)
+
+
+class FakeEndpoint(object):
+    """
+    Client endpoint that connects given protocol to :obj:`StringTransport` or fails if
+    `refuse` is set
+    """
+
+    def __init__(self):
+        self.transports = []
+        self.refuse = False
+
+    def connect(self, factory):
+        if self.refuse:
+            return fail(ConnectionRefusedError())
+        proto = factory.buildProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        self.transports.append(transport)
+        return succeed(proto)
+
+
+class LineBlocClientTests(SynchronousTestCase):
+    """
+    Tests for :obj:`client.LineBlocClient`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.endpoint = FakeEndpoint()
+        self.client = LineBlocClient(self.clock, 'server:8990', 3, session_id='sid',
+                                     endpoint=self.endpoint)
+
+    def respond(self, body):
+        transport = self.endpoint.transports[-1]
+        self.assertEqual(transport.value(), b'INDEX sid\n')
+        transport.clear()
+        self.client._protocol.dataReceived(json.dumps(body).encode("utf-8") + b'\n')
+
+    def test_heartbeats_on_one_connection(self):
+        """
+        Client connects on first heartbeat and keeps using the same connection
+        """
+        self.client.startService()
+        self.respond({"status": "SETTLING"})
+        self.assertIsNone(self.client.get_index_total())
+        self.clock.advance(3)
+        self.respond({"status": "SETTLED", "index": 2, "total": 3, "generation": 1})
+        self.assertEqual(self.client.get_index_total(), (2, 3))
+        self.assertEqual(len(self.endpoint.transports), 1)
+
+    def test_reconnects(self):
+        """
+        Client reconnects on next heartbeat if connection is lost or could not be made
+        """
+        self.test_heartbeats_on_one_connection()
+        self.clock.advance(3)
+        self.client._protocol.connectionLost(Failure(ConnectionLost()))
+        self.assertIsNone(self.client.get_index_total())
+        self.endpoint.refuse = True
+        self.clock.advance(3)
+        self.assertEqual(len(self.endpoint.transports), 1)
+        self.endpoint.refuse = False
+        self.clock.advance(3)
+        self.respond({"status": "SETTLED", "index": 1, "total": 3, "generation": 2})
+        self.assertEqual(self.client.get_index_total(), (1, 3))
+        self.assertEqual(len(self.endpoint.transports), 2)
+
+    def test_timeout_keeps_connection(self):
+        """
+        If heartbeat is not responded within interval then it fails but the connection is kept
+        and the late response is discarded
+        """
+        self.test_heartbeats_on_one_connection()
+        self.clock.advance(3)
+        self.clock.advance(3.01)
+        self.assertIsNone(self.client.get_index_total())
+        transport = self.endpoint.transports[-1]
+        self.assertFalse(transport.disconnecting)
+        self.client._protocol.dataReceived(
+            b'{"status": "SETTLED", "index": 1, "total": 3, "generation": 1}\n')
+        self.assertIsNone(self.client.get_index_total())
+        self.flushLoggedErrors()
+
+    def test_overdue_aborts_connection(self):
+        """
+        If a response has not arrived within `LINE_ABORT_INTERVALS` intervals then the connection
+        is aborted
+        """
+        self.test_heartbeats_on_one_connection()
+        self.clock.pump([3] * LINE_ABORT_INTERVALS)
+        self.assertFalse(self.endpoint.transports[-1].disconnecting)
+        self.clock.advance(3)
+        self.assertTrue(self.endpoint.transports[-1].disconnecting)
+        self.flushLoggedErrors()
+
+    def test_stop_deletes_session(self):
+        """
+        :func:`stopService` deletes the session and closes the connection
+        """
+        self.test_heartbeats_on_one_connection()
+        d = self.client.stopService()
+        transport = self.endpoint.transports[-1]
+        self.assertEqual(transport.value(), b'DELETE sid\n')
+        self.client._protocol.dataReceived(b'{}\n')
+        self.assertIsNone(self.successResultOf(d))
+        self.assertTrue(transport.disconnecting)
+
+
+class BlocMultiplexerTests(SynchronousTestCase):
+    """
+    Tests for :obj:`client.BlocMultiplexer`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.mux = BlocMultiplexer(self.clock, 'server:8989', 3)
+        self.c1 = self.mux.client('s1')
+        self.c2 = self.mux.client('s2')
+
+    def setup_treq(self, sessions, code=200, body={}):
+        self.async_failures = []
+        self.stubs = RequestSequence(
+            [((b"post", "http://server:8989/heartbeats", {},
+               HasHeaders({"Content-Type": ["application/json"]}),
+               json.dumps(sessions).encode("utf-8")),
+              (code, {}, json.dumps(body).encode("utf-8")))],
+            self.async_failures.append)
+        self.mux.treq = StubTreq(StringStubbingResource(self.stubs))
+
+    def test_one_request(self):
+        """
+        All sessions are heartbeated in one request and their indexes are set from the response
+        """
+        self.setup_treq(
+            ["s1", "s2"],
+            body={"s1": {"status": "SETTLED", "index": 2, "total": 2},
+                  "s2": {"status": "SETTLED", "index": 1, "total": 2}})
+        self.mux.startService()
+        with self.stubs.consume(self.fail):
+            self.assertEqual(self.c1.get_index_total(), (2, 2))
+            self.assertEqual(self.c2.get_index_total(), (1, 2))
+        self.assertEqual(self.async_failures, [])
+
+    def test_settling(self):
+        """
+        Sessions that are settling return None
+        """
+        self.setup_treq(["s1", "s2"], body={"s1": {"status": "SETTLING"},
+                                            "s2": {"status": "SETTLING"}})
+        self.mux.startService()
+        with self.stubs.consume(self.fail):
+            self.assertIsNone(self.c1.get_index_total())
+            self.assertIsNone(self.c2.get_index_total())
+
+    def test_error(self):
+        """
+        If heartbeat request fails then all sessions return None
+        """
+        self.test_one_request()
+        self.setup_treq(["s1", "s2"], code=500)
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+            self.assertIsNone(self.c1.get_index_total())
+            self.assertIsNone(self.c2.get_index_total())
+
+    def test_no_sessions(self):
+        """
+        No request is made when there are no sessions
+        """
+        mux = BlocMultiplexer(self.clock, 'server:8989', 3, treq=None)
+        mux.startService()
+        self.clock.advance(3)
+
+    def test_remove(self):
+        """
+        Removing a session deletes it on server and it is not heartbeated anymore
+        """
+        self.test_one_request()
+        stubs = RequestSequence(
+            [((b"delete", "http://server:8989/session", {},
+               HasHeaders({"Bloc-Session-ID": ["s1"]}), b''),
+              (200, {}, b'{}'))],
+            self.fail)
+        self.mux.treq = StubTreq(StringStubbingResource(stubs))
+        with stubs.consume(self.fail):
+            self.assertIsNone(self.successResultOf(self.c1.remove()))
+        self.assertIsNone(self.c1.get_index_total())
+        self.setup_treq(["s2"], body={"s2": {"status": "SETTLING"}})
+        with self.stubs.consume(self.fail):
+            self.clock.advance(3)
+
+    def test_stop_deletes_sessions(self):
+        """
+        :func:`stopService` deletes all sessions, waiting at most 1 second, and stops
+        heartbeating
+        """
+        self.test_one_request()
+        self.mux.treq = StubTreq(DeferredResource(Deferred()))
+        d = self.mux.stopService()
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertIsNone(self.successResultOf(d))
+        # Moving time would fail treq if it tried to heartbeat
+        self.clock.advance(4)
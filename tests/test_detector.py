@@ -0,0 +1,86 @@
+"""
+Tests for :module:`bloc.detector`
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from bloc.detector import PhiAccrualDetector, deviations, phi
+
+
+class PhiTests(SynchronousTestCase):
+    """
+    Tests for :func:`phi` and :func:`deviations`
+    """
+
+    def test_deviations(self):
+        """
+        Phi at returned number of deviations beyond the mean is the threshold
+        """
+        for threshold in [0.5, 1, 3, 8, 16]:
+            y = deviations(threshold)
+            self.assertAlmostEqual(phi(2 + y * 0.5, 2, 0.5), threshold, places=6)
+
+    def test_phi(self):
+        """
+        Phi grows with elapsed time and is about 0.3 at the mean
+        """
+        values = [phi(elapsed, 1, 0.1) for elapsed in [0, 0.5, 1, 1.2, 1.5, 2]]
+        self.assertEqual(values, sorted(values))
+        self.assertAlmostEqual(values[2], 0.30103, places=4)
+        self.assertAlmostEqual(values[0], 0, places=6)
+
+
+class PhiAccrualDetectorTests(SynchronousTestCase):
+    """
+    Tests for :obj:`PhiAccrualDetector`
+    """
+
+    def setUp(self):
+        self.detector = PhiAccrualDetector(threshold=3, window=4, min_std=0.1, min_samples=2)
+
+    def heartbeat(self, client, times):
+        return [self.detector.heartbeat(client, t) for t in times]
+
+    def test_not_enough_samples(self):
+        """
+        Nothing is suspected until there are `min_samples` intervals
+        """
+        self.assertEqual(self.heartbeat('c', [0, 1]), [None, None])
+        self.assertIsNone(self.detector.phi('c', 5))
+        self.assertIsNone(self.detector.phi('unknown', 5))
+
+    def test_regular(self):
+        """
+        Regular heartbeats are suspected after mean plus `min_std` times deviations
+        """
+        suspected = self.heartbeat('c', [0, 1, 2, 3])[-1]
+        self.assertAlmostEqual(suspected, 1 + deviations(3) * 0.1)
+        self.assertAlmostEqual(self.detector.phi('c', 3 + suspected), 3)
+
+    def test_irregular(self):
+        """
+        Irregular heartbeats are suspected later
+        """
+        irregular = self.heartbeat('c', [0, 0.5, 2, 2.5, 4])[-1]
+        regular = self.heartbeat('d', [0, 1, 2, 3, 4])[-1]
+        self.assertGreater(irregular, regular)
+        mean, std = 1, 0.5
+        self.assertAlmostEqual(irregular, mean + deviations(3) * std)
+
+    def test_window(self):
+        """
+        Only last `window` intervals are considered
+        """
+        self.heartbeat('c', [0, 5, 10, 11, 12, 13])
+        suspected = self.detector.heartbeat('c', 14)
+        self.assertAlmostEqual(suspected, 1 + deviations(3) * 0.1)
+
+    def test_remove(self):
+        """
+        Removed client starts afresh
+        """
+        self.heartbeat('c', [0, 1, 2])
+        self.detector.remove('c')
+        self.detector.remove('unknown')
+        self.assertEqual(len(self.detector), 0)
+        self.assertIsNone(self.detector.heartbeat('c', 10))
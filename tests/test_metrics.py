@@ -0,0 +1,61 @@
+"""
+Tests for :module:`bloc.metrics`
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from bloc.metrics import Histogram, render
+
+
+class HistogramTests(SynchronousTestCase):
+    """
+    Tests for :obj:`Histogram`
+    """
+
+    def test_samples(self):
+        """
+        Samples have cumulative bucket counts, sum and count
+        """
+        h = Histogram((0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            h.observe(value)
+        self.assertEqual(
+            h.samples({"g": "a"}),
+            [("_bucket", {"g": "a", "le": "0.1"}, 2),
+             ("_bucket", {"g": "a", "le": "1"}, 3),
+             ("_bucket", {"g": "a", "le": "+Inf"}, 4),
+             ("_sum", {"g": "a"}, 2.65),
+             ("_count", {"g": "a"}, 4)])
+
+    def test_observe_times(self):
+        """
+        Value can be observed many times at once
+        """
+        h = Histogram((1,))
+        h.observe(0, 3)
+        h.observe(2)
+        self.assertEqual(
+            h.samples(),
+            [("_bucket", {"le": "1"}, 3), ("_bucket", {"le": "+Inf"}, 4),
+             ("_sum", {}, 2), ("_count", {}, 4)])
+
+
+class RenderTests(SynchronousTestCase):
+    """
+    Tests for :func:`render`
+    """
+
+    def test_render(self):
+        """
+        Renders families in Prometheus text format
+        """
+        self.assertEqual(
+            render([("a_total", "counter", "Some a", [("", {}, 3)]),
+                    ("b", "gauge", "Some b", [("", {"x": 'q"1'}, 1.5), ("", {"x": "2"}, 0)])]),
+            b'# HELP a_total Some a\n'
+            b'# TYPE a_total counter\n'
+            b'a_total 3\n'
+            b'# HELP b Some b\n'
+            b'# TYPE b gauge\n'
+            b'b{x="q\\"1"} 1.5\n'
+            b'b{x="2"} 0\n')
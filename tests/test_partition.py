@@ -0,0 +1,167 @@
+"""
+Tests for :module:`bloc.partition`
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from bloc.partition import HashRing, assign_buckets, key_hash
+
+
+class KeyHashTests(SynchronousTestCase):
+    """
+    Tests for :func:`key_hash`
+    """
+
+    def test_stable(self):
+        """
+        Hash is same for text and its utf-8 bytes and does not change across runs
+        """
+        self.assertEqual(key_hash(u"abc"), key_hash(b"abc"))
+        self.assertEqual(key_hash(b"abc"), 0x900150983cd24fb0)
+
+
+class HashRingTests(SynchronousTestCase):
+    """
+    Tests for :obj:`HashRing`
+    """
+
+    keys = ["key{}".format(i) for i in range(5000)]
+
+    def test_owners(self):
+        """
+        Every key is owned by one of the members and `owners` agrees with `owner`
+        """
+        ring = HashRing(["a", "b", "c"])
+        owners = ring.owners(self.keys)
+        self.assertEqual(owners, [ring.owner(key) for key in self.keys])
+        self.assertEqual(set(owners), set(["a", "b", "c"]))
+        # roughly even
+        for member in "abc":
+            self.assertTrue(1000 < owners.count(member) < 2400)
+
+    def test_owned_by(self):
+        """
+        `owned_by` partitions the keys among the members
+        """
+        ring = HashRing(["a", "b", "c"])
+        owned = [ring.owned_by(m, self.keys) for m in "abc"]
+        self.assertEqual(sorted(sum(owned, [])), sorted(self.keys))
+
+    def test_minimal_movement(self):
+        """
+        When a member joins or leaves only keys owned by it change owner
+        """
+        members = ["m{}".format(i) for i in range(10)]
+        before = HashRing(members).owners(self.keys)
+        after = HashRing(members + ["new"]).owners(self.keys)
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        self.assertTrue(all(a == "new" for _, a in moved))
+        self.assertTrue(len(moved) < len(self.keys) / 5)
+        after = HashRing(members[1:]).owners(self.keys)
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        self.assertTrue(all(b == "m0" for b, _ in moved))
+
+    def test_weights(self):
+        """
+        Members own keys in proportion to their weights
+        """
+        owners = HashRing(["a", "b", "c"], weights={"a": 2}).owners(self.keys)
+        self.assertTrue(1900 < owners.count("a") < 3100)
+        self.assertTrue(700 < owners.count("b") < 1800)
+
+    def test_empty(self):
+        """
+        Empty ring has no owners
+        """
+        ring = HashRing([])
+        self.assertIsNone(ring.owner("k"))
+        self.assertEqual(ring.owners(["k", "l"]), [None, None])
+
+
+def moved(before, after):
+    """
+    Return number of buckets whose owner changed between two assignments
+    """
+    owner = dict((b, m) for m, bs in before.items() for b in bs)
+    return sum(1 for m, bs in after.items() for b in bs if owner.get(b) != m)
+
+
+class AssignBucketsTests(SynchronousTestCase):
+    """
+    Tests for :func:`assign_buckets`
+    """
+
+    def check_even(self, assignment, buckets):
+        self.assertEqual(sorted(sum(assignment.values(), [])), list(range(buckets)))
+        counts = [len(bs) for bs in assignment.values()]
+        self.assertTrue(max(counts) - min(counts) <= 1)
+
+    def test_even(self):
+        """
+        Buckets are spread evenly without previous assignment
+        """
+        a = assign_buckets(10, ["a", "b", "c"])
+        self.assertEqual(a, {"a": [0, 1, 2, 3], "b": [4, 5, 6], "c": [7, 8, 9]})
+
+    def test_member_leaves(self):
+        """
+        When a member leaves only its buckets move
+        """
+        before = assign_buckets(12, ["a", "b", "c", "d"])
+        after = assign_buckets(12, ["a", "b", "d"], before)
+        self.check_even(after, 12)
+        self.assertEqual(moved(before, after), 3)
+        for m in "abd":
+            self.assertTrue(set(before[m]) <= set(after[m]))
+
+    def test_member_joins(self):
+        """
+        When a member joins only buckets given to it move
+        """
+        before = assign_buckets(10, ["a", "b", "c"])
+        after = assign_buckets(10, ["a", "b", "c", "d"], before)
+        self.check_even(after, 10)
+        self.assertEqual(moved(before, after), len(after["d"]))
+        for m in "abc":
+            self.assertTrue(set(after[m]) <= set(before[m]))
+
+    def test_more_members(self):
+        """
+        Members beyond number of buckets get no buckets
+        """
+        a = assign_buckets(2, ["a", "b", "c"])
+        self.check_even(a, 2)
+        self.assertEqual(sum(1 for bs in a.values() if not bs), 1)
+
+    def test_buckets_reduced(self):
+        """
+        Previous buckets not in range anymore are dropped
+        """
+        a = assign_buckets(4, ["a", "b"], {"a": [0, 1, 5], "b": [2, 3, 4]})
+        self.assertEqual(a, {"a": [0, 1], "b": [2, 3]})
+
+    def test_weights(self):
+        """
+        Buckets are spread in proportion to weights, with remaining buckets going to members
+        with the largest fractional share
+        """
+        a = assign_buckets(10, ["a", "b", "c"], weights={"a": 2, "b": 2})
+        self.assertEqual(a, {"a": [0, 1, 2, 3], "b": [4, 5, 6, 7], "c": [8, 9]})
+        a = assign_buckets(10, ["a", "b"], weights={"a": 3})
+        self.assertEqual(a, {"a": [0, 1, 2, 3, 4, 5, 6, 7], "b": [8, 9]})
+
+    def test_weight_changes(self):
+        """
+        When a member's weight grows only buckets given to it move
+        """
+        before = assign_buckets(12, ["a", "b", "c"])
+        after = assign_buckets(12, ["a", "b", "c"], before, {"a": 2})
+        self.assertEqual([len(after[m]) for m in "abc"], [6, 3, 3])
+        self.assertEqual(moved(before, after), 2)
+        self.assertTrue(set(before["a"]) <= set(after["a"]))
+
+    def test_no_members(self):
+        """
+        No members get empty assignment
+        """
+        self.assertEqual(assign_buckets(4, []), {})
@@ -0,0 +1,149 @@
+"""
+Tests for :module:`bloc.protocol`
+"""
+
+import json
+
+from twisted.internet.defer import CancelledError
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import SynchronousTestCase
+
+from bloc.protocol import BlocLineClientProtocol, BlocLineFactory
+from bloc.server import Bloc
+
+
+class BlocLineProtocolTests(SynchronousTestCase):
+    """
+    Tests for :obj:`BlocLineProtocol`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.bloc = Bloc(self.clock, 3, 10)
+        self.bloc.startService()
+        self.proto = BlocLineFactory(self.bloc).buildProtocol(None)
+        self.transport = StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def responses(self):
+        lines = self.transport.value().splitlines()
+        self.transport.clear()
+        return [json.loads(line.decode("utf-8")) for line in lines]
+
+    def test_index(self):
+        """
+        INDEX command heartbeats the session and responds with its index
+        """
+        self.proto.dataReceived(b'INDEX s1\n')
+        self.assertEqual(self.responses(), [{"status": "SETTLING"}])
+        self.assertIn('s1', self.bloc._clients)
+        for _ in range(4):
+            self.clock.advance(3)
+            self.proto.dataReceived(b'INDEX s1\r\n')
+        self.assertEqual(
+            self.responses()[-1],
+            {"status": "SETTLED", "index": 1, "total": 1, "generation": 1})
+
+    def test_delete(self):
+        """
+        DELETE command removes the session
+        """
+        self.proto.dataReceived(b'INDEX s1\nDELETE s1\n')
+        self.assertEqual(self.responses(), [{"status": "SETTLING"}, {}])
+        self.assertNotIn('s1', self.bloc._clients)
+        self.assertNotIn('s1', self.bloc._group)
+
+    def test_unknown(self):
+        """
+        Unknown or incomplete command responds with error
+        """
+        self.proto.dataReceived(b'GET s1\nINDEX\n')
+        self.assertEqual(self.responses(), [{"error": "unknown command"}] * 2)
+
+    def test_passive(self):
+        """
+        Passive server responds with error to all commands
+        """
+        self.bloc.active = False
+        self.proto.dataReceived(b'INDEX s1\n')
+        self.assertEqual(self.responses(), [{"error": "passive standby"}])
+        self.assertNotIn('s1', self.bloc._group)
+
+    def test_connection_lost(self):
+        """
+        Sessions heartbeated over the connection are removed when connection is lost
+        """
+        self.proto.dataReceived(b'INDEX s1\nINDEX s2\n')
+        self.bloc.heartbeat('other')
+        self.bloc._clients.remove('s2')
+        self.proto.connectionLost(Failure(ConnectionLost()))
+        self.assertNotIn('s1', self.bloc._group)
+        self.assertNotIn('s2', self.bloc._group)
+        self.assertIn('other', self.bloc._group)
+
+
+class BlocLineClientProtocolTests(SynchronousTestCase):
+    """
+    Tests for :obj:`BlocLineClientProtocol`
+    """
+
+    def setUp(self):
+        self.disconnected = []
+        self.proto = BlocLineClientProtocol(lambda: self.disconnected.append(True))
+        self.transport = StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def test_requests_in_order(self):
+        """
+        Requests are sent as lines and responses fire the requests' Deferreds in order
+        """
+        d1 = self.proto.request(b'INDEX', 'sid')
+        d2 = self.proto.request(b'DELETE', 'sid')
+        self.assertEqual(self.transport.value(), b'INDEX sid\nDELETE sid\n')
+        self.proto.dataReceived(b'{"status": "SETTLING"}\n')
+        self.assertEqual(self.successResultOf(d1), {"status": "SETTLING"})
+        self.assertNoResult(d2)
+        self.proto.dataReceived(b'{}\n')
+        self.assertEqual(self.successResultOf(d2), {})
+
+    def test_cancel(self):
+        """
+        Cancelling a request keeps the connection and discards its response when it arrives
+        """
+        d1 = self.proto.request(b'INDEX', 'sid')
+        d2 = self.proto.request(b'INDEX', 'sid')
+        d1.cancel()
+        self.failureResultOf(d1, CancelledError)
+        self.assertFalse(self.transport.disconnecting)
+        self.proto.dataReceived(b'{"status": "SETTLING"}\n{}\n')
+        self.assertEqual(self.successResultOf(d2), {})
+
+    def test_abort_after(self):
+        """
+        Connection is aborted when a response has not arrived within `abort_after` seconds
+        """
+        clock = Clock()
+        self.proto = BlocLineClientProtocol(lambda: None, clock, 10)
+        self.proto.makeConnection(self.transport)
+        self.proto.request(b'INDEX', 'sid')
+        clock.advance(5)
+        self.proto.dataReceived(b'{}\n')
+        d = self.proto.request(b'INDEX', 'sid')
+        clock.advance(9)
+        self.assertFalse(self.transport.disconnecting)
+        clock.advance(1)
+        self.assertTrue(self.transport.disconnecting)
+        self.proto.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(d, ConnectionLost)
+
+    def test_connection_lost(self):
+        """
+        Pending requests fail when connection is lost and disconnected callback is called
+        """
+        d = self.proto.request(b'INDEX', 'sid')
+        self.proto.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(d, ConnectionLost)
+        self.assertEqual(self.disconnected, [True])
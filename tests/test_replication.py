@@ -0,0 +1,263 @@
+"""
+Tests for :module:`bloc.replication`
+"""
+
+import json
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.error import ConnectionLost, ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import SynchronousTestCase
+
+from bloc.replication import ReplicationFactory, Standby
+from bloc.server import TERM_GENERATIONS, Bloc
+
+
+def settled_bloc(clock, sessions):
+    """
+    Return started Bloc whose default group has settled with given sessions
+    """
+    bloc = Bloc(clock, 3, 5)
+    bloc.startService()
+    for _ in range(3):
+        for session in sessions:
+            bloc.heartbeat(session)
+        clock.pump([1] * 2)
+    return bloc
+
+
+class ReplicationFactoryTests(SynchronousTestCase):
+    """
+    Tests for :obj:`ReplicationFactory`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.bloc = settled_bloc(self.clock, ['s1', 's2'])
+        self.factory = ReplicationFactory(self.bloc)
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+    def test_publish(self):
+        """
+        State is sent to standbys when they connect and after that only when it has changed
+        """
+        proto, transport = self.connect()
+        self.assertEqual(json.loads(transport.value().decode("utf-8")), self.bloc.snapshot())
+        transport.clear()
+        self.factory.publish()
+        self.assertEqual(transport.value(), b'')
+        self.bloc.heartbeat('s3')
+        self.factory.publish()
+        self.assertIn(b'"s3"', transport.value())
+        # disconnected standby is not sent anything
+        proto.connectionLost(Failure(ConnectionLost()))
+        self.assertEqual(self.factory.standbys, set())
+
+    def test_new_standby_gets_last_state(self):
+        """
+        Standby connecting after state is published gets it immediately
+        """
+        self.factory.publish()
+        _, transport = self.connect()
+        self.assertEqual(transport.value(), self.factory.last + b'\n')
+
+    def test_publish_on_change(self):
+        """
+        State is sent as soon as any group settles or starts settling while the factory is
+        started
+        """
+        self.factory.doStart()
+        _, transport = self.connect()
+        transport.clear()
+        self.bloc.heartbeat('s3')
+        self.assertIn(b'"s3"', transport.value())
+        for _ in range(3):
+            for session in ['s1', 's2', 's3']:
+                self.bloc.heartbeat(session)
+            self.bloc.heartbeat('s1', 'g')
+            self.clock.pump([1] * 2)
+        last = transport.value().splitlines()[-1]
+        self.assertEqual(json.loads(last.decode("utf-8")), self.bloc.snapshot())
+        self.assertTrue(self.bloc._groups['g'].group.settled)
+        transport.clear()
+        self.factory.doStop()
+        self.bloc.heartbeat('s4')
+        self.assertEqual(transport.value(), b'')
+        self.assertEqual(self.bloc._waiters, set())
+
+    def test_passive_does_not_publish(self):
+        """
+        Passive server does not publish its state
+        """
+        self.bloc.active = False
+        _, transport = self.connect()
+        self.factory.publish()
+        self.assertIsNone(self.factory.last)
+        self.assertEqual(transport.value(), b'')
+
+
+class Endpoint(object):
+    """
+    Client endpoint whose connection attempts are controlled by the test
+    """
+
+    def __init__(self):
+        self.attempts = []
+
+    def connect(self, factory):
+        d = Deferred()
+        self.attempts.append((factory, d))
+        return d
+
+    def succeed(self):
+        factory, d = self.attempts[-1]
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        d.callback(proto)
+        return proto
+
+    def refuse(self):
+        self.attempts[-1][1].errback(ConnectionRefusedError())
+
+
+class StandbyTests(SynchronousTestCase):
+    """
+    Tests for :obj:`Standby`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.primary = settled_bloc(self.clock, ['s1', 's2'])
+        self.bloc = Bloc(self.clock, 3, 5)
+        self.bloc.startService()
+        self.endpoint = Endpoint()
+        self.standby = Standby(self.bloc, self.clock, self.endpoint, takeover=3, retry=1)
+
+    def test_passive(self):
+        """
+        Server is passive until primary is lost
+        """
+        self.assertFalse(self.bloc.active)
+        self.standby.startService()
+        proto = self.endpoint.succeed()
+        self.clock.advance(10)
+        self.assertFalse(self.bloc.active)
+        self.assertIs(self.standby._protocol, proto)
+
+    def test_takeover(self):
+        """
+        Standby restores last state it got and becomes active after primary is lost for
+        `takeover` seconds. Settled group remains settled with the same indexes.
+        """
+        expected = [self.primary.heartbeat(session) for session in ['s1', 's2']]
+        self.standby.startService()
+        proto = self.endpoint.succeed()
+        proto.dataReceived(json.dumps(self.primary.snapshot()).encode("utf-8") + b'\n')
+        proto.connectionLost(Failure(ConnectionLost()))
+        self.clock.advance(1)
+        self.endpoint.refuse()
+        self.clock.advance(1)
+        self.assertFalse(self.bloc.active)
+        self.clock.advance(1)
+        self.assertTrue(self.bloc.active)
+        self.assertEqual([self.bloc.heartbeat(session) for session in ['s1', 's2']], expected)
+        # Next settle is in a new term so its generation differs from the primary's
+        for _ in range(3):
+            for session in ['s1', 's2', 's3']:
+                self.bloc.heartbeat(session)
+            self.clock.pump([1] * 2)
+        self.assertEqual(json.loads(self.bloc.heartbeat('s1').decode("utf-8"))['generation'],
+                         TERM_GENERATIONS + 1)
+        # pending attempt is cancelled and there are no more attempts
+        self.assertTrue(self.endpoint.attempts[-1][1].called)
+        self.clock.advance(5)
+        self.assertEqual(len(self.endpoint.attempts), 3)
+
+    def test_reconnect(self):
+        """
+        Standby does not take over if it reconnects to the primary within `takeover` seconds
+        """
+        self.standby.startService()
+        proto = self.endpoint.succeed()
+        proto.connectionLost(Failure(ConnectionLost()))
+        self.clock.advance(1)
+        self.endpoint.succeed()
+        self.clock.advance(5)
+        self.assertFalse(self.bloc.active)
+
+    def test_primary_never_reached(self):
+        """
+        Standby keeps trying to connect and takes over without any state if primary cannot
+        be reached from the start
+        """
+        self.standby.startService()
+        self.endpoint.refuse()
+        self.clock.advance(1)
+        self.endpoint.refuse()
+        self.clock.advance(2)
+        self.assertTrue(self.bloc.active)
+        self.assertEqual(len(self.bloc._group), 0)
+
+    def test_stop(self):
+        """
+        Stopping the service stops connecting and taking over
+        """
+        endpoint = Endpoint()
+        endpoint.connect = lambda factory: fail(ConnectionRefusedError())
+        standby = Standby(self.bloc, self.clock, endpoint)
+        standby.startService()
+        standby.stopService()
+        self.clock.advance(10)
+        self.assertFalse(self.bloc.active)
+
+    def test_stop_connected(self):
+        """
+        Stopping the service disconnects from the primary
+        """
+        self.standby.startService()
+        proto = self.endpoint.succeed()
+        self.standby.stopService()
+        self.assertTrue(proto.transport.disconnecting)
+        proto.connectionLost(Failure(ConnectionLost()))
+        self.clock.advance(10)
+        self.assertFalse(self.bloc.active)
+
+
+class EndToEndTests(SynchronousTestCase):
+    """
+    Primary replicating to a standby over a connection
+    """
+
+    def test_replicate(self):
+        """
+        State published by the primary reaches the standby
+        """
+        clock = Clock()
+        primary = settled_bloc(clock, ['s1'])
+        factory = ReplicationFactory(primary)
+        standby_bloc = Bloc(clock, 3, 5)
+
+        class Endpoint(object):
+            def connect(self, standby_factory):
+                proto = standby_factory.buildProtocol(None)
+                transport = StringTransport()
+                proto.makeConnection(transport)
+                self.proto = proto
+                return succeed(proto)
+
+        endpoint = Endpoint()
+        standby = Standby(standby_bloc, clock, endpoint)
+        standby.startService()
+        primary_proto = factory.buildProtocol(None)
+        primary_transport = StringTransport()
+        primary_proto.makeConnection(primary_transport)
+        factory.publish()
+        endpoint.proto.dataReceived(primary_transport.value())
+        self.assertEqual(standby._state, primary.snapshot())
@@ -3,14 +3,20 @@ Tests for :module:`bloc.server`
 """
 
 import json
+from io import BytesIO
 
+from twisted.internet.defer import CancelledError
 from twisted.internet.task import Clock
+from twisted.logger import Logger
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.web.http import Headers, Request
+from twisted.web.server import Request as ServerRequest, Site
 from twisted.web.test.requesthelper import DummyChannel
 
 from bloc.server import (
-    SettlingGroup, NotSettled, extract_client, HeartbeatingClients, Bloc)
+    MAX_WEIGHT, MEMBERS_HISTORY, SETTLING_RESPONSE, TERM_GENERATIONS, SettlingGroup, NotSettled,
+    extract_client, HeartbeatingClients, Bloc, LeanResource)
+from bloc.detector import PhiAccrualDetector
 
 
 class SettlingGroupTests(SynchronousTestCase):
@@ -26,6 +32,24 @@ class SettlingGroupTests(SynchronousTestCase):
         self.assertTrue(self.g.settled)
         self.assertEqual(len(self.g), length)
 
+    def test_weight(self):
+        """
+        Changing weight of a member makes the group settle again. Adding with same weight does
+        not.
+        """
+        self.g.add('m1')
+        self.clock.advance(10)
+        self.g.add('m1', 1)
+        self.assertTrue(self.g.settled)
+        self.assertFalse(self.g.weighted)
+        self.g.add('m1', 3)
+        self.assertFalse(self.g.settled)
+        self.assertEqual(self.g.weight_of('m1'), 3)
+        self.assertTrue(self.g.weighted)
+        self.g.remove('m1')
+        self.assertFalse(self.g.weighted)
+        self.assertEqual(self.g.weight_of('m1'), 1)
+
     def test_add_and_settle(self):
         """
         Add a member and see if it settles after 10 seconds
@@ -73,6 +97,106 @@ class SettlingGroupTests(SynchronousTestCase):
         """
         self.assertRaises(KeyError, self.g.remove, "bad")
 
+    def test_generation(self):
+        """
+        Generation is incremented every time the group settles
+        """
+        self.assertEqual(self.g.generation, 0)
+        self.g.add('m1')
+        self.clock.advance(10)
+        self.assertEqual(self.g.generation, 1)
+        self.g.add('m2')
+        self.assertEqual(self.g.generation, 1)
+        self.clock.advance(10)
+        self.assertEqual(self.g.generation, 2)
+
+    def test_wait_for_change_settled(self):
+        """
+        `wait_for_change` fires when the group settles and when it starts settling again. It
+        does not fire when the group remains settling
+        """
+        self.g.add('m1')
+        d = self.g.wait_for_change()
+        self.g.add('m2')
+        self.assertNoResult(d)
+        self.clock.advance(10)
+        self.assertIsNone(self.successResultOf(d))
+        d = self.g.wait_for_change()
+        self.g.remove('m2')
+        self.assertIsNone(self.successResultOf(d))
+
+    def test_wait_for_change_cancel(self):
+        """
+        Cancelling Deferred returned by `wait_for_change` stops waiting
+        """
+        d = self.g.wait_for_change()
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(self.g._waiters, set())
+
+    def test_metrics(self):
+        """
+        Resets and time spent settling are recorded
+        """
+        self.g.add('m1')
+        self.clock.advance(4)
+        self.g.add('m2')
+        self.assertEqual(self.g.settling_seconds, 4)
+        self.clock.advance(10)
+        self.assertEqual(self.g.resets, 2)
+        self.assertEqual(self.g.settling_seconds, 14)
+        self.clock.advance(5)
+        self.g.remove('m1')
+        self.clock.advance(2)
+        self.assertEqual(self.g.settling_seconds, 16)
+
+    def settle_sticky(self, add=(), remove=()):
+        for member in add:
+            self.g.add(member)
+        for member in remove:
+            self.g.remove(member)
+        self.clock.advance(10)
+        return dict((m, self.g.index_of(m)) for m in self.g.members())
+
+    def test_sticky_leave(self):
+        """
+        With sticky, when a member leaves, the others keep their index except the one with
+        last index which takes the freed index
+        """
+        self.g.sticky = True
+        before = self.settle_sticky(add=["m1", "m2", "m3", "m4"])
+        self.assertEqual(sorted(before.values()), [1, 2, 3, 4])
+        leaving = [m for m, i in before.items() if i == 2][0]
+        last = [m for m, i in before.items() if i == 4][0]
+        after = self.settle_sticky(remove=[leaving])
+        self.assertEqual(after[last], 2)
+        for m in after:
+            if m != last:
+                self.assertEqual(after[m], before[m])
+
+    def test_sticky_replace(self):
+        """
+        With sticky, a new member joining in place of one leaving takes its index and others
+        do not change
+        """
+        self.g.sticky = True
+        before = self.settle_sticky(add=["m1", "m2", "m3"])
+        after = self.settle_sticky(add=["new"], remove=["m2"])
+        self.assertEqual(after["new"], before["m2"])
+        self.assertEqual(after["m1"], before["m1"])
+        self.assertEqual(after["m3"], before["m3"])
+
+    def test_sticky_join(self):
+        """
+        With sticky, joining members get next indexes and others do not change
+        """
+        self.g.sticky = True
+        before = self.settle_sticky(add=["m1", "m2"])
+        after = self.settle_sticky(add=["m3", "m4"])
+        self.assertEqual(sorted([after["m3"], after["m4"]]), [3, 4])
+        self.assertEqual(after["m1"], before["m1"])
+        self.assertEqual(after["m2"], before["m2"])
+
     def test_notsettled_error(self):
         """
         Getting index when not settled raises `NotSettled` error
@@ -80,11 +204,83 @@ class SettlingGroupTests(SynchronousTestCase):
         self.g.add('m1')
         self.assertRaises(NotSettled, self.g.index_of, 'm1')
 
+    def test_stop(self):
+        """
+        `stop` cancels the settle timer and releases waiters
+        """
+        self.g.add(1)
+        d = self.g.wait_for_change()
+        self.g.stop()
+        self.assertIsNone(self.successResultOf(d))
+        self.clock.advance(10)
+        self.assertFalse(self.g.settled)
+
+    def test_single_timer(self):
+        """
+        Activity while settling moves the deadline without rescheduling the timer
+        """
+        self.g.add('m1')
+        timer = self.g._timer
+        for i in range(5):
+            self.clock.advance(1)
+            self.g.add('m{}'.format(i + 2))
+        self.assertIs(self.g._timer, timer)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        # timer fires at 10 and is rescheduled for the deadline at 15
+        self.clock.advance(5)
+        self.assertFalse(self.g.settled)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 15)
+        self.clock.advance(4.9)
+        self.assertFalse(self.g.settled)
+        self.clock.advance(0.1)
+        self._check_settled(6)
+
+    def test_max_settle(self):
+        """
+        Group settles `max_settle` seconds after it started settling even if there is activity
+        all this while
+        """
+        self.g.max_settle = 25
+        for i in range(30):
+            self.g.add('m{}'.format(i))
+            self.clock.advance(1)
+            if self.g.settled:
+                break
+        self.assertEqual(self.clock.seconds(), 25)
+        self._check_settled(25)
+        # starts counting afresh when settling again
+        self.g.add('n')
+        self.clock.advance(10)
+        self._check_settled(26)
+
+    def test_log_transition(self):
+        """
+        Starting to settle is logged once and not on every activity
+        """
+        events = []
+        self.g._log = Logger(observer=events.append)
+        self.g.add('m1')
+        self.g.add('m2')
+        self.g.remove('m1')
+        self.clock.advance(10)
+        self.assertEqual([e['log_format'] for e in events],
+                         ['started settling', 'settled with {n} members'])
 
-def request_with_session(sid, method="GET"):
+
+def request_with_body(body, method="POST"):
+    r = Request(DummyChannel(), False)
+    r.method = method
+    r.content = BytesIO(body)
+    return r
+
+
+def request_with_session(sid, method="GET", args=None, weight=None):
     r = Request(DummyChannel(), False)
     r.method = method
     r.requestHeaders = Headers({'Bloc-Session-ID': [sid]})
+    if weight is not None:
+        r.requestHeaders.setRawHeaders('Bloc-Weight', [weight])
+    r.args = args or {}
     return r
 
 
@@ -134,6 +330,163 @@ class HeartbeatingClientsTests(SynchronousTestCase):
         self.clock.pump([1] * 6)
         self.assertNotIn("c1", self.removed_clients)
 
+    def test_heartbeating_client_stays(self):
+        """
+        Client that keeps heartbeating is never removed even though its original deadline
+        has passed many times
+        """
+        self.c.startService()
+        for _ in range(20):
+            self.c.heartbeat("c1")
+            self.clock.advance(1)
+        self.assertIn("c1", self.c)
+        self.assertEqual(self.removed_clients, set())
+        # the client is due in only one tick
+        self.assertEqual([c for cs in self.c._due.values() for c in cs], ["c1"])
+
+    def test_arrivals(self):
+        """
+        Number of heartbeats in each arrival window is recorded when the window ends including
+        windows without any heartbeat within the timeout
+        """
+        for client in ["c1", "c2", "c3"]:
+            self.c.heartbeat(client)
+        self.clock.advance(0.35)
+        self.c.heartbeat("c1")
+        self.assertEqual(self.c.arrivals.count, 3)
+        self.assertEqual(self.c.arrivals.sum, 3)
+        self.assertEqual(self.c.arrivals.samples()[:2],
+                         [("_bucket", {"le": "0"}, 2), ("_bucket", {"le": "1"}, 2)])
+        # Long idle time is counted only for a timeout
+        self.clock.advance(100)
+        self.c.heartbeat("c1")
+        self.assertEqual(self.c.arrivals.count, 54)
+
+    def test_client_timeout(self):
+        """
+        Client heartbeated with its own timeout is removed after that timeout
+        """
+        self.c.startService()
+        self.c.heartbeat("short", 2)
+        self.c.heartbeat("long", 8)
+        self.c.heartbeat("default")
+        self.clock.pump([1] * 3)
+        self.assertEqual(self.removed_clients, set(["short"]))
+        self.clock.pump([1] * 3)
+        self.assertEqual(self.removed_clients, set(["short", "default"]))
+        self.clock.pump([1] * 3)
+        self.assertEqual(self.removed_clients, set(["short", "default", "long"]))
+
+    def test_detector(self):
+        """
+        Client with regular heartbeats is removed once the detector suspects it which is well
+        before the timeout. The detector forgets removed clients.
+        """
+        detector = PhiAccrualDetector(threshold=3, min_std=0.1, min_samples=2)
+        self.c.detector = detector
+        self.c.startService()
+        for _ in range(8):
+            self.c.heartbeat("regular")
+            self.clock.advance(1)
+        # suspected about 1.3 seconds after last heartbeat at 7 and removed in next check
+        self.clock.advance(0.9)
+        self.assertEqual(self.removed_clients, set())
+        self.clock.advance(0.1)
+        self.assertEqual(self.removed_clients, set(["regular"]))
+        self.assertEqual(len(detector), 0)
+
+    def test_due(self):
+        """
+        Heartbeats move clients to the set of their new deadline's tick and checks leave alone
+        the clients whose tick has not started
+        """
+        self.c.startService()
+        self.c.heartbeat("c1")
+        self.c.heartbeat("c2")
+        self.assertEqual(self.c._due, {5: set(["c1", "c2"])})
+        self.clock.advance(2.5)
+        self.c.heartbeat("c2")
+        self.assertEqual(self.c._due, {5: set(["c1"]), 8: set(["c2"])})
+        self.clock.advance(2)
+        self.assertEqual(self.c._due, {5: set(["c1"]), 8: set(["c2"])})
+        self.clock.advance(1)
+        self.assertEqual(self.removed_clients, set(["c1"]))
+        self.assertEqual(self.c._due, {8: set(["c2"])})
+
+    def test_detector_not_detected(self):
+        """
+        Heartbeats not given to the detector keep the client for the timeout
+        """
+        self.c.detector = PhiAccrualDetector(threshold=3, min_std=0.1, min_samples=2)
+        self.c.startService()
+        for _ in range(8):
+            self.c.heartbeat("c")
+            self.clock.advance(1)
+        self.c.heartbeat("c", detect=False)
+        self.clock.pump([1] * 5)
+        self.assertIn("c", self.c)
+        self.clock.advance(1)
+        self.assertNotIn("c", self.c)
+
+    def test_detector_remove(self):
+        """
+        Removed client is removed from the detector
+        """
+        self.c.detector = PhiAccrualDetector()
+        self.c.heartbeat("c1")
+        self.c.remove("c1")
+        self.assertEqual(len(self.c.detector), 0)
+
+    def test_readd_after_remove(self):
+        """
+        Client removed and added again is timed out based on its latest heartbeat and
+        does not leave duplicate deadlines behind
+        """
+        self.c.startService()
+        self.c.heartbeat("c1")
+        self.clock.advance(3)
+        self.c.remove("c1")
+        self.c.heartbeat("c1")
+        self.assertEqual(self.c._client_ticks, {"c1": 8})
+        self.clock.pump([1] * 5)
+        self.assertIn("c1", self.c)
+        self.clock.pump([1] * 2)
+        self.assertNotIn("c1", self.c)
+        self.assertEqual(self.removed_clients, set(["c1"]))
+        self.assertEqual(self.c._client_ticks, {})
+
+    def test_check_only_expired(self):
+        """
+        Checking clients only looks at the clients whose deadline has passed
+        """
+        self.c.startService()
+        for i in range(100):
+            self.c.heartbeat("c{}".format(i))
+        self.clock.advance(3)
+        self.c.heartbeat("late")
+        self.clock.advance(2.5)
+        self.assertEqual(len(self.removed_clients), 100)
+        self.assertNotIn("late", self.removed_clients)
+        self.assertEqual(list(self.c._client_ticks), ["late"])
+
+    def test_metrics(self):
+        """
+        Heartbeats, additions, removals, timeouts and check durations are recorded
+        """
+        times = iter(range(100))
+        self.c._walltime = lambda: next(times)
+        self.c.startService()
+        self.c.heartbeat("c1")
+        self.c.heartbeat("c2")
+        self.c.heartbeat("c1")
+        self.c.remove("c2")
+        self.clock.pump([1] * 6)
+        self.assertEqual(
+            (self.c.heartbeats, self.c.added, self.c.removed, self.c.timeouts), (3, 2, 1, 1))
+        # checked at 0 (on start) and every second after that, each taking 1 "second"
+        self.assertEqual(self.c.check_durations.count, 7)
+        self.assertEqual(self.c.check_durations.sum, 7)
+
 
 class BlocTests(SynchronousTestCase):
     """
@@ -165,7 +518,242 @@ class BlocTests(SynchronousTestCase):
         r = self.b.get_index(request_with_session('s'))
         self.assertEqual(
             json.loads(r.decode("utf-8")),
-            {'status': 'SETTLED', 'index': 1, 'total': 1})
+            {'status': 'SETTLED', 'index': 1, 'total': 1, 'generation': 1})
+
+    def test_get_index_settled_cached(self):
+        """
+        SETTLED response is encoded once per settle and returned from cache after that. It is
+        encoded again after the group settles again
+        """
+        self.test_get_index_settled()
+        r1 = self.b.get_index(request_with_session('s'))
+        r2 = self.b.get_index(request_with_session('s'))
+        self.assertIs(r1, r2)
+        # another member joins and group settles again
+        self.b.get_index(request_with_session('s2'))
+        for i in range(4):
+            self.b.get_index(request_with_session('s'))
+            self.b.get_index(request_with_session('s2'))
+            self.clock.pump([1] * 3)
+        r3 = self.b.get_index(request_with_session('s'))
+        self.assertEqual(json.loads(r3.decode("utf-8"))['total'], 2)
+
+    def test_wait_changed(self):
+        """
+        `get_index` with `wait` returns immediately if group has settled with different
+        generation
+        """
+        self.test_get_index_settled()
+        r = self.b.get_index(request_with_session('s', args={b'wait': [b'0']}))
+        self.assertEqual(json.loads(r.decode("utf-8"))['generation'], 1)
+
+    def test_wait_settled(self):
+        """
+        `get_index` with `wait` of current generation is held until the group starts settling
+        """
+        self.test_get_index_settled()
+        d = self.b.get_index(
+            request_with_session('s', args={b'wait': [b'1'], b'timeout': [b'2']}))
+        self.assertNoResult(d)
+        self.b.get_index(request_with_session('s2'))
+        self.assertEqual(json.loads(self.successResultOf(d).decode("utf-8")),
+                         {'status': 'SETTLING'})
+
+    def test_wait_settling(self):
+        """
+        `get_index` with `wait` when group is settling is held until the group settles
+        """
+        d = self.b.get_index(
+            request_with_session('s', args={b'wait': [b'0'], b'timeout': [b'20']}))
+        self.assertNoResult(d)
+        # request is held for at most heartbeat timeout
+        self.clock.advance(3)
+        self.assertEqual(self.successResultOf(d), b'{"status": "SETTLING"}')
+        d = self.b.get_index(request_with_session('s', args={b'wait': [b'0']}))
+        self.clock.advance(3)
+        d = self.b.get_index(request_with_session('s', args={b'wait': [b'0']}))
+        self.clock.advance(3)
+        d = self.b.get_index(request_with_session('s', args={b'wait': [b'0']}))
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertEqual(
+            json.loads(self.successResultOf(d).decode("utf-8")),
+            {'status': 'SETTLED', 'index': 1, 'total': 1, 'generation': 1})
+        # Client remained alive throughout
+        self.assertIn('s', self.b._clients)
+
+    def test_wait_timeout(self):
+        """
+        `get_index` with `wait` returns current state after given timeout and heartbeats
+        the client again
+        """
+        self.test_get_index_settled()
+        d = self.b.get_index(
+            request_with_session('s', args={b'wait': [b'1'], b'timeout': [b'2']}))
+        self.clock.advance(2)
+        self.assertEqual(json.loads(self.successResultOf(d).decode("utf-8"))['generation'], 1)
+        self.clock.advance(2)
+        self.assertIn('s', self.b._clients)
+
+    def test_wait_invalid(self):
+        """
+        `get_index` with invalid `wait` or with `timeout` that is not a finite number of seconds
+        returns 400 without heartbeating the client
+        """
+        for args in [{b'wait': [b'bad']},
+                     {b'wait': [b'1'], b'timeout': [b'bad']},
+                     {b'wait': [b'1'], b'timeout': [b'-1']},
+                     {b'wait': [b'1'], b'timeout': [b'nan']},
+                     {b'wait': [b'1'], b'timeout': [b'inf']}]:
+            request = request_with_session('s', args=args)
+            self.assertEqual(self.b.get_index(request), b'{}')
+            self.assertEqual(request.code, 400)
+        self.assertNotIn('s', self.b._clients)
+        self.assertNotIn('s', self.b._group)
+
+    def test_heartbeats(self):
+        """
+        `heartbeats` heartbeats all given sessions and returns index response of each
+        """
+        r = self.b.heartbeats(request_with_body(b'["s1", "s2"]'))
+        self.assertEqual(json.loads(r.decode("utf-8")),
+                         {"s1": {"status": "SETTLING"}, "s2": {"status": "SETTLING"}})
+        self.assertIn('s1', self.b._clients)
+        self.assertIn('s2', self.b._group)
+        self.clock.advance(2)
+        self.b.heartbeats(request_with_body(b'["s1", "s2"]'))
+        self.clock.advance(2)
+        self.b.heartbeats(request_with_body(b'["s1", "s2"]'))
+        self.clock.advance(2)
+        self.b.heartbeats(request_with_body(b'["s1", "s2"]'))
+        self.clock.advance(2)
+        self.b.heartbeats(request_with_body(b'["s1", "s2"]'))
+        self.clock.advance(2)
+        r = self.b.heartbeats(request_with_body(b'["s1", "s2"]'))
+        self.assertEqual(
+            json.loads(r.decode("utf-8")),
+            {"s1": {"status": "SETTLED", "index": 1, "total": 2, "generation": 1},
+             "s2": {"status": "SETTLED", "index": 2, "total": 2, "generation": 1}})
+
+    def test_heartbeats_invalid(self):
+        """
+        `heartbeats` returns 400 if body is not JSON list of session ids
+        """
+        for body in [b'bad', b'{"s1": 2}', b'["s1", 2]']:
+            request = request_with_body(body)
+            self.assertEqual(self.b.heartbeats(request), b'{}')
+            self.assertEqual(request.code, 400)
+        self.assertEqual(len(self.b._group), 0)
+
+    def test_buckets(self):
+        """
+        When created with buckets, SETTLED response contains buckets of the member which remain
+        with it across settles
+        """
+        b = Bloc(self.clock, 3, 10, buckets=5)
+        b.startService()
+
+        def settle(sessions):
+            for _ in range(5):
+                for s in sessions:
+                    b.get_index(request_with_session(s))
+                self.clock.pump([1] * 3)
+            return dict(
+                (s, json.loads(b.get_index(request_with_session(s)).decode("utf-8"))["buckets"])
+                for s in sessions)
+
+        first = settle(["s1", "s2"])
+        self.assertEqual(sorted(first["s1"] + first["s2"]), [0, 1, 2, 3, 4])
+        second = settle(["s1", "s2", "s3"])
+        self.assertEqual(sorted(sum(second.values(), [])), [0, 1, 2, 3, 4])
+        self.assertTrue(set(second["s1"]) <= set(first["s1"]))
+        self.assertTrue(set(second["s2"]) <= set(first["s2"]))
+
+    def test_members(self):
+        """
+        `get_members` returns sorted members with generation when settled and SETTLING otherwise.
+        The response is cached until next settle
+        """
+        self.b.get_index(request_with_session('s2'))
+        self.b.get_index(request_with_session('s1'))
+        self.assertEqual(self.b.get_members(request_with_session('s1')), SETTLING_RESPONSE)
+        for _ in range(5):
+            self.clock.pump([1] * 2)
+            self.b.get_index(request_with_session('s2'))
+            self.b.get_index(request_with_session('s1'))
+        r = self.b.get_members(request_with_session('s1'))
+        self.assertEqual(json.loads(r.decode("utf-8")),
+                         {"status": "SETTLED", "generation": 1, "members": ["s1", "s2"]})
+        self.assertIs(self.b.get_members(request_with_session('s1')), r)
+
+    def members_since(self, since):
+        request = request_with_session('s1', args={b'since': [since]})
+        return json.loads(self.b.get_members(request).decode("utf-8"))
+
+    def settle(self, sessions):
+        for _ in range(8):
+            for s in sessions:
+                self.b.get_index(request_with_session(s))
+            self.clock.pump([1] * 2)
+
+    def test_members_since(self):
+        """
+        `get_members` with ``since`` returns only the members added and removed since that
+        generation. Members added and removed in between are in "removed" and members removed
+        and added again are in "added".
+        """
+        self.settle(['s1', 's2'])
+        self.assertEqual(self.members_since(b'1'),
+                         {'status': 'SETTLED', 'generation': 1, 'since': 1,
+                          'added': [], 'removed': []})
+        self.settle(['s1', 's3'])
+        self.settle(['s1', 's4'])
+        self.assertEqual(self.members_since(b'1'),
+                         {'status': 'SETTLED', 'generation': 3, 'since': 1,
+                          'added': ['s4'], 'removed': ['s2', 's3']})
+        self.assertEqual(self.members_since(b'2'),
+                         {'status': 'SETTLED', 'generation': 3, 'since': 2,
+                          'added': ['s4'], 'removed': ['s3']})
+        r = self.b.get_members(request_with_session('s1', args={b'since': [b'2']}))
+        self.assertIs(self.b.get_members(request_with_session('s1', args={b'since': [b'2']})), r)
+
+    def test_members_since_unknown(self):
+        """
+        `get_members` with generation that is not known or is older than `MEMBERS_HISTORY`
+        generations returns all members. Bad generation is rejected.
+        """
+        self.settle(['s1'])
+        for sessions in [['s1', 's2'], ['s1']] * (MEMBERS_HISTORY // 2):
+            self.settle(sessions)
+        self.assertEqual(self.b._group.generation, MEMBERS_HISTORY + 1)
+        self.assertEqual(self.members_since(b'1')['added'], [])
+        for since in [b'0', b'40', b'-1']:
+            self.assertEqual(self.members_since(since),
+                             {'status': 'SETTLED', 'generation': MEMBERS_HISTORY + 1,
+                              'members': ['s1']})
+        self.settle(['s1', 's2'])
+        self.assertIn('members', self.members_since(b'1'))
+        self.assertEqual(self.members_since(b'2')['added'], ['s2'])
+        request = request_with_session('s1', args={b'since': [b'bad']})
+        self.assertEqual(self.b.get_members(request), b'{}')
+        self.assertEqual(request.code, 400)
+
+    def test_metrics(self):
+        """
+        `metrics` returns server metrics in Prometheus text format
+        """
+        self.b.get_index(request_with_session('s'))
+        request = request_with_session('s')
+        lines = self.b.metrics(request).decode("utf-8").splitlines()
+        self.assertEqual(request.responseHeaders.getRawHeaders('Content-Type'),
+                         ['text/plain; version=0.0.4'])
+        for line in ["bloc_heartbeats_total 1", "bloc_sessions_added_total 1",
+                     "bloc_members 1", "bloc_settled 0", "bloc_settle_resets_total 1",
+                     "bloc_settles_total 0", "bloc_settling_seconds_total 0.0",
+                     "bloc_session_timeouts_total 0", "bloc_sessions_removed_total 0",
+                     'bloc_heartbeat_check_seconds_count 1',
+                     'bloc_heartbeat_arrivals_count 0']:
+            self.assertIn(line, lines)
 
     def test_disconnect(self):
         """
@@ -177,6 +765,28 @@ class BlocTests(SynchronousTestCase):
         self.assertNotIn('new', self.b._group)
         self.assertNotIn('new', self.b._clients)
 
+    def test_disconnect_unknown(self):
+        """
+        Disconnecting unknown session does nothing
+        """
+        r = self.b.cancel_session(request_with_session("unknown", "DELETE"))
+        self.assertEqual(r.decode("utf-8"), "{}")
+
+    def test_detector_long_poll(self):
+        """
+        Long polls are not given to the detector so a client held open after regular
+        heartbeats is not removed while it waits
+        """
+        b = Bloc(self.clock, 10, 2, detector=PhiAccrualDetector(8))
+        b.startService()
+        for _ in range(10):
+            b.get_index(request_with_session('a'))
+            self.clock.advance(1)
+        d = b.get_index(request_with_session('a', args={b'wait': [b'1'], b'timeout': [b'10']}))
+        self.clock.pump([1] * 10)
+        self.assertIn('a', b._group)
+        self.assertEqual(json.loads(self.successResultOf(d).decode("utf-8"))['generation'], 1)
+
     def test_timeout_removed(self):
         """
         On timeout HeartbeatingClients removes client from SettlingGroup
@@ -185,3 +795,509 @@ class BlocTests(SynchronousTestCase):
         self.clock.pump([1] * 4)
         self.assertNotIn("s", self.b._group)
         self.assertNotIn("s", self.b._clients)
+
+
+class NamedGroupsTests(SynchronousTestCase):
+    """
+    Tests for named groups hosted by :obj:`Bloc`
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.b = Bloc(self.clock, 3, 10, groups={"fast": (2, 4)})
+        self.b.startService()
+
+    def index(self, sid, name, args=None):
+        r = self.b.get_group_index(request_with_session(sid, args=args), name)
+        return json.loads(r.decode("utf-8"))
+
+    def test_lazy_creation(self):
+        """
+        Named group is created on first heartbeat and is separate from the default group
+        """
+        self.assertEqual(self.index('s', 'g1'), {'status': 'SETTLING'})
+        self.assertIn('g1', self.b._groups)
+        self.assertIn(('g1', 's'), self.b._clients)
+        self.assertNotIn('s', self.b._group)
+        self.assertNotIn('s', self.b._clients)
+
+    def test_settles_independently(self):
+        """
+        Each group settles with its own members and settle time
+        """
+        self.b.get_index(request_with_session('d'))
+        for _ in range(3):
+            self.index('s1', 'fast')
+            self.index('s2', 'fast')
+            self.index('s1', 'g1')
+            self.b.get_index(request_with_session('d'))
+            self.clock.pump([1] * 2)
+        self.assertEqual(self.index('s2', 'fast'),
+                         {'status': 'SETTLED', 'index': 2, 'total': 2, 'generation': 1})
+        # Default settle time is yet to pass for other groups
+        self.assertEqual(self.index('s1', 'g1'), {'status': 'SETTLING'})
+        self.assertFalse(self.b._group.settled)
+        self.assertIn('s1', self.b._groups['fast'].group)
+
+    def test_group_timeout(self):
+        """
+        Members of a group are removed after the group's timeout. The group is discarded when
+        its last member leaves
+        """
+        self.index('s', 'fast')
+        self.index('s', 'g1')
+        self.clock.pump([1] * 3)
+        self.assertNotIn('fast', self.b._groups)
+        self.assertIn('s', self.b._groups['g1'].group)
+        self.clock.pump([1] * 2)
+        self.assertEqual(self.b._groups, {})
+
+    def test_wait_for_any_change(self):
+        """
+        :func:`Bloc.wait_for_any_change` fires when any group settles or starts settling,
+        including a named group being discarded. Discarded groups are no longer watched.
+        """
+        d = self.b.wait_for_any_change()
+        self.index('s', 'fast')
+        self.assertNoResult(d)
+        for _ in range(4):
+            self.clock.advance(1)
+            self.index('s', 'fast')
+        self.assertIsNone(self.successResultOf(d))
+        group = self.b._groups['fast'].group
+        d = self.b.wait_for_any_change()
+        self.b.cancel_group_session(request_with_session('s', 'DELETE'), 'fast')
+        self.assertIsNone(self.successResultOf(d))
+        self.assertEqual(group._waiters, set())
+        d = self.b.wait_for_any_change()
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(self.b._waiters, set())
+
+    def test_recreated_generation(self):
+        """
+        A discarded group created again continues from the highest generation of discarded
+        groups, also after restoring from snapshot. Other named groups start from it too.
+        """
+        for expected in [1, 2]:
+            for _ in range(5):
+                self.index('s', 'fast')
+                self.clock.advance(1)
+            self.assertEqual(self.index('s', 'fast')['generation'], expected)
+            self.b.cancel_group_session(request_with_session('s', 'DELETE'), 'fast')
+            self.assertNotIn('fast', self.b._groups)
+        b = Bloc(self.clock, 3, 10, groups={"fast": (2, 4)})
+        b.restore(json.loads(json.dumps(self.b.snapshot())))
+        b.heartbeat('s', 'fast')
+        self.assertEqual(b._groups['fast'].group.generation, 2)
+        self.index('s', 'g1')
+        self.assertEqual(self.b._groups['g1'].group.generation, 2)
+
+    def test_cancel(self):
+        """
+        Deleting session of a named group removes it from that group only and discards the
+        group if it becomes empty
+        """
+        self.index('s', 'g1')
+        self.index('s2', 'g1')
+        self.b.get_index(request_with_session('s'))
+        self.b.cancel_group_session(request_with_session('s', 'DELETE'), 'g1')
+        self.assertNotIn('s', self.b._groups['g1'].group)
+        self.assertNotIn(('g1', 's'), self.b._clients)
+        self.assertIn('s', self.b._group)
+        self.b.cancel_group_session(request_with_session('s2', 'DELETE'), 'g1')
+        self.assertEqual(self.b._groups, {})
+        # unknown group
+        r = self.b.cancel_group_session(request_with_session('s', 'DELETE'), 'g2')
+        self.assertEqual(r, b'{}')
+
+    def test_wait(self):
+        """
+        Long poll on a named group is held until that group changes for at most the group's
+        timeout
+        """
+        d = self.b.get_group_index(
+            request_with_session('s', args={b'wait': [b'0'], b'timeout': [b'20']}), 'fast')
+        self.assertNoResult(d)
+        self.clock.advance(2)
+        self.assertEqual(self.successResultOf(d), SETTLING_RESPONSE)
+        self.assertIn(('fast', 's'), self.b._clients)
+
+    def test_members(self):
+        """
+        `get_group_members` returns members of the named group
+        """
+        r = self.b.get_group_members(request_with_session('s'), 'fast')
+        self.assertEqual(r, SETTLING_RESPONSE)
+        for _ in range(3):
+            self.index('s', 'fast')
+            self.clock.pump([1] * 2)
+        r = self.b.get_group_members(request_with_session('s'), 'fast')
+        self.assertEqual(json.loads(r.decode("utf-8")),
+                         {'status': 'SETTLED', 'generation': 1, 'members': ['s']})
+        r = self.b.get_group_members(
+            request_with_session('s', args={b'since': [b'1']}), 'fast')
+        self.assertEqual(json.loads(r.decode("utf-8"))['removed'], [])
+
+    def test_shared_timer(self):
+        """
+        All groups are checked by the single heartbeat timer of :obj:`HeartbeatingClients`
+        """
+        for i in range(10):
+            self.index('s', 'g{}'.format(i))
+        self.assertEqual(len(self.b._groups), 10)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 11)
+        self.assertEqual(len(list(self.b)), 1)
+        self.clock.pump([1] * 4)
+        self.assertEqual(self.b._groups, {})
+
+
+class HintsTests(SynchronousTestCase):
+    """
+    Tests for :obj:`Bloc` created with `hints=True`
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.b = Bloc(self.clock, 4, 10, hints=True, groups={"g": (2, 1)})
+        self.b.startService()
+
+    def test_settling(self):
+        """
+        SETTLING response suggests heartbeating after quarter of the timeout
+        """
+        r = self.b.get_index(request_with_session('s'))
+        self.assertEqual(json.loads(r.decode("utf-8")), {'status': 'SETTLING', 'heartbeat': 1})
+
+    def test_settled(self):
+        """
+        SETTLED response suggests heartbeating after three quarters of the smaller of timeout
+        and settle
+        """
+        for _ in range(4):
+            self.b.get_index(request_with_session('s'))
+            self.clock.pump([1] * 3)
+        r = self.b.get_index(request_with_session('s'))
+        self.assertEqual(
+            json.loads(r.decode("utf-8")),
+            {'status': 'SETTLED', 'index': 1, 'total': 1, 'generation': 1, 'heartbeat': 3})
+
+    def test_group(self):
+        """
+        Named group's suggestions are based on its settings
+        """
+        r = self.b.get_group_index(request_with_session('s'), 'g')
+        self.assertEqual(json.loads(r.decode("utf-8"))['heartbeat'], 0.5)
+        self.clock.advance(1)
+        r = self.b.get_group_index(request_with_session('s'), 'g')
+        self.assertEqual(json.loads(r.decode("utf-8"))['heartbeat'], 0.75)
+
+
+class LeaseTests(SynchronousTestCase):
+    """
+    Tests for :obj:`Bloc` created with `leases=True`
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.b = Bloc(self.clock, 4, 3, leases=True, groups={"g": (4, 1)})
+        self.b.startService()
+
+    def test_settled(self):
+        """
+        SETTLED response grants lease for the settle time. SETTLING response does not.
+        """
+        r = self.b.get_index(request_with_session('s'))
+        self.assertEqual(json.loads(r.decode("utf-8")), {'status': 'SETTLING'})
+        self.clock.advance(3)
+        r = self.b.get_index(request_with_session('s'))
+        self.assertEqual(
+            json.loads(r.decode("utf-8")),
+            {'status': 'SETTLED', 'index': 1, 'total': 1, 'generation': 1, 'lease': 3})
+
+    def test_group(self):
+        """
+        Named group's lease is its settle time
+        """
+        self.b.get_group_index(request_with_session('s'), 'g')
+        self.clock.advance(1)
+        r = self.b.get_group_index(request_with_session('s'), 'g')
+        self.assertEqual(json.loads(r.decode("utf-8"))['lease'], 1)
+
+
+class WeightTests(SynchronousTestCase):
+    """
+    Tests for :obj:`Bloc` with clients heartbeating with weights
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.b = Bloc(self.clock, 4, 3)
+        self.b.startService()
+
+    def settle(self, weights):
+        for sid, weight in weights:
+            self.b.get_index(request_with_session(sid, weight=weight))
+        self.clock.advance(3)
+        return dict(
+            (sid, json.loads(
+                self.b.get_index(request_with_session(sid, weight=weight)).decode("utf-8")))
+            for sid, weight in weights)
+
+    def test_unweighted(self):
+        """
+        Response has no weight fields if all members have weight 1
+        """
+        r = self.settle([('s1', None), ('s2', '1')])
+        self.assertEqual(r['s2'], {'status': 'SETTLED', 'index': 2, 'total': 2, 'generation': 1})
+
+    def test_ranges(self):
+        """
+        Members get consecutive ranges of total weight in order of their index
+        """
+        r = self.settle([('s1', '3'), ('s2', None), ('s3', '2')])
+        self.assertEqual(r['s1'], {'status': 'SETTLED', 'index': 1, 'total': 3, 'generation': 1,
+                                   'weight': 3, 'range': [0, 3], 'weight_total': 6})
+        self.assertEqual([(r[s]['weight'], r[s]['range']) for s in ['s2', 's3']],
+                         [(1, [3, 4]), (2, [4, 6])])
+
+    def test_weight_change(self):
+        """
+        Changing weight makes the group settle again
+        """
+        self.settle([('s1', '2'), ('s2', None)])
+        r = self.b.get_index(request_with_session('s2', weight='2'))
+        self.assertEqual(r, SETTLING_RESPONSE)
+        self.clock.advance(3)
+        r = self.settle([('s1', '2'), ('s2', '2')])
+        self.assertEqual(r['s2']['range'], [2, 4])
+        self.assertEqual(r['s2']['generation'], 2)
+
+    def test_buckets(self):
+        """
+        Buckets are spread in proportion to the weights
+        """
+        b = Bloc(self.clock, 4, 3, buckets=8)
+        b.startService()
+        self.b = b
+        r = self.settle([('s1', '3'), ('s2', None)])
+        self.assertEqual((r['s1']['buckets'], r['s2']['buckets']), ([0, 1, 2, 3, 4, 5], [6, 7]))
+
+    def test_members(self):
+        """
+        Members response includes weights if the group is weighted
+        """
+        self.settle([('s1', '3'), ('s2', None)])
+        r = self.b.get_members(request_with_session('s1'))
+        self.assertEqual(json.loads(r.decode("utf-8")),
+                         {'status': 'SETTLED', 'generation': 1, 'members': ['s1', 's2'],
+                          'weights': {'s1': 3, 's2': 1}})
+
+    def test_invalid(self):
+        """
+        Weight that is not an integer from 1 to `MAX_WEIGHT` is rejected with 400
+        """
+        self.b.get_index(request_with_session('s', weight=str(MAX_WEIGHT)))
+        self.assertEqual(self.b._group.weight_of('s'), MAX_WEIGHT)
+        self.b.cancel_session(request_with_session('s', 'DELETE'))
+        for weight in ['0', '-1', 'x', '1.5', str(MAX_WEIGHT + 1), '100000000']:
+            request = request_with_session('s', weight=weight)
+            self.assertEqual(self.b.get_index(request), b'{}')
+            self.assertEqual(request.code, 400)
+        self.assertEqual(len(self.b._group), 0)
+
+    def test_members_since(self):
+        """
+        Members whose weight changed are added with their weight
+        """
+        self.settle([('s1', '3'), ('s2', None)])
+        self.settle([('s1', None), ('s2', '2'), ('s3', None)])
+        r = self.b.get_members(request_with_session('s1', args={b'since': [b'1']}))
+        self.assertEqual(json.loads(r.decode("utf-8")),
+                         {'status': 'SETTLED', 'generation': 2, 'since': 1,
+                          'added': ['s1', 's2', 's3'], 'removed': [],
+                          'weights': {'s1': 1, 's2': 2, 's3': 1}})
+
+    def test_snapshot(self):
+        """
+        Weights are restored from snapshot
+        """
+        self.settle([('s1', '3'), ('s2', None)])
+        b = Bloc(self.clock, 4, 3)
+        b.restore(json.loads(json.dumps(self.b.snapshot())))
+        self.assertEqual(b._group.weight_of('s1'), 3)
+        self.assertTrue(b._group.weighted)
+
+
+class SnapshotTests(SynchronousTestCase):
+    """
+    Tests for :func:`Bloc.snapshot`, :func:`Bloc.restore` and passive :obj:`Bloc`
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.b = Bloc(self.clock, 3, 5, buckets=4, groups={"g": (3, 20)})
+        self.b.startService()
+        for _ in range(3):
+            for session in ['s1', 's2']:
+                self.b.heartbeat(session)
+            self.b.heartbeat('s1', 'g')
+            self.clock.pump([1] * 2)
+
+    def test_snapshot(self):
+        """
+        Snapshot has all groups with members, indexes, generations and buckets
+        """
+        self.b.heartbeat('s1')
+        snapshot = json.loads(json.dumps(self.b.snapshot()))
+        self.assertEqual(
+            snapshot,
+            {"groups": [
+                {"name": None, "settled": True, "generation": 1,
+                 "members": {"s1": 1, "s2": 2}, "buckets": {"s1": [0, 1], "s2": [2, 3]}},
+                {"name": "g", "settled": False, "generation": 0,
+                 "members": {"s1": None}, "buckets": {}}]})
+
+    def test_start_term(self):
+        """
+        After starting a new term settled groups stay the same and all groups, including ones
+        created later, settle next with generations of the new term. Restoring the server's
+        snapshot keeps the term.
+        """
+        expected = self.b.heartbeat('s1')
+        self.b.start_term()
+        self.assertEqual(self.b.heartbeat('s1'), expected)
+        snapshot = json.loads(json.dumps(self.b.snapshot()))
+        for _ in range(5):
+            for session in ['s1', 's3']:
+                self.b.heartbeat(session)
+            self.b.heartbeat('s1', 'h')
+            self.clock.pump([1] * 2)
+        self.assertEqual(self.b._group.generation, TERM_GENERATIONS + 1)
+        self.assertEqual(self.b._groups['h'].group.generation, TERM_GENERATIONS + 1)
+        b = Bloc(self.clock, 3, 5)
+        b.restore(snapshot)
+        b.heartbeat('s3')
+        self.clock.advance(5)
+        self.assertEqual(b._group.generation, TERM_GENERATIONS + 1)
+        b.start_term()
+        self.assertEqual(b._generation, 2 * TERM_GENERATIONS)
+
+    def test_restore(self):
+        """
+        Restored server responds with same indexes and buckets. Its groups that were settling
+        settle again and members get heartbeat timeout from the time of restore.
+        """
+        expected = self.b.heartbeat('s1')
+        snapshot = json.loads(json.dumps(self.b.snapshot()))
+        b = Bloc(self.clock, 3, 5, buckets=4, groups={"g": (3, 20)})
+        b.startService()
+        b.restore(snapshot)
+        self.assertEqual(b.heartbeat('s1'), expected)
+        self.assertIn(('g', 's1'), b._clients)
+        self.assertEqual(b.heartbeat('s1', 'g'), SETTLING_RESPONSE)
+        self.clock.advance(2)
+        self.assertIn('s2', b._group)
+        self.clock.pump([1] * 2)
+        self.assertNotIn('s2', b._group)
+
+    def test_restore_members_history(self):
+        """
+        Membership changes from before restoring are forgotten
+        """
+        snapshot = self.b.snapshot()
+        self.b.heartbeat('s1')
+        snapshot['groups'][0]['generation'] = 2
+        self.b.restore(snapshot)
+        since = request_with_session('s1', args={b'since': [b'1']})
+        self.assertIn('members', json.loads(self.b.get_members(since).decode("utf-8")))
+        since = request_with_session('s1', args={b'since': [b'2']})
+        self.assertEqual(json.loads(self.b.get_members(since).decode("utf-8"))['added'], [])
+
+    def test_passive(self):
+        """
+        Passive server responds with 503 to all client requests
+        """
+        self.b.active = False
+        for handler, args in [(self.b.get_index, ()), (self.b.get_group_index, ('g',)),
+                              (self.b.cancel_session, ()),
+                              (self.b.cancel_group_session, ('g',)),
+                              (self.b.get_members, ()), (self.b.get_group_members, ('g',)),
+                              (self.b.heartbeats, ())]:
+            request = request_with_session('s3')
+            self.assertEqual(json.loads(handler(request, *args).decode("utf-8")),
+                             {"error": "passive standby"})
+            self.assertEqual(request.code, 503)
+        self.assertNotIn('s3', self.b._group)
+
+
+class LeanResourceTests(SynchronousTestCase):
+    """
+    Tests for :obj:`LeanResource`
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.b = Bloc(self.clock, 3, 10)
+        self.b.startService()
+        self.site = Site(LeanResource(self.b))
+
+    def request(self, method, uri, sid='s', weight=None):
+        """
+        Process request through the site and return (code, body) of the response
+        """
+        channel = DummyChannel()
+        channel.site = self.site
+        request = ServerRequest(channel, False)
+        request.gotLength(0)
+        request.requestHeaders.setRawHeaders(b'Bloc-Session-ID', [sid])
+        if weight is not None:
+            request.requestHeaders.setRawHeaders(b'Bloc-Weight', [weight])
+        request.requestReceived(method, uri, b'HTTP/1.1')
+        response = channel.transport.written.getvalue()
+        return request.code, response.partition(b'\r\n\r\n')[2]
+
+    def test_index(self):
+        """
+        ``GET /index`` heartbeats and returns index response
+        """
+        self.assertEqual(self.request(b'GET', b'/index'), (200, SETTLING_RESPONSE))
+        self.assertIn('s', self.b._group)
+        self.assertIn('s', self.b._clients)
+
+    def test_session(self):
+        """
+        ``DELETE /session`` removes the session
+        """
+        self.request(b'GET', b'/index')
+        self.assertEqual(self.request(b'DELETE', b'/session'), (200, b'{}'))
+        self.assertNotIn('s', self.b._group)
+
+    def test_other_requests(self):
+        """
+        Other requests are served by Klein
+        """
+        code, body = self.request(b'GET', b'/members')
+        self.assertEqual(code, 200)
+        self.assertIn(SETTLING_RESPONSE, body)
+        self.request(b'GET', b'/groups/g/index')
+        self.assertIn(('g', 's'), self.b._clients)
+        self.assertEqual(self.request(b'GET', b'/index/more')[0], 404)
+        self.assertEqual(self.request(b'POST', b'/index')[0], 405)
+
+    def test_weight(self):
+        """
+        ``GET /index`` with weight heartbeats with it. Invalid weight is left to Klein.
+        """
+        self.request(b'GET', b'/index', weight=b'2')
+        self.assertEqual(self.b._group.weight_of('s'), 2)
+        self.assertEqual(self.request(b'GET', b'/index', weight=b'0')[0], 400)
+
+    def test_long_poll(self):
+        """
+        ``GET /index`` with arguments is served by Klein
+        """
+        self.assertEqual(self.request(b'GET', b'/index?wait=bad')[0], 400)
+
+    def test_passive(self):
+        """
+        Passive server's responses are served by Klein
+        """
+        self.b.active = False
+        self.assertEqual(self.request(b'GET', b'/index')[0], 503)
+        self.assertEqual(self.request(b'DELETE', b'/session')[0], 503)
+        self.assertNotIn('s', self.b._group)
@@ -0,0 +1,140 @@
+"""
+Tests for :module:`bloc.snapshot`
+"""
+
+import json
+import os
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from bloc.server import Bloc
+from bloc.snapshot import Snapshotter, encode, load, save
+
+
+class FileTests(SynchronousTestCase):
+    """
+    Tests for :func:`save` and :func:`load`
+    """
+
+    def test_save_load(self):
+        """
+        Saved state is loaded back and temporary file is not left behind
+        """
+        path = self.mktemp()
+        save(encode({"a": [1, None]}), path)
+        save(encode({"b": 2}), path)
+        self.assertEqual(load(path), {"b": 2})
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def test_compact(self):
+        """
+        State is encoded without spaces
+        """
+        self.assertEqual(encode({"b": [1, 2], "a": None}), b'{"a":null,"b":[1,2]}')
+
+    def test_load_missing(self):
+        """
+        Loading from file that does not exist returns None
+        """
+        self.assertIsNone(load(self.mktemp()))
+
+
+class SnapshotterTests(SynchronousTestCase):
+    """
+    Tests for :obj:`Snapshotter`
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.path = self.mktemp()
+        self.bloc = Bloc(self.clock, 3, 5)
+        self.bloc.startService()
+
+    def settle(self, bloc, sessions):
+        for _ in range(3):
+            for session in sessions:
+                bloc.heartbeat(session)
+            self.clock.pump([1] * 2)
+
+    def test_saves_periodically(self):
+        """
+        State is saved every interval if it has changed and when stopped
+        """
+        snapshotter = Snapshotter(self.bloc, self.clock, self.path, interval=5)
+        snapshotter.startService()
+        self.assertIsNone(load(self.path))
+        self.clock.advance(5)
+        self.assertEqual(load(self.path), self.bloc.snapshot())
+        os.remove(self.path)
+        self.clock.advance(5)
+        self.assertIsNone(load(self.path))
+        self.clock.advance(4)
+        self.bloc.heartbeat('s1')
+        self.clock.advance(1)
+        self.assertEqual(load(self.path), json.loads(json.dumps(self.bloc.snapshot())))
+        self.bloc.heartbeat('s2')
+        snapshotter.stopService()
+        self.assertIn('s2', load(self.path)['groups'][0]['members'])
+
+    def test_saves_on_change(self):
+        """
+        State is saved as soon as any group settles or starts settling without waiting for
+        the interval
+        """
+        snapshotter = Snapshotter(self.bloc, self.clock, self.path, interval=100)
+        snapshotter.startService()
+        self.settle(self.bloc, ['s1'])
+        self.assertEqual(load(self.path)['groups'][0]['generation'], 1)
+        for _ in range(3):
+            self.bloc.heartbeat('s1')
+            self.bloc.heartbeat('s1', 'g')
+            self.clock.pump([1] * 2)
+        self.assertEqual(load(self.path)['groups'][1]['generation'], 1)
+        self.bloc.heartbeat('s2')
+        self.assertEqual(load(self.path)['groups'][0]['members'], {'s1': 1, 's2': None})
+        snapshotter.stopService()
+        self.bloc.heartbeat('s3')
+        self.clock.advance(5)
+        self.assertNotIn('s3', load(self.path)['groups'][0]['members'])
+
+    def test_restores_on_start(self):
+        """
+        Saved state is restored on start and restored members get grace period to heartbeat
+        """
+        self.settle(self.bloc, ['s1', 's2'])
+        expected = self.bloc.heartbeat('s1')
+        Snapshotter(self.bloc, self.clock, self.path).stopService()
+
+        bloc = Bloc(self.clock, 3, 5)
+        bloc.startService()
+        Snapshotter(bloc, self.clock, self.path, grace=10).startService()
+        self.assertEqual(bloc.heartbeat('s1'), expected)
+        self.clock.pump([1] * 9)
+        bloc.heartbeat('s1')
+        self.assertIn('s2', bloc._group)
+        self.clock.pump([1] * 2)
+        self.assertNotIn('s2', bloc._group)
+
+    def test_passive(self):
+        """
+        Passive server is neither restored nor saved
+        """
+        self.settle(self.bloc, ['s1'])
+        save(encode(self.bloc.snapshot()), self.path)
+        bloc = Bloc(self.clock, 3, 5)
+        bloc.active = False
+        snapshotter = Snapshotter(bloc, self.clock, self.path)
+        snapshotter.startService()
+        self.assertNotIn('s1', bloc._group)
+        bloc.heartbeat('s2')
+        snapshotter.stopService()
+        self.assertEqual(load(self.path)['groups'][0]['members'], {'s1': 1})
+
+    def test_save_error(self):
+        """
+        Error saving the file is logged
+        """
+        snapshotter = Snapshotter(self.bloc, self.clock, os.path.join(self.path, 'missing'))
+        snapshotter.save()
+        self.assertEqual(len(self.flushLoggedErrors(IOError, OSError)), 1)
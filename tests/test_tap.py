@@ -3,10 +3,15 @@ Tests for :module:`tap`
 """
 
 from twisted.application.service import MultiService
+from twisted.python import usage
 from twisted.trial.unittest import SynchronousTestCase
 
 from bloc import tap
-from bloc.server import Bloc
+from bloc.protocol import BlocLineFactory
+from bloc.replication import ReplicationFactory, Standby
+from bloc.server import Bloc, LeanResource
+from bloc.snapshot import Snapshotter
+from bloc.worker import WorkerPool
 
 
 class ServiceTests(SynchronousTestCase):
@@ -29,3 +34,150 @@ class ServiceTests(SynchronousTestCase):
         self.assertIs(site_service.factory.resource._app, bloc.app)
         # Would like to test the listen part of config but not sure how to inspect
         # IStreamServerEndpoint in site_service.endpoint
+
+    def test_line_listen(self):
+        """
+        Line protocol service serving the Bloc object is added if `line-listen` is given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989",
+                             "line-listen": "tcp:8990"})
+        children = list(s)
+        self.assertIsInstance(children[2].factory, BlocLineFactory)
+        self.assertIs(children[2].factory.bloc, children[0])
+
+    def test_buckets(self):
+        """
+        Bloc is created with buckets if given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989",
+                             "buckets": "10"})
+        self.assertEqual(list(s)[0]._buckets, 10)
+
+    def test_sticky(self):
+        """
+        Bloc's group is sticky if `sticky` is given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989", "sticky": 1})
+        self.assertTrue(list(s)[0]._group.sticky)
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989"})
+        self.assertFalse(list(s)[0]._group.sticky)
+
+    def test_hints(self):
+        """
+        Bloc suggests heartbeat delay if `hints` is given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989", "hints": 1})
+        self.assertTrue(list(s)[0]._hints)
+
+    def test_leases(self):
+        """
+        Bloc grants leases if `leases` is given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989", "leases": 1})
+        self.assertTrue(list(s)[0]._default.leases)
+
+    def test_groups(self):
+        """
+        Named group settings given with ``--group`` are passed to Bloc
+        """
+        options = tap.Options()
+        options.parseOptions(["-t", "3", "-s", "4", "--group", "a:1:2", "--group", "b:3.5:6"])
+        self.assertEqual(options["groups"], {"a": (1, 2), "b": (3.5, 6)})
+        s = tap.makeService(options)
+        self.assertEqual(list(s)[0]._group_settings, {"a": (1, 2), "b": (3.5, 6)})
+
+    def test_invalid_group(self):
+        """
+        ``--group`` not in name:timeout:settle form is rejected
+        """
+        for value in ["a:1", "a:1:b"]:
+            self.assertRaises(usage.UsageError, tap.Options().parseOptions, ["--group", value])
+
+    def test_replication_listen(self):
+        """
+        Replication listener service is added if `replication-listen` is given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989",
+                             "replication-listen": "tcp:8991"})
+        children = list(s)
+        self.assertIsInstance(children[2].factory, ReplicationFactory)
+        self.assertIs(children[2].factory.bloc, children[0])
+        self.assertEqual(len(children), 3)
+
+    def test_standby_of(self):
+        """
+        Bloc is made passive standby of the primary if `standby-of` is given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989",
+                             "standby-of": "tcp:primary:8991", "takeover": 5})
+        children = list(s)
+        self.assertIsInstance(children[2], Standby)
+        self.assertFalse(children[0].active)
+        self.assertEqual(children[2]._takeover, 5)
+
+    def test_snapshot(self):
+        """
+        Snapshotter is added right after Bloc if `snapshot` is given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989",
+                             "snapshot": "/tmp/bloc.json", "snapshot-interval": 2,
+                             "grace": "10"})
+        snapshotter = list(s)[1]
+        self.assertIsInstance(snapshotter, Snapshotter)
+        self.assertIs(snapshotter.bloc, list(s)[0])
+        self.assertEqual((snapshotter.path, snapshotter.interval, snapshotter.grace),
+                         ("/tmp/bloc.json", 2, 10))
+
+    def test_lean(self):
+        """
+        Site serves :obj:`LeanResource` if `lean` is given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989", "lean": 1})
+        self.assertIsInstance(list(s)[1].factory.resource, LeanResource)
+
+    def test_workers(self):
+        """
+        Worker pool serving the site is added instead of the listener if `workers` is given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989", "workers": 4,
+                             "lean": 1})
+        pool = list(s)[1]
+        self.assertIsInstance(pool, WorkerPool)
+        self.assertEqual((pool._address, pool._count), ((8989, '', 50), 4))
+        self.assertIsInstance(pool._site.resource, LeanResource)
+
+    def test_workers_need_tcp(self):
+        """
+        ``--workers`` is rejected if listen endpoint is not TCP
+        """
+        self.assertRaises(usage.UsageError, tap.Options().parseOptions,
+                          ["--workers", "2", "--listen", "unix:/tmp/bloc.sock"])
+
+    def test_max_settle(self):
+        """
+        Groups get `max-settle` if given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989",
+                             "max-settle": "20"})
+        self.assertEqual(list(s)[0]._group.max_settle, 20)
+
+    def test_max_settle_less_than_settle(self):
+        """
+        ``--max-settle`` less than ``--settle`` is rejected
+        """
+        self.assertRaises(usage.UsageError, tap.Options().parseOptions,
+                          ["-s", "10", "--max-settle", "5"])
+
+    def test_phi(self):
+        """
+        Bloc uses phi accrual detector if `phi` is given
+        """
+        s = tap.makeService({"timeout": "3", "settle": "4", "listen": "tcp:8989", "phi": "6"})
+        self.assertEqual(list(s)[0]._clients.detector.threshold, 6)
+
+    def test_invalid_phi(self):
+        """
+        ``--phi`` must be positive and cannot be used with ``--hints``
+        """
+        for args in [["--phi", "0"], ["--phi", "8", "--hints"]]:
+            self.assertRaises(usage.UsageError, tap.Options().parseOptions, args)
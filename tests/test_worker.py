@@ -0,0 +1,261 @@
+"""
+Tests for :module:`bloc.worker`
+"""
+
+import json
+import sys
+
+from twisted.internet.defer import succeed
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransport
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.resource import Resource
+from twisted.web.server import Request, Site
+from twisted.web.test.requesthelper import DummyChannel
+
+from bloc.server import SETTLING_RESPONSE, Bloc
+from bloc.worker import Replica, WorkerPool, WorkerResource, parse_listen
+
+
+class ParseListenTests(SynchronousTestCase):
+    """
+    Tests for :func:`parse_listen`
+    """
+
+    def test_port(self):
+        self.assertEqual(parse_listen('tcp:8989'), (8989, '', 50))
+
+    def test_parameters(self):
+        self.assertEqual(parse_listen('tcp:port=80:interface=127.0.0.1:backlog=5'),
+                         (80, '127.0.0.1', 5))
+
+    def test_not_tcp(self):
+        self.assertRaises(ValueError, parse_listen, 'unix:/tmp/bloc.sock')
+        self.assertRaises(ValueError, parse_listen, 'tcp')
+        self.assertRaises(ValueError, parse_listen, 'tcp:80:ssl=1')
+
+
+class Process(object):
+    """
+    Process transport given to the protocol spawned by :obj:`Reactor`
+    """
+
+    def __init__(self):
+        self.written = []
+        self.stdin_closed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def closeStdin(self):
+        self.stdin_closed = True
+
+
+class Reactor(MemoryReactorClock):
+    """
+    Memory reactor that records spawned processes
+    """
+
+    def __init__(self):
+        MemoryReactorClock.__init__(self)
+        self.processes = []
+
+    def spawnProcess(self, protocol, executable, args, env=None, childFDs=None):
+        self.processes.append((protocol, args, childFDs))
+        protocol.makeConnection(Process())
+
+    def listenTCP(self, port, factory, backlog=50, interface=''):
+        listener = MemoryReactorClock.listenTCP(self, port, factory, backlog, interface)
+        listener.stopListening = lambda: succeed(None)
+        return listener
+
+
+class WorkerPoolTests(SynchronousTestCase):
+    """
+    Tests for :obj:`WorkerPool`
+    """
+
+    def setUp(self):
+        self.reactor = Reactor()
+        self.bloc = Bloc(self.reactor, 10, 2)
+        self.bloc.startService()
+        self.site = Site(Resource())
+        self.pool = WorkerPool(self.bloc, self.reactor, 'tcp:0:interface=127.0.0.1', 2, self.site)
+        self.pool.startService()
+        self.addCleanup(lambda: self.pool.running and self.pool.stopService())
+
+    def states(self, protocol):
+        return [json.loads(line.decode("utf-8"))
+                for line in b''.join(protocol.transport.written).splitlines()]
+
+    def test_start(self):
+        """
+        Starts workers sharing the listening socket and serves the site on localhost
+        """
+        self.assertEqual(len(self.reactor.processes), 2)
+        _, args, fds = self.reactor.processes[0]
+        self.assertEqual(args[:3], [sys.executable, '-m', 'bloc.worker'])
+        self.assertEqual(fds[3], self.pool._socket.fileno())
+        port, site, _, interface = self.reactor.tcpServers[0]
+        self.assertEqual((site, interface), (self.site, '127.0.0.1'))
+        self.assertEqual(args[5], str(self.pool._backend.getHost().port))
+
+    def test_events(self):
+        """
+        Heartbeats and removals from workers are done on the server
+        """
+        protocol = self.reactor.processes[0][0]
+        protocol.childDataReceived(1, b'H s1\nH s')
+        self.assertEqual(self.bloc._group.members(), ['s1'])
+        protocol.childDataReceived(1, b'2\nD s1\n')
+        self.assertEqual(self.bloc._group.members(), ['s2'])
+        self.assertIn('s2', self.bloc._clients)
+        protocol.childDataReceived(1, b'W 3 s2\n')
+        self.assertEqual(self.bloc._group.weight_of('s2'), 3)
+
+    def test_push(self):
+        """
+        Responses are sent to all workers when the group settles and when it starts settling
+        again. New workers get the last responses.
+        """
+        protocol = self.reactor.processes[0][0]
+        self.assertEqual(self.states(protocol),
+                         [{'active': True, 'settling': SETTLING_RESPONSE.decode("utf-8")}])
+        protocol.childDataReceived(1, b'H s1\n')
+        self.reactor.advance(2)
+        self.assertEqual(self.states(protocol)[-1]['settled'],
+                         {'s1': self.bloc.heartbeat('s1').decode("utf-8")})
+        protocol.childDataReceived(1, b'H s2\n')
+        self.assertNotIn('settled', self.states(protocol)[-1])
+        self.assertEqual(len(self.states(protocol)), 3)
+        # new worker
+        self.pool._spawn()
+        self.assertEqual(self.states(self.reactor.processes[-1][0]), self.states(protocol)[-1:])
+
+    def test_push_active(self):
+        """
+        Responses are sent within a second after the server becomes active
+        """
+        self.bloc.active = False
+        self.reactor.advance(1)
+        protocol = self.reactor.processes[0][0]
+        self.assertFalse(self.states(protocol)[-1]['active'])
+        self.reactor.advance(1)
+        self.assertEqual(len(self.states(protocol)), 2)
+
+    def test_respawn(self):
+        """
+        A worker that exits is started again after a second
+        """
+        protocol = self.reactor.processes[0][0]
+        protocol.processEnded(Failure(Exception('boom')))
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.processes), 3)
+        self.assertEqual(len(self.pool._workers), 2)
+
+    def test_stop(self):
+        """
+        Stopping closes workers' stdin and fires when all of them have exited
+        """
+        d = self.pool.stopService()
+        self.assertNoResult(d)
+        for protocol, _, _ in self.reactor.processes:
+            self.assertTrue(protocol.transport.stdin_closed)
+            protocol.processEnded(Failure(Exception('done')))
+        self.successResultOf(d)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.processes), 2)
+
+
+class Proxy(Resource):
+    """
+    Resource recording requests passed on to it
+    """
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.paths = []
+
+    def getChild(self, name, request):
+        return self
+
+    def render(self, request):
+        self.paths.append(request.path)
+        return b'proxied'
+
+
+class WorkerResourceTests(SynchronousTestCase):
+    """
+    Tests for :obj:`Replica` and :obj:`WorkerResource`
+    """
+
+    def setUp(self):
+        self.replica = Replica()
+        self.transport = StringTransport()
+        self.replica.makeConnection(self.transport)
+        self.replica.dataReceived(json.dumps(
+            {'active': True, 'settling': 'settling',
+             'settled': {'s1': 'settled s1'}}).encode("utf-8") + b'\n')
+        self.proxy = Proxy()
+        self.site = Site(WorkerResource(self.replica, self.proxy))
+
+    def request(self, method, uri, sid='s1', weight=None):
+        channel = DummyChannel()
+        channel.site = self.site
+        request = Request(channel, False)
+        request.gotLength(0)
+        if sid is not None:
+            request.requestHeaders.setRawHeaders(b'Bloc-Session-ID', [sid])
+        if weight is not None:
+            request.requestHeaders.setRawHeaders(b'Bloc-Weight', [weight])
+        request.requestReceived(method, uri, b'HTTP/1.1')
+        return channel.transport.written.getvalue().partition(b'\r\n\r\n')[2]
+
+    def test_heartbeat(self):
+        """
+        ``GET /index`` is answered from the replica and the heartbeat is forwarded
+        """
+        self.assertEqual(self.request(b'GET', b'/index'), b'settled s1')
+        self.assertEqual(self.request(b'GET', b'/index', 's2'), b'settling')
+        self.assertEqual(self.transport.value(), b'H s1\nH s2\n')
+        self.assertEqual(self.proxy.paths, [])
+
+    def test_weight(self):
+        """
+        Weight is forwarded with the heartbeat. Invalid weight is proxied.
+        """
+        self.assertEqual(self.request(b'GET', b'/index', weight=b'2'), b'settled s1')
+        self.request(b'GET', b'/index', weight=b'bad')
+        self.assertEqual(self.transport.value(), b'W 2 s1\n')
+        self.assertEqual(self.proxy.paths, [b'/index'])
+
+    def test_cancel(self):
+        """
+        ``DELETE /session`` is forwarded
+        """
+        self.assertEqual(self.request(b'DELETE', b'/session'), b'{}')
+        self.assertEqual(self.transport.value(), b'D s1\n')
+
+    def test_proxied(self):
+        """
+        Other requests, long polls, requests without session and all requests before getting
+        active responses are proxied
+        """
+        self.request(b'GET', b'/members')
+        self.request(b'GET', b'/groups/g/index')
+        self.request(b'GET', b'/index?wait=1')
+        self.request(b'GET', b'/index', None)
+        self.replica.dataReceived(b'{"active": false, "settling": "settling"}\n')
+        self.request(b'GET', b'/index')
+        self.request(b'DELETE', b'/session')
+        self.assertEqual(self.proxy.paths, [b'/members', b'/groups/g/index', b'/index',
+                                            b'/index', b'/index', b'/session'])
+        self.assertEqual(self.transport.value(), b'')
+
+    def test_done(self):
+        """
+        `done` fires when the connection to the server is lost
+        """
+        self.assertNoResult(self.replica.done)
+        self.replica.connectionLost(None)
+        self.successResultOf(self.replica.done)